@@ -0,0 +1,75 @@
+import mrich
+from typer import Typer
+from pathlib import Path
+import json
+
+app = Typer()
+
+
+@app.command()
+def run(
+    sizes: str = "100,1000,10000",
+    work_dir: str = "benchmark_output",
+    report: str = None,
+    seed: int = 0,
+    engine: str = "joblib",
+    output_format: str = "parquet",
+    limit: int = 5,
+    batch_size: int = 200,
+    num_expansions: int = 3,
+    regenerate: bool = False,
+):
+    """Time every pipeline stage on synthetic ligands and a matching local fragment graph"""
+
+    from .run import run_benchmarks
+
+    work_dir = Path(work_dir)
+    report = Path(report or work_dir / "report.json")
+
+    results = run_benchmarks(
+        sizes=[int(size) for size in sizes.split(",")],
+        work_dir=work_dir,
+        seed=seed,
+        engine=engine,
+        output_format=output_format,
+        limit=limit,
+        batch_size=batch_size,
+        num_expansions=num_expansions,
+        regenerate=regenerate,
+    )
+
+    mrich.writing(report)
+    json.dump(results, open(report, "wt"), indent=2)
+
+
+@app.command()
+def compare(
+    baseline: str,
+    report: str,
+):
+    """Compare the timings in two benchmark reports"""
+
+    from .run import compare_reports
+
+    compare_reports(
+        json.load(open(baseline, "rt")),
+        json.load(open(report, "rt")),
+    )
+
+
+@app.command()
+def check(
+    only: str = None,
+    work_dir: str = "benchmark_output",
+):
+    """Check optimised code paths against reference implementations (e.g. --only pairs)"""
+
+    from typer import Exit
+    from .checks import run_checks
+
+    if not run_checks(only.split(",") if only else None, work_dir=work_dir):
+        raise Exit(1)
+
+
+if __name__ == "__main__":
+    app()
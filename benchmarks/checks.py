@@ -0,0 +1,726 @@
+import mrich
+
+import math
+from itertools import product
+import traceback
+import numpy as np
+from pathlib import Path
+
+EXAMPLE_SDF = Path(__file__).parent.parent / "data" / "example_hits_RdRp_green_site.sdf"
+
+# name -> check function, in the order they are run
+CHECKS = {}
+
+
+def check(func):
+    """Register a check, which raises an AssertionError if it fails"""
+    CHECKS[func.__name__.removeprefix("check_")] = func
+    return func
+
+
+def reference_pairs(
+    mol_df: "pd.DataFrame",
+    overlap_cutoff: float,
+    distance_cutoff: float,
+) -> "pd.DataFrame":
+    """Pairs from the original full cross-join, scoring every ordered pair one at a time"""
+
+    from knitwork.tools import pair_overlap, pair_min_distance
+
+    pair_df = mol_df.copy()
+    pair_df["key"] = 1
+    pair_df = pair_df.merge(pair_df, on="key", suffixes=["_A", "_B"])
+    pair_df = pair_df.drop(columns="key")
+    pair_df = pair_df[pair_df["ID_A"] != pair_df["ID_B"]]
+    pair_df = pair_df.set_index(["ID_A", "ID_B"])
+
+    pair_df["overlap"] = pair_df.apply(
+        lambda x: pair_overlap(x["ROMol_A"], x["ROMol_B"]), axis=1
+    )
+    pair_df = pair_df[~(pair_df["overlap"] > overlap_cutoff)]
+
+    pair_df["distance"] = pair_df.apply(
+        lambda x: pair_min_distance(x["ROMol_A"], x["ROMol_B"]), axis=1
+    )
+    pair_df = pair_df[~(pair_df["distance"] > distance_cutoff)]
+
+    return pair_df
+
+
+@check
+def check_pairs():
+    """get_pairs (blocked, vectorised and parallel) matches the original cross-join on the example hits"""
+
+    import numpy as np
+    from rdkit.Chem import PandasTools
+    from knitwork.config import CONFIG
+    from knitwork.fragment import get_pairs
+    from knitwork.tools import (
+        get_mol_coords,
+        pad_coords,
+        iter_pair_blocks,
+        pair_min_distance,
+        pair_min_distances,
+    )
+
+    mol_df = PandasTools.LoadSDF(str(EXAMPLE_SDF))[["ID", "ROMol"]]
+    overlap_cutoff = CONFIG["FRAGMENT_OVERLAP_CUTOFF"]
+    distance_cutoff = CONFIG["FRAGMENT_DISTANCE_CUTOFF"]
+
+    expected = reference_pairs(mol_df, overlap_cutoff, distance_cutoff)
+    mrich.var("#expected pairs", len(expected))
+
+    # overlaps over several processes, in small and large blocks
+    CONFIG["FRAGMENT_NUM_PROCESSES"] = 2
+
+    for block_size in [100, 100_000]:
+        pair_df = get_pairs(
+            mol_df, overlap_cutoff, distance_cutoff, block_size=block_size
+        )
+
+        assert list(pair_df.index) == list(expected.index), (
+            f"pairs differ (block_size={block_size})"
+        )
+
+        for column in ["overlap", "distance"]:
+            assert np.allclose(pair_df[column], expected[column]), (
+                f"{column} differs (block_size={block_size})"
+            )
+
+    # distances of every pair, in chunks of a few pairs
+    mols = list(mol_df["ROMol"])
+    padded, mask = pad_coords([get_mol_coords(mol) for mol in mols])
+    i, j = next(iter_pair_blocks(len(mols), len(mols) ** 2))
+
+    pair_bytes = padded.shape[1] ** 2 * 3 * 8
+    distances = pair_min_distances(padded, mask, i, j, max_bytes=7 * pair_bytes)
+    expected = [pair_min_distance(mols[a], mols[b]) for a, b in zip(i, j)]
+    assert np.allclose(distances, expected), "chunked minimum distances differ"
+
+
+class FakeResult:
+    def __init__(self, records: list[dict], summary=None):
+        self.records = records
+        self.summary = summary
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def consume(self):
+        return self.summary
+
+
+class FakeSession:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def run(self, query, **params) -> FakeResult:
+        # run_query sends a neo4j.Query
+        return self.driver.run(getattr(query, "text", query).strip(), **params)
+
+
+class FakeDriver:
+    """Stand-in for a Neo4j driver, answering SHOW INDEXES, EXPLAIN and PROFILE with canned results
+    and recording every query it is sent"""
+
+    def __init__(self, indexes: list[dict], plan: dict, profile: dict):
+        from types import SimpleNamespace
+
+        self.indexes = indexes
+        self.summary = SimpleNamespace(plan=plan, profile=profile)
+        self.queries = []
+
+    def session(self):
+        return FakeSession(self)
+
+    def close(self):
+        pass
+
+    def run(self, query: str, **params) -> FakeResult:
+        self.queries.append(query)
+        if query == "SHOW INDEXES":
+            return FakeResult(self.indexes)
+        if query.startswith(("EXPLAIN", "PROFILE")):
+            return FakeResult([], self.summary)
+        # e.g. the sample parameters for PROFILE, and CREATE INDEX
+        return FakeResult([])
+
+
+@check
+def check_graph():
+    """graph_check parses plans and finds missing indexes, against a fake driver"""
+
+    import os
+    import knitwork.query
+    from knitwork.config import CONFIG
+    from knitwork.graph import graph_check, query_templates, RECOMMENDED_INDEXES
+
+    # as returned by SHOW INDEXES: the built-in LOOKUP indexes have no labels or properties
+    indexes = [
+        dict(
+            name="index_343aff4e",
+            type="LOOKUP",
+            entityType="NODE",
+            labelsOrTypes=None,
+            properties=None,
+        ),
+        dict(
+            name="index_f7700477",
+            type="LOOKUP",
+            entityType="RELATIONSHIP",
+            labelsOrTypes=None,
+            properties=None,
+        ),
+        dict(
+            name="f2_smiles",
+            type="RANGE",
+            entityType="NODE",
+            labelsOrTypes=["F2"],
+            properties=["smiles"],
+        ),
+        dict(
+            name="composite",
+            type="RANGE",
+            entityType="RELATIONSHIP",
+            labelsOrTypes=["FRAG"],
+            properties=["prop_synthon", "prop_core"],
+        ),
+    ]
+
+    def operator(operator_type, children=(), **values):
+        return dict(operatorType=operator_type, children=list(children), **values)
+
+    plan = operator(
+        "ProduceResults@neo4j",
+        [
+            operator(
+                "Expand(All)@neo4j",
+                [operator("NodeByLabelScan@neo4j", args=dict(EstimatedRows=1000.0))],
+                args=dict(EstimatedRows=10.0),
+            )
+        ],
+        args=dict(EstimatedRows=5.0),
+    )
+    profile = operator(
+        "ProduceResults@neo4j",
+        [
+            operator(
+                "Expand(All)@neo4j",
+                [operator("NodeIndexSeek@neo4j", dbHits=2, rows=1)],
+                dbHits=40,
+                rows=7,
+            ),
+        ],
+        dbHits=0,
+        rows=7,
+        args=dict(EstimatedRows=5.0),
+    )
+
+    CONFIG["GRAPH_LOCATION"] = "bolt://fake:7687"
+    driver = FakeDriver(indexes, plan, profile)
+    knitwork.query.DRIVER, knitwork.query.DRIVER_PID = driver, os.getpid()
+
+    try:
+        summaries = graph_check(create_indexes=True)
+
+        assert set(summaries) == set(query_templates()), "not every query was planned"
+        for summary in summaries.values():
+            assert summary["estimated_rows"] == 5.0, summary
+            assert summary["operators"] == [
+                "ProduceResults",
+                "Expand(All)",
+                "NodeByLabelScan",
+            ], summary
+            assert summary["scans"] == ["NodeByLabelScan"], summary
+
+        # only the FRAG.prop_synthon index is missing (the composite index doesn't count)
+        created = [query for query in driver.queries if query.startswith("CREATE INDEX")]
+        assert created == [
+            "CREATE INDEX knitwork_frag_synthon IF NOT EXISTS FOR ()-[n:FRAG]-() ON (n.prop_synthon)"
+        ], created
+
+        summaries = graph_check(profile=True)
+        for summary in summaries.values():
+            assert summary["db_hits"] == 42, summary
+            assert summary["rows"] == 7, summary
+            assert summary["scans"] == [], summary
+
+        # nothing missing
+        driver.indexes = indexes + [
+            dict(
+                name="frag_synthon",
+                type="RANGE",
+                entityType="RELATIONSHIP",
+                labelsOrTypes=["FRAG"],
+                properties=["prop_synthon"],
+            )
+        ]
+        driver.queries = []
+        graph_check(create_indexes=True)
+        assert not [query for query in driver.queries if query.startswith("CREATE INDEX")]
+
+    finally:
+        knitwork.query.DRIVER = None
+
+
+class CypherReference:
+    """The fragment network queries of knitwork.query evaluated as Cypher does,
+    by enumerating every path (with no repeated relationship), from a JSON graph extract"""
+
+    def __init__(self, nodes: list[dict], edges: list[dict]):
+        self.nodes = nodes
+        self.edges = edges
+        self.out = {}
+        self.into = {}
+        for e, edge in enumerate(edges):
+            self.out.setdefault(edge["start"], []).append(e)
+            self.into.setdefault(edge["end"], []).append(e)
+
+    def is_f2(self, n: int) -> bool:
+        return "F2" in self.nodes[n].get("labels", ["F2"])
+
+    def is_mol(self, n: int) -> bool:
+        return "Mol" in self.nodes[n].get("labels", [])
+
+    def starts(self, smiles: str) -> list[int]:
+        """(a:F2 {smiles: $smiles})"""
+        return [
+            n
+            for n, node in enumerate(self.nodes)
+            if node["smiles"] == smiles and self.is_f2(n)
+        ]
+
+    def paths(self, smiles: str, max_length: int, reverse: bool = False):
+        """(node, edges) for each path (a)-[e:FRAG*0..max_length]->(node), or <- with reverse"""
+
+        adjacency, key = (self.into, "start") if reverse else (self.out, "end")
+
+        stack = [(a, []) for a in self.starts(smiles)]
+        while stack:
+            node, path = stack.pop()
+            yield node, path
+            if len(path) < max_length:
+                for e in adjacency.get(node, []):
+                    if e not in path:
+                        stack.append((self.edges[e][key], path + [e]))
+
+    def terminal(self, n: int) -> bool:
+        """NOT ()-[:FRAG]-(n)-[:FRAG]->()"""
+        touching = set(self.out.get(n, [])) | set(self.into.get(n, []))
+        return not any(r1 != r2 for r1 in touching for r2 in self.out.get(n, []))
+
+    def prop(self, e: int | None, name: str):
+        return None if e is None else self.edges[e].get(name)
+
+    def subnodes(self, smiles: str, terminal_nodes: bool) -> set[str]:
+        return {
+            self.nodes[b]["smiles"]
+            for b, path in self.paths(smiles, 20)
+            if self.is_f2(b) and (not terminal_nodes or self.terminal(b))
+        }
+
+    def synthons(self, smiles: str, terminal_nodes: bool) -> set[tuple]:
+        # paths of length 0 give a null edge, which is skipped (see knitwork.query.aget_synthons)
+        return {
+            (self.prop(path[-1], "prop_synthon"), self.prop(path[-1], "prop_core"))
+            for b, path in self.paths(smiles, 15)
+            if path and self.is_f2(b) and (not terminal_nodes or self.terminal(b))
+        }
+
+    def r_groups(self, smiles: str) -> set[tuple]:
+        records = set()
+        for b, path in self.paths(smiles, 15):
+            # e[-2] is null (and the comparison with it null) for paths shorter than 2
+            if len(path) < 2 or not self.is_f2(b) or not self.terminal(b):
+                continue
+            synthon = self.prop(path[-1], "prop_synthon")
+            r_group = self.prop(path[-2], "prop_synthon")
+            if synthon is None or r_group is None:
+                continue
+            if "[Xe]" in synthon and synthon != r_group:
+                records.add((synthon, r_group))
+        return records
+
+    def fragments(self, smiles: str) -> dict[str, tuple]:
+        """subnode -> (terminal, sorted paths)"""
+
+        depths = {}
+        for b, path in self.paths(smiles, 20):
+            if self.is_f2(b):
+                key = (b, path[-1] if path else None, path[-2] if len(path) > 1 else None)
+                depths[key] = min(depths.get(key, len(path)), len(path))
+
+        records = {}
+        for (b, edge, parent_edge), depth in depths.items():
+            records.setdefault(b, []).append(
+                (
+                    self.prop(edge, "prop_synthon"),
+                    self.prop(edge, "prop_core"),
+                    self.prop(parent_edge, "prop_synthon"),
+                    depth,
+                )
+            )
+
+        return {
+            self.nodes[b]["smiles"]: (self.terminal(b), sorted_paths(paths))
+            for b, paths in records.items()
+        }
+
+    def expansion_rows(self, smiles: str, num_hops: int) -> list[int]:
+        """Edge e of each path (a:F2 {smiles: $smiles})<-[:FRAG*0..num_hops]-(b:F2)<-[e:FRAG]-(c:Mol), in match order"""
+
+        edges = []
+        for b, path in self.paths(smiles, num_hops, reverse=True):
+            if self.is_f2(b):
+                for e in self.into.get(b, []):
+                    if e not in path and self.is_mol(self.edges[e]["start"]):
+                        edges.append(e)
+
+        return edges
+
+    def expansion_edges(self, smiles: str, num_hops: int) -> list[int]:
+        """Distinct edges of expansion_rows"""
+        return sorted(set(self.expansion_rows(smiles, num_hops)))
+
+    def pure_expansions(self, pair: dict, num_hops: int) -> list[tuple]:
+        return sorted(
+            (pair["index"], self.nodes[self.edges[e]["start"]]["smiles"])
+            for e in self.expansion_edges(pair["smiles"], num_hops)
+            if self.edges[e].get("prop_synthon") == pair["synthon"]
+        )
+
+    def impure_expansions(
+        self, pair: dict, num_hops: int, threshold: float, metric: str
+    ) -> list[tuple]:
+        """Distinct edges of impure_rows"""
+
+        edges = self.expansion_edges(pair["smiles"], num_hops)
+        return sorted(self.impure_rows(pair, edges, threshold, metric))
+
+    def impure_rows(
+        self,
+        pair: dict,
+        edges: list[int],
+        threshold: float,
+        metric: str,
+        limit: int | None = None,
+    ) -> list[tuple]:
+        """Rows of IMPURE_EXPANSIONS_QUERY for a pair, from its expansion edges (in match order)"""
+
+        records = []
+        for e in edges:
+            edge = self.edges[e]
+            if edge.get("prop_pharmfp") is None:
+                continue
+            sim = reference_similarity(metric, edge["prop_pharmfp"], pair["vector"])
+            synthon = edge.get("prop_synthon")
+            # NOT syn=p.synthon is null (so false) for a missing synthon
+            if sim >= threshold and synthon is not None and synthon != pair["synthon"]:
+                smi = self.nodes[edge["start"]]["smiles"]
+                records.append((pair["index"], smi, synthon, round(sim, 6)))
+        return records[:limit] if limit else records
+
+    def candidates(self, subnodes: list[str], num_hops: int) -> list[dict]:
+        """Rows of knitwork.query.IMPURE_CANDIDATES_QUERY (one per path, in match order)"""
+
+        rows = []
+        for s in subnodes:
+            for e in self.expansion_rows(s, num_hops):
+                edge = self.edges[e]
+                if edge.get("prop_pharmfp") is None:
+                    continue
+                c = self.nodes[edge["start"]]
+                rows.append(
+                    dict(
+                        subnode=s,
+                        smi=c["smiles"],
+                        ids=c.get("cmpd_ids"),
+                        syn=edge.get("prop_synthon"),
+                        fp=edge["prop_pharmfp"],
+                    )
+                )
+        return rows
+
+
+def sorted_paths(paths) -> list[tuple]:
+    """Paths of a FRAGMENTS_QUERY record in a canonical order (collect() has none)"""
+    return sorted((tuple(int(x) if isinstance(x, (int, np.integer)) else x for x in path) for path in paths), key=repr)
+
+
+def reference_similarity(metric: str, fp: list[int], vector: list[int]) -> float:
+    """usersimilarity.{tanimoto,dice,cosine}_similarity of two bit vectors, one pair at a time"""
+
+    a = {i for i, x in enumerate(fp) if x}
+    b = {i for i, x in enumerate(vector) if x}
+    common = len(a & b)
+
+    name = metric.rsplit(".", maxsplit=1)[-1].removesuffix("_similarity")
+    if name == "tanimoto":
+        denominator = len(a | b)
+    elif name == "dice":
+        common, denominator = 2 * common, len(a) + len(b)
+    elif name == "cosine":
+        denominator = math.sqrt(len(a) * len(b))
+
+    return common / denominator if denominator else 0.0
+
+
+def chain_graph(length: int = 24, seed: int = 0) -> dict:
+    """A FRAG chain longer than the queries' depth limits (15 and 20), with a leaf off every chain node,
+    a few shortcuts (so that nodes are reached by several paths), a repeated synthon,
+    and Mol expansions with (differently sized, or missing) fingerprints and synthons"""
+
+    rng = np.random.default_rng(seed)
+
+    nodes = [dict(smiles=f"C{k}", labels=["F2"]) for k in range(length)]
+    nodes += [dict(smiles=f"L{k}", labels=["F2"]) for k in range(length)]
+    edges = []
+
+    def edge(start, end, synthon, core=None, pharmfp=None):
+        edges.append(
+            dict(start=start, end=end, prop_synthon=synthon, prop_core=core, prop_pharmfp=pharmfp)
+        )
+
+    for k in range(length - 1):
+        # every third chain synthon has no attachment point, and two in a row are the same
+        synthon = f"[Xe]C{k}" if k % 3 else f"C{k}"
+        if k == 6:
+            synthon = edges[-2]["prop_synthon"]
+        edge(k, k + 1, synthon, f"[Xe]C{k + 1}")
+
+    for k in range(length):
+        edge(k, length + k, f"[Xe]N{k % 4}", f"[Xe]L{k}")
+
+    for start, end in [(2, 4), (9, 12), (1, 3)]:
+        edge(start, end, f"[Xe]S{start}", f"[Xe]C{end}")
+
+    synthons = ["[Xe]c1ccccc1", "[Xe]C(=O)O", "[Xe]N0", None]
+    for j in range(12):
+        m = len(nodes)
+        nodes.append(dict(smiles=f"M{j}", labels=["Mol"], cmpd_ids=[f"Z{j}"]))
+        for target in rng.choice([0, 1, 2, 3, 5, length, length + 1], size=2, replace=False):
+            width = int(rng.choice([8, 12]))
+            pharmfp = rng.integers(0, 2, width).tolist() if j % 5 else None
+            edge(m, int(target), synthons[int(rng.integers(len(synthons)))], None, pharmfp)
+
+    return dict(nodes=nodes, edges=edges)
+
+
+def synthetic_graph(num_ligands: int = 4, seed: int = 0) -> dict:
+    """A small synthetic fragment network (see benchmarks.synthetic), for ligands at one site"""
+
+    from rdkit import Chem
+    from knitwork.config import CONFIG
+    from knitwork.tools import calc_synthon_fp
+    from .synthetic import load_templates, synthetic_ligands, SyntheticGraph
+
+    def fingerprint(synthon):
+        return list(
+            calc_synthon_fp(
+                synthon,
+                CONFIG["FINGERPRINT_FDEF"],
+                CONFIG["FINGERPRINT_MAXPOINTCOUNT"],
+                CONFIG["FINGERPRINT_BINS"],
+            )
+        )
+
+    mols = synthetic_ligands(num_ligands, load_templates()[:2], seed=seed)
+
+    graph = SyntheticGraph(num_expansions=2, seed=seed)
+    graph.add_group([Chem.MolToSmiles(mol) for mol in mols], fingerprint)
+
+    return graph.data()
+
+
+@check
+def check_local_graph():
+    """LocalGraph and client-side similarity give the same results as the Cypher queries,
+    on a small synthetic graph and a chain deeper than the depth limits"""
+
+    from knitwork.local import LocalGraph
+    from knitwork.query import score_expansions
+    from knitwork.tools import SIMILARITY_METRICS, similarity_matrix
+
+    # similarity_matrix against the server's metrics, thresholded at every attainable ratio
+    rng = np.random.default_rng(0)
+    fps = rng.integers(0, 2, (200, 10))
+    vectors = rng.integers(0, 2, (50, 6))
+    thresholds = sorted({k / n for n in range(1, 21) for k in range(n + 1)})
+    for metric in SIMILARITY_METRICS:
+        similarities = similarity_matrix(fps, vectors, metric)
+        expected = np.array([[reference_similarity(metric, fp, v) for v in vectors] for fp in fps])
+        assert np.allclose(similarities, expected), f"{metric} similarity_matrix"
+        for threshold in thresholds:
+            assert np.array_equal(similarities >= threshold, expected >= threshold), (
+                f"{metric} similarity_matrix >= {threshold}"
+            )
+
+    for name, data in [("chain", chain_graph()), ("synthetic", synthetic_graph())]:
+
+        mrich.h3(name)
+
+        graph = LocalGraph(data["nodes"], data["edges"])
+        reference = CypherReference(data["nodes"], data["edges"])
+        mrich.var("graph", graph)
+
+        f2_smiles = [node["smiles"] for n, node in enumerate(data["nodes"]) if reference.is_f2(n)]
+
+        for smiles in f2_smiles:
+
+            for terminal_nodes in [True, False]:
+                subnodes = {r["f"]["smiles"] for r in graph.subnodes(smiles, terminal_nodes)}
+                assert subnodes == reference.subnodes(smiles, terminal_nodes), (
+                    f"subnodes of {smiles} (terminal_nodes={terminal_nodes})"
+                )
+
+                synthons = {
+                    (r["edge"]["prop_synthon"], r["edge"]["prop_core"])
+                    for r in graph.synthons(smiles, terminal_nodes)
+                }
+                assert synthons == reference.synthons(smiles, terminal_nodes), (
+                    f"synthons of {smiles} (terminal_nodes={terminal_nodes})"
+                )
+
+            r_groups = {(r["synthon"], r["r_group"]) for r in graph.r_groups(smiles)}
+            assert r_groups == reference.r_groups(smiles), f"r_groups of {smiles}"
+
+            fragments = {
+                r["subnode"]: (r["terminal"], sorted_paths(r["paths"]))
+                for r in graph.fragments(smiles)
+            }
+            assert fragments == reference.fragments(smiles), f"fragments of {smiles}"
+
+        # expansions of every synthon of a Mol edge, from each F2 node
+        expansion_synthons = sorted(
+            {edge["prop_synthon"] for edge in data["edges"] if reference.is_mol(edge["start"]) and edge["prop_synthon"]}
+        )
+        pairs = [
+            dict(index=i, smiles=smiles, synthon=synthon)
+            for i, (smiles, synthon) in enumerate(
+                (smiles, synthon) for smiles in f2_smiles for synthon in expansion_synthons
+            )
+        ]
+
+        for num_hops in [0, 1, 2]:
+
+            expected = [r for pair in pairs for r in reference.pure_expansions(pair, num_hops)]
+            unlimited = graph.expansions("pure", pairs=pairs, num_hops=num_hops, limit=None)
+            assert sorted((r["index"], r["smi"]) for r in unlimited) == sorted(expected), (
+                f"pure expansions (num_hops={num_hops})"
+            )
+
+            # LIMIT applies to each pair, and takes the first of its unlimited results
+            for limit in [1, 2]:
+                limited = graph.expansions("pure", pairs=pairs, num_hops=num_hops, limit=limit)
+                for pair in pairs:
+                    rows = [r["smi"] for r in unlimited if r["index"] == pair["index"]]
+                    assert [r["smi"] for r in limited if r["index"] == pair["index"]] == rows[:limit], (
+                        f"pure expansions of pair {pair['index']} (num_hops={num_hops}, limit={limit})"
+                    )
+
+        # impure expansions against random query fingerprints, of differing widths
+        rng = np.random.default_rng(0)
+        width = max(len(edge["prop_pharmfp"] or []) for edge in data["edges"])
+        impure_pairs = [
+            dict(pair, vector=rng.integers(0, 2, int(rng.choice([width, width - 4]))).tolist())
+            for pair in pairs
+        ]
+
+        # thresholds at exactly attainable ratios (e.g. 7/10 and 1/2 for tanimoto)
+        for metric, threshold in product(SIMILARITY_METRICS, [0.5, 0.7]):
+            metric = f"usersimilarity.{metric}_similarity"
+            for num_hops in [0, 2]:
+
+                expected = sorted(
+                    r
+                    for pair in impure_pairs
+                    for r in reference.impure_expansions(pair, num_hops, threshold, metric)
+                )
+
+                unlimited = graph.expansions(
+                    "impure", pairs=impure_pairs, num_hops=num_hops, limit=None, threshold=threshold, metric=metric
+                )
+                assert sorted(impure_row(r) for r in unlimited) == expected, (
+                    f"impure expansions ({metric}, num_hops={num_hops})"
+                )
+
+                # client-side scoring of the candidates query against the server-side query, row for row
+                # (a row per path in both), so that the same rows count against LIMIT
+                params = dict(pairs=impure_pairs, threshold=threshold, metric=metric)
+                rows = reference.candidates(list(dict.fromkeys(f2_smiles)), num_hops)
+                for limit in [None, 1, 2]:
+                    client = score_expansions(params, rows, limit=limit)
+                    server = [
+                        r
+                        for pair in impure_pairs
+                        for r in reference.impure_rows(
+                            pair,
+                            reference.expansion_rows(pair["smiles"], num_hops),
+                            threshold,
+                            metric,
+                            limit,
+                        )
+                    ]
+                    assert sorted(impure_row(r) for r in client) == sorted(server), (
+                        f"client-side impure expansions ({metric}, num_hops={num_hops}, limit={limit})"
+                    )
+
+                limited = graph.expansions(
+                    "impure", pairs=impure_pairs, num_hops=num_hops, limit=2, threshold=threshold, metric=metric
+                )
+                for pair in impure_pairs:
+                    rows = [impure_row(r) for r in unlimited if r["index"] == pair["index"]]
+                    got = [impure_row(r) for r in limited if r["index"] == pair["index"]]
+                    assert len(got) == min(2, len(rows)) and set(got) <= set(expected), (
+                        f"limited impure expansions of pair {pair['index']} ({metric}, num_hops={num_hops})"
+                    )
+
+
+def impure_row(record: dict) -> tuple:
+    return (record["index"], record["smi"], record["syn"], round(record["sim"], 6))
+
+
+def run_checks(
+    names: list[str] | None = None,
+    work_dir: str | Path = "benchmark_output",
+) -> bool:
+    """Run the checks (all by default), returns whether they all passed"""
+
+    from .run import setup_benchmark_config
+
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    names = names or list(CHECKS)
+
+    for name in names:
+        if name not in CHECKS:
+            raise ValueError(f"Unknown check: {name}, must be one of {list(CHECKS)}")
+
+    failed = []
+    for name in names:
+
+        mrich.h2(name)
+
+        # each check starts from the default configuration
+        setup_benchmark_config(work_dir)
+
+        try:
+            CHECKS[name]()
+        except AssertionError as e:
+            mrich.error(f"{name} failed:", e)
+            traceback.print_exc()
+            failed.append(name)
+        else:
+            mrich.success(name)
+
+    if failed:
+        mrich.error("Failed checks:", failed)
+
+    return not failed
@@ -0,0 +1,358 @@
+import mrich
+from mrich import print
+
+import json
+import time
+import shutil
+import platform
+import subprocess
+from pathlib import Path
+from datetime import datetime, timezone
+from contextlib import contextmanager
+
+from .synthetic import (
+    load_templates,
+    synthetic_ligands,
+    write_ligands,
+    SyntheticGraph,
+)
+
+# stages timed for each size, in pipeline order
+STAGES = [
+    "generate_ligands",
+    "generate_graph",
+    "load_graph",
+    "load_sdf",
+    "fragment",
+    "unique_substructure_pairs",
+    "pure_merge",
+    "impure_merge",
+    "write_pickle",
+    "write_parquet",
+    "write_sdf",
+]
+
+
+@contextmanager
+def timer(timings: dict, stage: str):
+    """Record the wall time of a block in timings[stage]"""
+
+    mrich.h3(stage)
+    start = time.perf_counter()
+    yield
+    timings[stage] = time.perf_counter() - start
+    mrich.var(f"{stage} [s]", f"{timings[stage]:.3f}")
+
+
+def git_revision() -> dict:
+    """Commit of the working tree, and whether it has uncommitted changes"""
+
+    root = Path(__file__).parent.parent
+
+    def git(*args):
+        return subprocess.run(
+            ["git", *args], cwd=root, capture_output=True, text=True
+        ).stdout.strip()
+
+    try:
+        return dict(
+            commit=git("rev-parse", "HEAD") or None,
+            dirty=bool(git("status", "--porcelain", "--untracked-files=no")),
+        )
+    except FileNotFoundError:
+        return dict(commit=None, dirty=None)
+
+
+def environment() -> dict:
+
+    import os
+    import numpy
+    import pandas
+    import rdkit
+
+    return dict(
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+        numpy=numpy.__version__,
+        pandas=pandas.__version__,
+        rdkit=rdkit.__version__,
+    )
+
+
+def setup_benchmark_config(work_dir: Path, **config) -> dict:
+    """Point knitwork at the local graph backend, with defaults for everything else.
+    Has to run before the pipeline modules are imported (their defaults are read from CONFIG)."""
+
+    from knitwork.config import DEFAULTS, dump_config, setup_config
+
+    config_path = work_dir / "config.json"
+    dump_config(DEFAULTS | dict(GRAPH_BACKEND="local") | config, config_path)
+    setup_config(config_path)
+
+    from knitwork.config import CONFIG
+
+    return CONFIG
+
+
+def generate(
+    size: int,
+    data_dir: Path,
+    seed: int,
+    num_expansions: int,
+    regenerate: bool,
+    timings: dict,
+) -> tuple[Path, Path]:
+    """Synthetic ligand SDF and local graph for a size, reused from an earlier run unless regenerate"""
+
+    from knitwork.config import CONFIG
+    from knitwork.tools import calc_synthon_fp
+    from rdkit import Chem
+
+    sdf_path = data_dir / f"ligands-{size}-{seed}.sdf"
+    graph_path = data_dir / f"graph-{size}-{seed}-{num_expansions}.json"
+
+    if regenerate or not sdf_path.exists() or not graph_path.exists():
+
+        with timer(timings, "generate_ligands"):
+            mols = synthetic_ligands(size, load_templates(), seed=seed)
+            write_ligands(mols, sdf_path)
+
+        def fingerprint(synthon):
+            return list(
+                calc_synthon_fp(
+                    synthon,
+                    CONFIG["FINGERPRINT_FDEF"],
+                    CONFIG["FINGERPRINT_MAXPOINTCOUNT"],
+                    CONFIG["FINGERPRINT_BINS"],
+                )
+            )
+
+        with timer(timings, "generate_graph"):
+            graph = SyntheticGraph(num_expansions=num_expansions, seed=seed)
+
+            # ligands at the same site are grouped, so that their synthons are combined
+            sites = {}
+            for mol in mols:
+                sites.setdefault(mol.GetIntProp("site"), []).append(Chem.MolToSmiles(mol))
+
+            for smiles_list in sites.values():
+                graph.add_group(smiles_list, fingerprint)
+
+            mrich.var("graph", graph)
+            mrich.writing(graph_path)
+            json.dump(graph.data(), open(graph_path, "wt"))
+
+    else:
+        mrich.reading(sdf_path)
+        mrich.reading(graph_path)
+
+    return sdf_path, graph_path
+
+
+def benchmark_size(
+    size: int,
+    work_dir: Path,
+    seed: int,
+    engine: str,
+    output_format: str,
+    limit: int,
+    batch_size: int,
+    num_expansions: int,
+    regenerate: bool,
+) -> dict:
+    """Time each stage of the pipeline for one number of ligands"""
+
+    import knitwork.local
+    from knitwork.config import CONFIG
+    from knitwork.fragment import fragment
+    from knitwork.knit import pure_merge, impure_merge, get_unique_substructure_pairs
+    from knitwork.io import MergeWriter, find_table, read_table, write_table, table_path
+    from knitwork.ingest import read_ligands
+
+    mrich.h2(f"{size} ligands")
+
+    timings = {}
+    counts = {}
+
+    data_dir = work_dir / "data"
+    data_dir.mkdir(parents=True, exist_ok=True)
+
+    sdf_path, graph_path = generate(
+        size, data_dir, seed, num_expansions, regenerate, timings
+    )
+
+    # outputs (and caches) from scratch, so that every query is run
+    run_dir = work_dir / f"size-{size}"
+    if run_dir.exists():
+        shutil.rmtree(run_dir)
+
+    CONFIG["GRAPH_LOCAL_PATH"] = str(graph_path.resolve())
+    knitwork.local.LOCAL_GRAPH = None
+
+    with timer(timings, "load_graph"):
+        graph = knitwork.local.get_local_graph()
+
+    counts["graph_nodes"] = len(graph.smiles)
+    counts["graph_edges"] = len(graph.start)
+
+    with timer(timings, "load_sdf"):
+        mol_df = read_ligands([sdf_path], num_threads=CONFIG["FRAGMENT_INGEST_THREADS"])
+
+    counts["ligands"] = len(mol_df)
+
+    with timer(timings, "fragment"):
+        fragment(mol_df, run_dir / "fragment", output_format=output_format)
+
+    pairs_df = read_table(
+        find_table(run_dir / "fragment", "pairs"), columns=["subnodes_A", "synthons_B"]
+    )
+    counts["pairs"] = len(pairs_df)
+
+    with timer(timings, "unique_substructure_pairs"):
+        pair_map, substructure_pairs = get_unique_substructure_pairs(pairs_df)
+
+    counts["substructure_pairs"] = len(pair_map)
+    counts["unique_substructure_pairs"] = len(substructure_pairs)
+
+    merges = {}
+    for kind, merge in [("pure", pure_merge), ("impure", impure_merge)]:
+
+        with timer(timings, f"{kind}_merge"):
+            path = merge(
+                pairs_df,
+                output_dir=run_dir / "knitwork",
+                limit=limit,
+                batch_size=batch_size,
+                engine=engine,
+                output_format=output_format,
+            )
+
+        merges[kind] = read_table(path) if path else None
+        counts[f"{kind}_merges"] = len(merges[kind]) if path else 0
+
+    # writers, on the pure merges (or the impure ones if there are none)
+    df = merges["pure"] if counts["pure_merges"] else merges["impure"]
+    writer_dir = run_dir / "writers"
+    writer_dir.mkdir()
+
+    if df is not None:
+
+        with timer(timings, "write_pickle"):
+            write_table(df, table_path(writer_dir, "merges", "pickle"))
+
+        try:
+            import pyarrow
+        except ImportError:
+            mrich.warning("pyarrow not installed, skipping write_parquet")
+        else:
+            with timer(timings, "write_parquet"):
+                write_table(df, table_path(writer_dir, "merges", "parquet"))
+
+        with timer(timings, "write_sdf"):
+            writer = MergeWriter(writer_dir, "sdf_merges", output_format, mols=False)
+            df = df.drop(columns="ROMol", errors="ignore")
+            for i in range(0, len(df), batch_size):
+                writer.write(df.iloc[i : i + batch_size])
+            writer.close()
+
+    return dict(size=size, timings=timings, counts=counts)
+
+
+def run_benchmarks(
+    sizes: list[int],
+    work_dir: str | Path = "benchmark_output",
+    seed: int = 0,
+    engine: str = "joblib",
+    output_format: str = "parquet",
+    limit: int = 5,
+    batch_size: int = 200,
+    num_expansions: int = 3,
+    regenerate: bool = False,
+) -> dict:
+    """Benchmark the pipeline at each size, returns the report"""
+
+    mrich.h1("BENCHMARKS")
+
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    config = setup_benchmark_config(work_dir, KNITWORK_OUTPUT_FORMAT=output_format)
+
+    params = dict(
+        seed=seed,
+        engine=engine,
+        output_format=output_format,
+        limit=limit,
+        batch_size=batch_size,
+        num_expansions=num_expansions,
+    )
+    mrich.var("sizes", sizes)
+    mrich.var("params", params)
+
+    results = [
+        benchmark_size(
+            size,
+            work_dir,
+            regenerate=regenerate,
+            **params,
+        )
+        for size in sizes
+    ]
+
+    return dict(
+        revision=git_revision(),
+        timestamp=datetime.now(timezone.utc).isoformat(),
+        environment=environment(),
+        params=params,
+        config=dict(config),
+        results=results,
+    )
+
+
+def compare_reports(baseline: dict, report: dict) -> None:
+    """Print the timings of two reports side by side, with the ratio of each stage's time to the baseline.
+    Differing counts are flagged, as the runs did different work."""
+
+    from rich.table import Table
+
+    mrich.var("baseline", baseline["revision"])
+    mrich.var("report", report["revision"])
+
+    if baseline["params"] != report["params"]:
+        mrich.warning("Parameters differ", baseline["params"], report["params"])
+
+    baseline_results = {result["size"]: result for result in baseline["results"]}
+
+    for result in report["results"]:
+
+        size = result["size"]
+        if (base := baseline_results.get(size)) is None:
+            mrich.warning(f"No baseline for {size} ligands")
+            continue
+
+        table = Table(title=f"{size} ligands")
+        table.add_column("stage")
+        table.add_column("baseline [s]", justify="right")
+        table.add_column("report [s]", justify="right")
+        table.add_column("ratio", justify="right")
+
+        for stage in STAGES:
+            a = base["timings"].get(stage)
+            b = result["timings"].get(stage)
+            if a is None and b is None:
+                continue
+            table.add_row(
+                stage,
+                f"{a:.3f}" if a is not None else "-",
+                f"{b:.3f}" if b is not None else "-",
+                f"{b / a:.2f}" if a and b is not None else "-",
+            )
+
+        print(table)
+
+        for key, count in result["counts"].items():
+            if base["counts"].get(key) != count:
+                mrich.warning(
+                    f"{key} differs for {size} ligands: {base['counts'].get(key)} != {count}"
+                )
@@ -0,0 +1,372 @@
+import mrich
+
+import numpy as np
+from pathlib import Path
+
+from rdkit import Chem, rdBase
+from rdkit.Chem import rdMolTransforms
+
+EXAMPLE_SDF = Path(__file__).parent.parent / "data" / "example_hits_RdRp_green_site.sdf"
+
+# substituents added to make ligand variants
+SUBSTITUENTS = ["C", "N", "O", "F", "Cl"]
+
+# separation of the copies of the example site (Å), well beyond FRAGMENT_DISTANCE_CUTOFF
+SITE_SPACING = 50.0
+
+
+def load_templates(path: str | Path = EXAMPLE_SDF) -> list[Chem.Mol]:
+    """Ligands that synthetic ligands are modelled on"""
+    mrich.reading(path)
+    return [mol for mol in Chem.SDMolSupplier(str(path)) if mol is not None]
+
+
+def synthetic_ligands(
+    n: int,
+    templates: list[Chem.Mol],
+    seed: int = 0,
+) -> list[Chem.Mol]:
+    """n ligands modelled on the templates.
+
+    The templates are copied to one site after another, so that the number of ligand pairs
+    grows linearly with n (as for many independent targets) rather than quadratically.
+    The first site holds the templates themselves, each later copy has up to three random substituents
+    and a small random rotation and translation, so that SMILES and poses differ between sites.
+    """
+
+    mols = []
+    for i in range(n):
+
+        site, t = divmod(i, len(templates))
+        rng = np.random.default_rng([seed, i])
+
+        mol = Chem.Mol(templates[t])
+
+        if site:
+            for _ in range(rng.integers(0, 4)):
+                mol = substitute(mol, rng)
+            mol = perturb(mol, rng)
+
+        # sites on a 10 x 10 x ... grid
+        offset = SITE_SPACING * np.array([site % 10, site // 10 % 10, site // 100])
+        translate(mol, offset)
+
+        mol.SetProp("_Name", f"BENCH-{i:06d}")
+        mol.SetIntProp("site", site)
+        mols.append(mol)
+
+    return mols
+
+
+def substitute(mol: Chem.Mol, rng: np.random.Generator) -> Chem.Mol:
+    """Add a random substituent to a random atom with hydrogens, placed 1.5 Å away from its neighbours"""
+
+    candidates = [atom.GetIdx() for atom in mol.GetAtoms() if atom.GetTotalNumHs()]
+    if not candidates:
+        return mol
+
+    idx = int(rng.choice(candidates))
+    symbol = str(rng.choice(SUBSTITUENTS))
+
+    conf = mol.GetConformer()
+    coords = conf.GetPositions()
+    neighbours = [n.GetIdx() for n in mol.GetAtomWithIdx(idx).GetNeighbors()]
+
+    direction = coords[idx] - coords[neighbours].mean(axis=0)
+    direction /= max(np.linalg.norm(direction), 1e-6)
+
+    rwmol = Chem.RWMol(mol)
+    new = rwmol.AddAtom(Chem.Atom(symbol))
+    rwmol.AddBond(idx, new, Chem.BondType.SINGLE)
+    rwmol.GetAtomWithIdx(idx).SetNoImplicit(False)
+    rwmol.GetAtomWithIdx(idx).SetNumExplicitHs(0)
+    rwmol.GetConformer().SetAtomPosition(new, (coords[idx] + 1.5 * direction).tolist())
+
+    try:
+        Chem.SanitizeMol(rwmol)
+    except Exception:
+        return mol
+
+    return rwmol.GetMol()
+
+
+def perturb(mol: Chem.Mol, rng: np.random.Generator) -> Chem.Mol:
+    """Rotate a ligand about its centroid (~10°) and translate it (~0.5 Å)"""
+
+    conf = mol.GetConformer()
+    centroid = conf.GetPositions().mean(axis=0)
+
+    axis = rng.normal(size=3)
+    axis /= np.linalg.norm(axis)
+    angle = np.radians(rng.normal(scale=10.0))
+
+    # Rodrigues' rotation formula
+    k = np.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+    rotation = np.eye(3) + np.sin(angle) * k + (1 - np.cos(angle)) * k @ k
+
+    transform = np.eye(4)
+    transform[:3, :3] = rotation
+    transform[:3, 3] = centroid - rotation @ centroid + rng.normal(scale=0.5, size=3)
+
+    rdMolTransforms.TransformConformer(conf, transform)
+
+    return mol
+
+
+def translate(mol: Chem.Mol, offset: np.ndarray) -> None:
+    transform = np.eye(4)
+    transform[:3, 3] = offset
+    rdMolTransforms.TransformConformer(mol.GetConformer(), transform)
+
+
+def write_ligands(mols: list[Chem.Mol], path: str | Path) -> None:
+    mrich.writing(path)
+    writer = Chem.SDWriter(str(path))
+    for mol in mols:
+        writer.write(mol)
+    writer.close()
+
+
+def cut_bonds(mol: Chem.Mol) -> list[int]:
+    """Acyclic single bonds between heavy atoms that are not terminal, with at least one end in a ring"""
+
+    bonds = []
+    for bond in mol.GetBonds():
+        a, b = bond.GetBeginAtom(), bond.GetEndAtom()
+        if (
+            bond.GetBondType() == Chem.BondType.SINGLE
+            and not bond.IsInRing()
+            and a.GetDegree() > 1
+            and b.GetDegree() > 1
+            and (a.IsInRing() or b.IsInRing())
+        ):
+            bonds.append(bond.GetIdx())
+
+    return bonds
+
+
+def split(mol: Chem.Mol, bond: int) -> list[tuple[str, str]] | None:
+    """The two pieces from cutting a bond, as (synthon with a [Xe] attachment point, capped SMILES)"""
+
+    fragmented = Chem.FragmentOnBonds(mol, [bond], dummyLabels=[(0, 0)])
+    for atom in fragmented.GetAtoms():
+        if atom.GetAtomicNum() == 0:
+            atom.SetAtomicNum(54)
+            atom.SetIsotope(0)
+
+    pieces = []
+    for piece in Chem.GetMolFrags(fragmented, asMols=True, sanitizeFrags=False):
+
+        synthon = Chem.MolFromSmiles(Chem.MolToSmiles(piece))
+        capped = Chem.MolFromSmiles(Chem.MolToSmiles(piece).replace("[Xe]", "[H]"))
+
+        if synthon is None or capped is None:
+            return None
+
+        pieces.append((Chem.MolToSmiles(synthon), Chem.MolToSmiles(capped)))
+
+    return pieces
+
+
+def attach(smiles: str, synthon: str, rng: np.random.Generator) -> tuple[str, str] | None:
+    """Attach a synthon to a random atom with hydrogens, returns (product SMILES, core with [Xe] attachment point)"""
+
+    mol = Chem.MolFromSmiles(smiles)
+    candidates = [atom.GetIdx() for atom in mol.GetAtoms() if atom.GetTotalNumHs()]
+    if not candidates:
+        return None
+
+    idx = int(rng.choice(candidates))
+
+    core = Chem.RWMol(mol)
+    dummy = core.AddAtom(Chem.Atom(0))
+    core.AddBond(idx, dummy, Chem.BondType.SINGLE)
+    core.GetAtomWithIdx(dummy).SetAtomMapNum(1)
+
+    rgroup = Chem.MolFromSmiles(synthon)
+
+    # molzip needs exactly one attachment point
+    if rgroup is None or sum(atom.GetAtomicNum() == 54 for atom in rgroup.GetAtoms()) != 1:
+        return None
+
+    rgroup = Chem.RWMol(rgroup)
+    for atom in rgroup.GetAtoms():
+        if atom.GetAtomicNum() == 54:
+            atom.SetAtomicNum(0)
+            atom.SetAtomMapNum(1)
+
+    # e.g. valence errors, which are expected (the product is skipped) rather than worth logging
+    with rdBase.BlockLogs():
+
+        try:
+            product = Chem.molzip(core, rgroup)
+            Chem.SanitizeMol(product)
+        except Exception:
+            return None
+
+        core.GetAtomWithIdx(dummy).SetAtomicNum(54)
+        core.GetAtomWithIdx(dummy).SetAtomMapNum(0)
+        core = Chem.MolFromSmiles(Chem.MolToSmiles(core))
+
+    if core is None:
+        return None
+
+    return Chem.MolToSmiles(product), Chem.MolToSmiles(core)
+
+
+class SyntheticGraph:
+    """Fragment network for a set of ligands, for knitwork.local.LocalGraph.
+
+    Each ligand is fragmented by cutting ring-substituent bonds (recursively, to max_depth),
+    with a FRAG edge from each node to both of the pieces of each cut. Every fragment is then expanded
+    into num_expansions purchasable (Mol) compounds, by attaching synthons from ligands in the same group
+    (e.g. the same site) so that there are merges to find. Expansion edges carry pharmacophore fingerprints."""
+
+    def __init__(
+        self,
+        max_depth: int = 3,
+        min_heavy_atoms: int = 3,
+        num_expansions: int = 3,
+        seed: int = 0,
+    ):
+        self.max_depth = max_depth
+        self.min_heavy_atoms = min_heavy_atoms
+        self.num_expansions = num_expansions
+        self.rng = np.random.default_rng(seed)
+
+        self.nodes = []
+        self.index = {}
+        self.edges = []
+        self.edge_keys = set()
+        self.children = {}
+        self.synthons = {}
+        self.expanded = set()
+
+    def __repr__(self) -> str:
+        return f"SyntheticGraph(#nodes={len(self.nodes)}, #edges={len(self.edges)})"
+
+    def node(self, smiles: str, cmpd_id: str | None = None) -> int:
+        """Index of a node, adding it if needed (as a Mol if it has a compound ID)"""
+
+        if (i := self.index.get(smiles)) is None:
+            i = self.index[smiles] = len(self.nodes)
+            self.nodes.append(dict(smiles=smiles, labels=["F2"], cmpd_ids=None))
+
+        if cmpd_id is not None and "Mol" not in self.nodes[i]["labels"]:
+            self.nodes[i]["labels"].append("Mol")
+            self.nodes[i]["cmpd_ids"] = [cmpd_id]
+
+        return i
+
+    def edge(
+        self,
+        start: int,
+        end: int,
+        synthon: str,
+        core: str,
+        pharmfp: list[int] | None = None,
+    ) -> None:
+
+        if (start, end, synthon) in self.edge_keys:
+            return
+
+        self.edge_keys.add((start, end, synthon))
+        self.children.setdefault(start, []).append(end)
+        self.edges.append(
+            dict(
+                start=start,
+                end=end,
+                prop_synthon=synthon,
+                prop_core=core,
+                prop_pharmfp=pharmfp,
+            )
+        )
+
+    def fragment(self, smiles: str, depth: int = 0) -> set[str]:
+        """Add the fragmentation tree of a SMILES, returns the synthons of all its cuts"""
+
+        parent = self.node(smiles)
+        if smiles in self.synthons:
+            return self.synthons[smiles]
+
+        mol = Chem.MolFromSmiles(smiles)
+
+        synthons = set()
+        for bond in cut_bonds(mol):
+
+            pieces = split(mol, bond)
+            if pieces is None:
+                continue
+
+            for (core, child), (synthon, _) in [pieces, pieces[::-1]]:
+
+                if Chem.MolFromSmiles(child).GetNumAtoms() < self.min_heavy_atoms:
+                    continue
+
+                synthons.add(synthon)
+                self.edge(parent, self.node(child), synthon, core)
+
+                if depth + 1 < self.max_depth:
+                    synthons |= self.fragment(child, depth + 1)
+
+        self.synthons[smiles] = synthons
+
+        return synthons
+
+    def expand(
+        self,
+        smiles: str,
+        synthons: list[str],
+        fingerprint,
+    ) -> None:
+        """Add purchasable compounds made by attaching random synthons to a node"""
+
+        if smiles in self.expanded or not synthons:
+            return
+        self.expanded.add(smiles)
+
+        end = self.node(smiles)
+        for _ in range(self.num_expansions):
+
+            synthon = synthons[self.rng.integers(len(synthons))]
+            if (attached := attach(smiles, synthon, self.rng)) is None:
+                continue
+
+            product, core = attached
+            start = self.node(product, cmpd_id=f"SYNTH-{len(self.nodes):08d}")
+            self.edge(start, end, synthon, core, fingerprint(synthon))
+
+    def add_group(
+        self,
+        smiles_list: list[str],
+        fingerprint,
+    ) -> None:
+        """Add the fragmentation trees of a group of ligands, expanded with the group's synthons"""
+
+        synthons = set()
+        for smiles in smiles_list:
+            synthons |= self.fragment(smiles)
+
+        # every F2 node reachable from the group
+        fragments = self.descendants([self.index[smiles] for smiles in smiles_list])
+
+        synthons = sorted(synthons)
+        for i in sorted(fragments):
+            self.expand(self.nodes[i]["smiles"], synthons, fingerprint)
+
+    def descendants(self, nodes: list[int]) -> set[int]:
+        """Nodes reachable from the given nodes (including them) by FRAG edges"""
+
+        seen = set(nodes)
+        frontier = list(nodes)
+        while frontier:
+            frontier = [
+                c for n in frontier for c in self.children.get(n, []) if c not in seen
+            ]
+            seen.update(frontier)
+
+        return seen
+
+    def data(self) -> dict:
+        """JSON extract for knitwork.local.LocalGraph"""
+        return dict(nodes=self.nodes, edges=self.edges)
@@ -1,5 +1,5 @@
 import mrich
-from typer import Typer
+from typer import Typer, Exit
 from pathlib import Path
 import json
 
@@ -10,22 +10,40 @@ app = Typer()
 def fragment(
     input_sdf: str,
     output_dir: str = "fragment_output",
+    cache_dir: str = None,
+    cached_only: bool = False,
+    output_format: str = None,
+    deduplicate: bool = True,
+    profile: bool = False,
     config_path: str = None,
 ):
-    """Fragment and pair up input molecules so that substructure matching can be run"""
+    """Fragment and pair up input molecules so that substructure matching can be run.
+    With --profile each stage is CPU profiled, worker processes included, into fragment_profile/"""
 
     mrich.h1("FRAGMENT")
     
     init_config(config_path=config_path)
 
     from .fragment import fragment as frag
-    from rdkit.Chem import PandasTools
+    from .ingest import read_ligands
+    from .config import CONFIG
 
     input_sdf = Path(input_sdf)
     mrich.var("input_sdf", input_sdf)
-    mol_df = PandasTools.LoadSDF(str(input_sdf.resolve()))
+    mol_df = read_ligands(
+        [input_sdf.resolve()],
+        num_threads=CONFIG["FRAGMENT_INGEST_THREADS"],
+        deduplicate=deduplicate,
+    )
 
-    frag(mol_df, output_dir)
+    frag(
+        mol_df,
+        output_dir,
+        cache_dir=cache_dir,
+        cached_only=cached_only,
+        output_format=output_format,
+        profile=profile,
+    )
 
 
 @app.command()
@@ -34,16 +52,29 @@ def pure_merge(
     output_dir: str = "knitwork_output",
     cached_only: bool = False,
     limit: int = 5,
+    batch_size: int = None,
+    engine: str = "joblib",
+    output_format: str = None,
+    sdf: str = "single",
+    sdf_properties: str = None,
+    mols: bool = True,
+    resume: bool = False,
+    shard: str = None,
+    profile: bool = False,
     config_path: str = None,
 ):
-    """Enumerate 'pure' knitwork merges"""
+    """Enumerate 'pure' knitwork merges.
+    Parquet output (the default) is streamed to disk, --output-format pickle builds the final table in memory.
+    With --profile each stage is CPU profiled, worker processes included, into pure_profile/"""
 
     mrich.h1("PURE MERGE")
 
     init_config(config_path=config_path)
 
-    from .knit import pure_merge as merge
-    import pandas as pd
+    from .knit import pure_merge as merge, IncompleteMergeError
+    from .config import CONFIG
+    from .io import find_table, read_table
+    from .shard import parse_shard
 
     fragment_dir = Path(fragment_dir)
     mrich.var("fragment_dir", fragment_dir)
@@ -51,13 +82,30 @@ def pure_merge(
     assert fragment_dir.exists()
     assert fragment_dir.is_dir()
 
-    pairs_df = fragment_dir / "pairs.pkl.gz"
+    # only the columns needed for knitting
+    pairs_df = find_table(fragment_dir, "pairs")
     mrich.var("pairs_df", pairs_df)
-    pairs_df = pd.read_pickle(pairs_df)
-
-    merge(
-        pairs_df=pairs_df, output_dir=output_dir, cached_only=cached_only, limit=limit
-    )
+    pairs_df = read_table(pairs_df, columns=["subnodes_A", "synthons_B"])
+
+    try:
+        merge(
+            pairs_df=pairs_df,
+            output_dir=output_dir,
+            cached_only=cached_only,
+            limit=limit,
+            batch_size=batch_size or CONFIG["KNITWORK_BATCH_SIZE"],
+            engine=engine,
+            output_format=output_format,
+            sdf=sdf,
+            sdf_properties=sdf_properties.split(",") if sdf_properties else None,
+            mols=mols,
+            resume=resume,
+            shard=parse_shard(shard) if shard else None,
+            profile=profile,
+        )
+    except IncompleteMergeError as e:
+        mrich.error(e)
+        raise Exit(1)
 
 
 @app.command()
@@ -66,16 +114,29 @@ def impure_merge(
     output_dir: str = "knitwork_output",
     cached_only: bool = False,
     limit: int = 5,
+    batch_size: int = None,
+    engine: str = "joblib",
+    output_format: str = None,
+    sdf: str = "single",
+    sdf_properties: str = None,
+    mols: bool = True,
+    resume: bool = False,
+    shard: str = None,
+    profile: bool = False,
     config_path: str = None,
 ):
-    """Enumerate 'impure' knitwork merges"""
+    """Enumerate 'impure' knitwork merges.
+    Parquet output (the default) is streamed to disk, --output-format pickle builds the final table in memory.
+    With --profile each stage is CPU profiled, worker processes included, into impure_profile/"""
 
     mrich.h1("IMPURE MERGE")
     
     init_config(config_path=config_path)
     
-    from .knit import impure_merge as merge
-    import pandas as pd
+    from .knit import impure_merge as merge, IncompleteMergeError
+    from .config import CONFIG
+    from .io import find_table, read_table
+    from .shard import parse_shard
 
     fragment_dir = Path(fragment_dir)
     mrich.var("fragment_dir", fragment_dir)
@@ -83,15 +144,102 @@ def impure_merge(
     assert fragment_dir.exists()
     assert fragment_dir.is_dir()
 
-    pairs_df = fragment_dir / "pairs.pkl.gz"
+    # only the columns needed for knitting
+    pairs_df = find_table(fragment_dir, "pairs")
     mrich.var("pairs_df", pairs_df)
-    pairs_df = pd.read_pickle(pairs_df)
+    pairs_df = read_table(pairs_df, columns=["subnodes_A", "synthons_B"])
+
+    try:
+        merge(
+            pairs_df=pairs_df,
+            output_dir=output_dir,
+            cached_only=cached_only,
+            limit=limit,
+            batch_size=batch_size or CONFIG["KNITWORK_BATCH_SIZE"],
+            engine=engine,
+            output_format=output_format,
+            sdf=sdf,
+            sdf_properties=sdf_properties.split(",") if sdf_properties else None,
+            mols=mols,
+            resume=resume,
+            shard=parse_shard(shard) if shard else None,
+            profile=profile,
+        )
+    except IncompleteMergeError as e:
+        mrich.error(e)
+        raise Exit(1)
+
+
+@app.command()
+def gather(
+    output_dir: str = "knitwork_output",
+    output_format: str = None,
+    sdf: str = "single",
+    sdf_properties: str = None,
+    mols: bool = True,
+    config_path: str = None,
+):
+    """Merge the outputs and caches of sharded (--shard i/N) knitting runs"""
+
+    mrich.h1("GATHER")
+
+    init_config(config_path=config_path)
 
-    merge(
-        pairs_df=pairs_df, output_dir=output_dir, cached_only=cached_only, limit=limit
+    from .shard import gather as gather_shards
+
+    mrich.var("output_dir", output_dir)
+
+    gather_shards(
+        output_dir,
+        output_format=output_format,
+        sdf=sdf,
+        sdf_properties=sdf_properties.split(",") if sdf_properties else None,
+        mols=mols,
     )
 
 
+@app.command()
+def graph_check(
+    smiles: str = None,
+    profile: bool = False,
+    create_indexes: bool = False,
+    config_path: str = None,
+):
+    """Check the graph's indexes and the query plans of knitwork's queries"""
+
+    mrich.h1("GRAPH CHECK")
+
+    init_config(config_path=config_path)
+
+    from .graph import graph_check as check
+
+    check(smiles=smiles, profile=profile, create_indexes=create_indexes)
+
+
+@app.command()
+def import_cache(
+    json_dir: str,
+    output_dir: str = "knitwork_output",
+    config_path: str = None,
+):
+    """Import a directory of per-query JSON cache files into the query cache"""
+
+    mrich.h1("IMPORT CACHE")
+
+    init_config(config_path=config_path)
+
+    from .cache import open_cache, import_json_cache
+
+    json_dir = Path(json_dir)
+    mrich.var("json_dir", json_dir)
+    assert json_dir.is_dir()
+
+    cache = open_cache(Path(output_dir) / "cache")
+    mrich.var("cache", cache)
+
+    import_json_cache(json_dir, cache)
+
+
 @app.command()
 def configure(
     var: str,
@@ -129,41 +277,101 @@ def configure(
     dump_config(CONFIG, config_path=config_path)
 
 
+@app.command()
+def run(
+    ligands: list[str],
+    output_dir: str = ".",
+    root: str = None,
+    cache_dir: str = None,
+    pure: bool = True,
+    impure: bool = True,
+    limit: int = 5,
+    batch_size: int = None,
+    engine: str = "joblib",
+    output_format: str = None,
+    sdf: str = "single",
+    sdf_properties: str = None,
+    mols: bool = True,
+    intermediates: bool = False,
+    profile: bool = False,
+    config_path: str = None,
+):
+    """Run the whole pipeline (combine inputs, fragment, pure and impure merge) in one process.
+    NEO4J_LOCATION, NEO4J_USERNAME and NEO4J_PASSWORD override the graph configuration.
+    With --profile each stage is CPU profiled, worker processes included"""
+
+    mrich.h1("RUN")
+
+    init_config(config_path=config_path, environment=True)
+
+    from .pipeline import run as run_pipeline
+    from .knit import IncompleteMergeError
+    from .config import CONFIG
+
+    try:
+        run_pipeline(
+            ligands,
+            output_dir=output_dir,
+            root=root,
+            kinds=["pure"] * pure + ["impure"] * impure,
+            cache_dir=cache_dir,
+            limit=limit,
+            batch_size=batch_size or CONFIG["KNITWORK_BATCH_SIZE"],
+            engine=engine,
+            output_format=output_format,
+            sdf=sdf,
+            sdf_properties=sdf_properties.split(",") if sdf_properties else None,
+            mols=mols,
+            intermediates=intermediates,
+            profile=profile,
+        )
+    except IncompleteMergeError as e:
+        mrich.error(e)
+        raise Exit(1)
+
+
 @app.command()
 def combine_inputs(
     inputs: list[str],
     output: str,
     root: str = None,
+    deduplicate: bool = True,
+    num_threads: int = None,
+    config_path: str = None,
 ):
-    """Combine SDF inputs into a single file"""
+    """Combine SDF inputs into a single file, dropping repeats of identical ligands (same SMILES and coordinates).
+    Parsed by --num-threads threads, by default FRAGMENT_INGEST_THREADS from the config (which isn't created if missing)"""
+
+    if num_threads is None:
+        from .config import DEFAULT_CONFIG_PATH, DEFAULTS, load_config
+
+        config_path = Path(config_path or DEFAULT_CONFIG_PATH)
+        config = load_config(config_path) if config_path.exists() else DEFAULTS
+        num_threads = config["FRAGMENT_INGEST_THREADS"]
 
     mrich.var("#inputs", len(inputs))
     mrich.var("inputs", inputs)
     mrich.var("output", output)
     mrich.var("root", root)
+    mrich.var("num_threads", num_threads)
 
-    from rdkit import Chem
+    from .ingest import combine_ligands
 
-    mols = []
-    for sdf_file in inputs:
-
-        if root:
-            sdf_file = Path(root) / sdf_file
-
-        suppl = Chem.SDMolSupplier(sdf_file)
-        mols.extend([m for m in suppl if m is not None])
+    combine_ligands(
+        inputs,
+        output,
+        root=root,
+        num_threads=num_threads,
+        deduplicate=deduplicate,
+    )
 
-    mrich.writing(output)
-    writer = Chem.SDWriter(output)
-    for mol in mols:
-        writer.write(mol)
-    writer.close()
 
 def init_config(
     config_path: str | Path | None = None,
+    environment: bool = False,
 ) -> None:
     from .config import setup_config
-    setup_config(config_path=config_path)
+    setup_config(config_path=config_path, environment=environment)
 
 if __name__ == "__main__":
     app()
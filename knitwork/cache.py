@@ -0,0 +1,288 @@
+import mrich
+
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+
+from .config import CONFIG
+
+CACHE_BACKENDS = ["sqlite", "json"]
+
+
+def cache_key(*params) -> str:
+    """Hash the parameters of a query into a cache key"""
+    return hashlib.sha256(json.dumps(params).encode()).hexdigest()
+
+
+def graph_params() -> list:
+    """Cache key parameters identifying the graph, so that results from a local graph extract are kept apart"""
+
+    if CONFIG["GRAPH_BACKEND"] == "local":
+        return ["local", str(Path(CONFIG["GRAPH_LOCAL_PATH"]).resolve())]
+
+    return []
+
+
+def expansion_key(
+    kind: str,
+    smiles: str,
+    synthon: str,
+    num_hops: int,
+    limit: int,
+) -> str:
+    """Cache key for a 'pure' or 'impure' expansion query"""
+
+    params = [kind, smiles, synthon, num_hops, limit]
+
+    # impure results also depend on the similarity and fingerprint settings
+    if kind == "impure":
+        params += [
+            CONFIG["KNITWORK_SIMILARITY_THRESHOLD"],
+            CONFIG["KNITWORK_SIMILARITY_METRIC"],
+            CONFIG["FINGERPRINT_FDEF"],
+            CONFIG["FINGERPRINT_MAXPOINTCOUNT"],
+            CONFIG["FINGERPRINT_BINS"],
+        ]
+
+    return cache_key(*params, *graph_params())
+
+
+def fragment_key(smiles: str) -> str:
+    """Cache key for the subnodes, synthons and r-groups of a (canonical) SMILES.
+    The combined query (FRAGMENT_COMBINED_QUERY) returns distinct r-groups, so its results are kept apart"""
+    return cache_key(
+        "fragment",
+        smiles,
+        CONFIG["FRAGMENT_TERMINAL_SUBNODES"],
+        CONFIG["FRAGMENT_TERMINAL_SYNTHONS"],
+        "combined" if CONFIG["FRAGMENT_COMBINED_QUERY"] else "separate",
+        *graph_params(),
+    )
+
+
+def open_cache(
+    cache_dir: str | Path,
+    backend: str | None = None,
+) -> "SQLiteCache | JSONCache":
+    """Open the query cache in a directory, using the KNITWORK_CACHE_BACKEND by default"""
+
+    cache_dir = Path(cache_dir)
+    backend = backend or CONFIG["KNITWORK_CACHE_BACKEND"]
+
+    if backend == "sqlite":
+        return SQLiteCache(cache_dir / "cache.sqlite")
+    elif backend == "json":
+        return JSONCache(cache_dir)
+    else:
+        raise ValueError(
+            f"Unknown cache backend: {backend}, must be one of {CACHE_BACKENDS}"
+        )
+
+
+class SQLiteCache:
+    """Query results stored as JSON in a single SQLite file.
+    WAL journalling allows concurrent readers and writers from parallel workers,
+    and within a process the connection is shared by threads (e.g. asyncio.to_thread) under a lock."""
+
+    # stay well below SQLite's limit on host parameters
+    CHUNK_SIZE = 500
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        self._pid = None
+        self._lock = threading.RLock()
+
+    def __repr__(self) -> str:
+        return f"SQLiteCache({str(self.path)!r})"
+
+    def __getstate__(self) -> dict:
+        # connections can't be pickled (or shared between processes)
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        state["_pid"] = None
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """Per-process connection, created on first use"""
+
+        if self._connection is None or self._pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(
+                self.path, timeout=120, check_same_thread=False
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self._connection.commit()
+            self._pid = os.getpid()
+
+        return self._connection
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def get_many(self, keys: list[str]) -> dict:
+        """Bulk lookup, returns a dict of the keys that are cached"""
+
+        keys = list(dict.fromkeys(keys))
+
+        results = {}
+        with self._lock:
+            for i in range(0, len(keys), self.CHUNK_SIZE):
+                chunk = keys[i : i + self.CHUNK_SIZE]
+                rows = self.connection.execute(
+                    "SELECT key, value FROM cache WHERE key IN (%s)"
+                    % ",".join("?" * len(chunk)),
+                    chunk,
+                )
+                results.update({key: json.loads(value) for key, value in rows})
+
+            self.hits += len(results)
+            self.misses += len(keys) - len(results)
+
+        return results
+
+    def set_many(self, items: dict) -> None:
+        """Bulk insert/update"""
+
+        rows = [(key, json.dumps(value)) for key, value in items.items()]
+
+        with self._lock, self.connection as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)", rows
+            )
+
+    def update(self, other: "SQLiteCache") -> None:
+        """Add the entries of another SQLite cache (e.g. from a shard), keeping existing entries"""
+
+        if not isinstance(other, SQLiteCache):
+            raise TypeError(f"Can't update {self} from {other}")
+
+        if not other.path.exists():
+            return
+
+        with self._lock:
+
+            # attach can't run inside a transaction
+            connection = self.connection
+            connection.execute("ATTACH DATABASE ? AS other", (str(other.path),))
+            try:
+                with connection:
+                    connection.execute(
+                        "INSERT OR IGNORE INTO cache (key, value) SELECT key, value FROM other.cache"
+                    )
+            finally:
+                connection.execute("DETACH DATABASE other")
+
+    def close(self) -> None:
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+
+
+class JSONCache:
+    """Query results stored as one JSON file per query, named by cache key"""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self) -> str:
+        return f"JSONCache({str(self.path)!r})"
+
+    def __len__(self) -> int:
+        return len(list(self.path.glob("*.json")))
+
+    def get_many(self, keys: list[str]) -> dict:
+        """Bulk lookup, returns a dict of the keys that are cached"""
+
+        keys = list(dict.fromkeys(keys))
+
+        results = {}
+        for key in keys:
+            cache_file = self.path / f"{key}.json"
+            if cache_file.exists():
+                results[key] = json.load(open(cache_file, "rt"))
+
+        self.hits += len(results)
+        self.misses += len(keys) - len(results)
+
+        return results
+
+    def set_many(self, items: dict) -> None:
+        """Bulk insert/update"""
+
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        for key, value in items.items():
+            # write then rename, so that parallel readers never see partial files
+            cache_file = self.path / f"{key}.json"
+            tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_file, "wt") as f:
+                json.dump(value, f)
+            tmp_file.replace(cache_file)
+
+    def update(self, other: "JSONCache") -> None:
+        """Add the entries of another JSON cache (e.g. from a shard), keeping existing entries"""
+
+        import shutil
+
+        if not isinstance(other, JSONCache):
+            raise TypeError(f"Can't update {self} from {other}")
+
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        for cache_file in other.path.glob("*.json"):
+            if not (self.path / cache_file.name).exists():
+                shutil.copy(cache_file, self.path / cache_file.name)
+
+    def close(self) -> None:
+        pass
+
+
+def import_json_cache(
+    json_dir: str | Path,
+    cache: "SQLiteCache | JSONCache",
+) -> int:
+    """Import a legacy cache directory of {kind}_{smiles}_{synthon}_{num_hops}_{limit}.json files.
+    Impure results are keyed with the current similarity and fingerprint configuration."""
+
+    json_dir = Path(json_dir)
+
+    items = {}
+    for cache_file in json_dir.glob("*.json"):
+
+        try:
+            kind, params = cache_file.stem.split("_", maxsplit=1)
+            params, num_hops, limit = params.rsplit("_", maxsplit=2)
+            smiles, synthon = params.split("_")
+            num_hops = int(num_hops)
+            limit = None if limit == "None" else int(limit)
+            assert kind in ["pure", "impure"]
+        except (ValueError, AssertionError):
+            # e.g. files already named by cache key
+            continue
+
+        key = expansion_key(kind, smiles, synthon, num_hops, limit)
+        items[key] = json.load(open(cache_file, "rt"))
+
+    mrich.var("#imported", len(items))
+    cache.set_many(items)
+
+    return len(items)
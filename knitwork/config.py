@@ -1,3 +1,4 @@
+import os
 import json
 import mrich
 from pathlib import Path
@@ -9,33 +10,81 @@ VARIABLES = {
     "GRAPH_LOCATION": str,
     "GRAPH_USERNAME": str,
     "GRAPH_PASSWORD": str,
+    "GRAPH_BACKEND": str,
+    "GRAPH_LOCAL_PATH": str,
+    "GRAPH_MAX_CONNECTION_POOL_SIZE": int,
+    "GRAPH_MAX_CONNECTION_LIFETIME": float,
+    "GRAPH_CONNECTION_ACQUISITION_TIMEOUT": float,
+    "GRAPH_KEEP_ALIVE": bool,
     "FRAGMENT_OVERLAP_CUTOFF": float,
     "FRAGMENT_DISTANCE_CUTOFF": float,
     "FRAGMENT_TERMINAL_SYNTHONS": bool,
     "FRAGMENT_TERMINAL_SUBNODES": bool,
+    "FRAGMENT_COMBINED_QUERY": bool,
     "FRAGMENT_CHECK_SINGLE_MOL": bool,
     "FRAGMENT_CHECK_CARBONS": bool,
     "FRAGMENT_CHECK_CARBON_RING": bool,
+    "FRAGMENT_NUM_PROCESSES": int,
+    "FRAGMENT_INGEST_THREADS": int,
+    "FRAGMENT_PAIR_BLOCK_SIZE": int,
+    "FRAGMENT_DESCRIPTOR_CACHE_SIZE": int,
     "KNITWORK_NUM_CONNECTIONS": int,
+    "KNITWORK_MAX_IN_FLIGHT": int,
+    "KNITWORK_QUERY_TIMEOUT": float,
+    "KNITWORK_QUERY_RETRIES": int,
+    "KNITWORK_RETRY_BACKOFF": float,
+    "KNITWORK_MAX_ATTEMPTS": int,
+    "KNITWORK_BATCH_SIZE": int,
+    "KNITWORK_CACHE_BACKEND": str,
+    "KNITWORK_OUTPUT_FORMAT": str,
+    "KNITWORK_OUTPUT_NUM_PROCESSES": int,
     "KNITWORK_SIMILARITY_THRESHOLD": float,
     "KNITWORK_SIMILARITY_METRIC": str,
+    "KNITWORK_SIMILARITY_MODE": str,
     "FINGERPRINT_FDEF": str,
     "FINGERPRINT_MAXPOINTCOUNT": int,
     "FINGERPRINT_BINS": str,
 }
 
+# environment variables overriding the graph configuration (see setup_config)
+ENVIRONMENT = {
+    "NEO4J_LOCATION": "GRAPH_LOCATION",
+    "NEO4J_USERNAME": "GRAPH_USERNAME",
+    "NEO4J_PASSWORD": "GRAPH_PASSWORD",
+}
+
 DEFAULTS = {
+    "GRAPH_BACKEND": "neo4j",
+    "GRAPH_MAX_CONNECTION_POOL_SIZE": 256,
+    "GRAPH_MAX_CONNECTION_LIFETIME": 3600.0,
+    "GRAPH_CONNECTION_ACQUISITION_TIMEOUT": 60.0,
+    "GRAPH_KEEP_ALIVE": True,
     "FRAGMENT_TERMINAL_SYNTHONS": True,
     "FRAGMENT_TERMINAL_SUBNODES": True,
+    "FRAGMENT_COMBINED_QUERY": True,
     "FRAGMENT_OVERLAP_CUTOFF": 0.56,
     "FRAGMENT_DISTANCE_CUTOFF": 5.0,
     "FRAGMENT_CHECK_SINGLE_MOL": True,
     "FRAGMENT_CHECK_CARBONS": True,
     "FRAGMENT_CHECK_CARBON_RING": True,
     "FRAGMENT_MIN_CARBONS": 3,
+    "FRAGMENT_NUM_PROCESSES": 4,
+    "FRAGMENT_INGEST_THREADS": 4,
+    "FRAGMENT_PAIR_BLOCK_SIZE": 100_000,
+    "FRAGMENT_DESCRIPTOR_CACHE_SIZE": 1_000_000,
     "KNITWORK_NUM_CONNECTIONS": 4,
+    "KNITWORK_MAX_IN_FLIGHT": 256,
+    "KNITWORK_QUERY_TIMEOUT": 600.0,
+    "KNITWORK_QUERY_RETRIES": 3,
+    "KNITWORK_RETRY_BACKOFF": 1.0,
+    "KNITWORK_MAX_ATTEMPTS": 3,
+    "KNITWORK_BATCH_SIZE": 200,
+    "KNITWORK_CACHE_BACKEND": "sqlite",
+    "KNITWORK_OUTPUT_FORMAT": "parquet",
+    "KNITWORK_OUTPUT_NUM_PROCESSES": 4,
     "KNITWORK_SIMILARITY_THRESHOLD": 0.9,
     "KNITWORK_SIMILARITY_METRIC": "usersimilarity.tanimoto_similarity",
+    "KNITWORK_SIMILARITY_MODE": "server",
     "FINGERPRINT_FDEF": "FeatureswAliphaticXenon.fdef",
     "FINGERPRINT_MAXPOINTCOUNT": 2,
     "FINGERPRINT_BINS": "[[0, 2], [2, 5], [5, 8]]",
@@ -50,7 +99,8 @@ def load_config(
     config_path = Path(config_path or DEFAULT_CONFIG_PATH)
 
     if config_path.exists():
-        return json.load(open(config_path, "rt"))
+        # fall back to defaults for variables missing from older config files
+        return DEFAULTS | json.load(open(config_path, "rt"))
     else:
         config = DEFAULTS.copy()
         dump_config(config, config_path=config_path)
@@ -70,12 +120,30 @@ def dump_config(
 
 def setup_config(
     config_path: str | Path | None = None,
+    environment: bool = False,
 ) -> None:
-    """Set global CONFIG variable"""
+    """Set global CONFIG variable, optionally overridden by environment variables (not written to the config file)"""
     
     global CONFIG
     CONFIG = load_config(config_path=config_path)
 
+    if environment:
+        CONFIG.update(config_from_environment())
+
+
+def config_from_environment() -> dict:
+    """Graph configuration from NEO4J_LOCATION, NEO4J_USERNAME and NEO4J_PASSWORD (those that are set)"""
+
+    config = {
+        var: os.environ[env] for env, var in ENVIRONMENT.items() if env in os.environ
+    }
+
+    # e.g. 'localhost:7687'
+    if "GRAPH_LOCATION" in config and "://" not in config["GRAPH_LOCATION"]:
+        config["GRAPH_LOCATION"] = "bolt://" + config["GRAPH_LOCATION"]
+
+    return config
+
 
 def print_config(prefix: str = None) -> None:
     """Print configuration"""
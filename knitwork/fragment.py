@@ -3,12 +3,22 @@ from mrich import print
 from pathlib import Path
 from .config import CONFIG, print_config
 import asyncio
-from .query import aget_subnodes, aget_synthons, aget_r_groups
+from .cache import open_cache, fragment_key
+from .metrics import METRICS, setup_metrics
+from .io import table_path, write_table
+from .query import (
+    aget_subnodes,
+    aget_synthons,
+    aget_r_groups,
+    aget_fragments,
+    aclose_driver,
+)
 from rich.progress import Progress
 from rdkit import Chem
+from collections import OrderedDict
 
-MOL_CACHE = {}
-MOL_C = None
+# descriptors of subnodes and synthons (see get_descriptors), least recently used first
+DESCRIPTOR_CACHE = OrderedDict()
 
 
 def fragment(
@@ -17,15 +27,18 @@ def fragment(
     overlap_cutoff: float = CONFIG["FRAGMENT_OVERLAP_CUTOFF"],
     distance_cutoff: float = CONFIG["FRAGMENT_DISTANCE_CUTOFF"],
     discard_props: bool = True,
-):
+    cache_dir: Path | str | None = None,
+    cached_only: bool = False,
+    output_format: str | None = None,
+    profile: bool = False,
+    write_tables: bool = True,
+) -> "pd.DataFrame":
+    """Fragment molecules and pair them up, returns the pairs dataframe.
+    With write_tables the molecules and pairs tables (and molecules.sdf) are written to output_dir.
+    Query and stage metrics are written to fragment_metrics.json, and with profile each stage is profiled into fragment_profile/"""
 
     import pandas as pd
-    from rdkit.Chem import PandasTools, MolToSmiles, MolFromSmarts
-    from itertools import permutations
-    from .tools import pair_overlap, pair_min_distance
-
-    global MOL_C
-    MOL_C = MolFromSmarts("[#6]")
+    from rdkit.Chem import PandasTools, MolToSmiles
 
     mrich.h2("knitwork.fragment.fragment()")
 
@@ -35,17 +48,25 @@ def fragment(
     mrich.var("output_dir", output_dir)
     print_config("GRAPH_LOCATION")
     print_config("FRAGMENT")
+    print_config("KNITWORK_MAX_IN_FLIGHT")
 
     # check paths
     if not output_dir.exists():
         mrich.writing(output_dir)
         output_dir.mkdir(parents=True)
 
+    # fragmentation results are cached across runs
+    cache = open_cache(cache_dir or output_dir / "cache")
+    mrich.var("cache", cache)
+
+    setup_metrics(output_dir / "fragment_profile" if profile else None)
+
     # get mols
     if discard_props:
-        mol_df = mol_df[["ID", "ROMol"]].copy()
-    mol_df.loc[:, "smiles"] = mol_df.apply(lambda x: MolToSmiles(x.ROMol), axis=1)
-    MOL_CACHE.update({r["smiles"]: r["ROMol"] for i, r in mol_df.iterrows()})
+        mol_df = mol_df[[c for c in ["ID", "ROMol", "smiles"] if c in mol_df]].copy()
+    if "smiles" not in mol_df:
+        # (knitwork.ingest.read_ligands already provides them)
+        mol_df.loc[:, "smiles"] = mol_df.apply(lambda x: MolToSmiles(x.ROMol), axis=1)
     n_molecules = len(mol_df)
     mrich.var("#molecules", n_molecules)
 
@@ -57,12 +78,35 @@ def fragment(
         t1 = progress.add_task("query subnodes", total=n_unique)
         t2 = progress.add_task("query synthons", total=n_unique)
         t3 = progress.add_task("query r_groups", total=n_unique)
-        results = asyncio.run(fragment_tasks(smiles_list, progress, (t1, t2, t3)))
+        with METRICS.stage("queries"):
+            results = asyncio.run(
+                fragment_tasks(
+                    smiles_list,
+                    progress,
+                    (t1, t2, t3),
+                    cache=cache,
+                    cached_only=cached_only,
+                )
+            )
+
+    hit_rate = cache.hits / max(n_unique, 1)
+    mrich.var("#cache hits", f"{cache.hits}/{n_unique} ({hit_rate:.0%})")
 
     # filter results
-    for smiles, v in results.items():
-        v["subnodes"] = filter_smiles_list(v["subnodes"], synthons=False)
-        v["synthons"] = filter_smiles_list(v["synthons"], synthons=True)
+    with METRICS.stage("filter"):
+        descriptors = get_descriptors(
+            set().union(
+                *(v["subnodes"] for v in results.values()),
+                *(v["synthons"] for v in results.values()),
+            )
+        )
+        for smiles, v in results.items():
+            v["subnodes"] = filter_smiles_list(
+                v["subnodes"], synthons=False, descriptors=descriptors
+            )
+            v["synthons"] = filter_smiles_list(
+                v["synthons"], synthons=True, descriptors=descriptors
+            )
 
     # update molecule dataframe
     mol_df.loc[:, "subnodes"] = mol_df["smiles"].map(lambda s: results[s]["subnodes"])
@@ -88,108 +132,323 @@ def fragment(
                 mol_df.loc[i, "subnodes"].append(new_s)
 
     # write mol_df
-    mol_df_path = output_dir / "molecules.pkl.gz"
-    mrich.writing(mol_df_path)
-    mol_df.to_pickle(mol_df_path)
-    mol_sdf_path = output_dir / "molecules.sdf"
-    mrich.writing(mol_sdf_path)
-    PandasTools.WriteSDF(
-        mol_df,
-        str(mol_sdf_path),
-        molColName="ROMol",
-        idName="ID",
-        properties=mol_df.columns,
-    )
+    if write_tables:
+        with METRICS.stage("write_molecules"):
+            write_table(mol_df, table_path(output_dir, "molecules", output_format))
+            mol_sdf_path = output_dir / "molecules.sdf"
+            mrich.writing(mol_sdf_path)
+            PandasTools.WriteSDF(
+                mol_df,
+                str(mol_sdf_path),
+                molColName="ROMol",
+                idName="ID",
+                properties=mol_df.columns,
+            )
 
     # get pairs
-    pair_df = mol_df.copy()
-    pair_df["key"] = 1
-    pair_df = pair_df.merge(pair_df, on="key", suffixes=["_A", "_B"])
-    pair_df = pair_df.drop(columns="key")
-    pair_df = pair_df[pair_df["ID_A"] != pair_df["ID_B"]]
-    pair_df = pair_df.set_index(["ID_A", "ID_B"])
-    mrich.var("#pairs", len(pair_df))
+    with METRICS.stage("pairs"):
+        pair_df = get_pairs(mol_df, overlap_cutoff, distance_cutoff)
+
+    mrich.var(f"#pairs (post-filter)", len(pair_df), "pairs")
+
+    # write pair_df
+    if write_tables:
+        with METRICS.stage("write_pairs"):
+            write_table(pair_df, table_path(output_dir, "pairs", output_format))
+
+    METRICS.write(output_dir / "fragment_metrics.json")
+
+    return pair_df
 
-    # filter by overlap
-    pair_df["overlap"] = pair_df.apply(
-        lambda x: pair_overlap(x["ROMol_A"], x["ROMol_B"]), axis=1
+
+def get_pairs(
+    mol_df: "pd.DataFrame",
+    overlap_cutoff: float,
+    distance_cutoff: float,
+    block_size: int = CONFIG["FRAGMENT_PAIR_BLOCK_SIZE"],
+) -> "pd.DataFrame":
+    """Pair up molecules that are within distance_cutoff of each other, but don't overlap by more than overlap_cutoff.
+
+    Candidate pairs are generated and filtered in blocks of block_size, so that memory is bounded by the
+    block size and the number of surviving pairs rather than all N^2 pairs. Distances are filtered first
+    (bounding boxes, then vectorised minimum interatomic distances) so that shape overlap is only calculated
+    for nearby pairs. Both measures are symmetric, so they are calculated once per unordered pair
+    (overlaps across FRAGMENT_NUM_PROCESSES processes) and mirrored."""
+
+    import numpy as np
+    import pandas as pd
+
+    n = len(mol_df)
+    mrich.var("#pairs", n * (n - 1))
+
+    n_distant = 0
+    n_overlapping = 0
+    survivors = []
+
+    with Progress() as progress:
+        task = progress.add_task("filter pairs", total=n * (n - 1) // 2)
+
+        for i, j, distance, overlap in iter_pairs(
+            mol_df,
+            distance_cutoff,
+            block_size,
+            progress=progress,
+            task=task,
+        ):
+
+            # overlap is only calculated for pairs within distance_cutoff
+            n_distant += np.isnan(overlap).sum()
+
+            overlapping = overlap > overlap_cutoff
+            n_overlapping += overlapping.sum()
+
+            keep = overlap <= overlap_cutoff
+            survivors.append((i[keep], j[keep], distance[keep], overlap[keep]))
+
+    mrich.var(f"#(distance > {distance_cutoff})", 2 * n_distant, "pairs")
+    mrich.var(f"#(overlap > {overlap_cutoff})", 2 * n_overlapping, "pairs")
+
+    if survivors:
+        i, j, distance, overlap = (np.concatenate(x) for x in zip(*survivors))
+    else:
+        i, j, distance, overlap = np.empty((4, 0))
+        i, j = i.astype(int), j.astype(int)
+
+    # mirror into both orderings of each pair, in the order of the full cross-join
+    order = np.lexsort((np.concatenate([j, i]), np.concatenate([i, j])))
+    i, j = np.concatenate([i, j])[order], np.concatenate([j, i])[order]
+    overlap = np.concatenate([overlap, overlap])[order]
+    distance = np.concatenate([distance, distance])[order]
+
+    pair_df = pd.concat(
+        [
+            mol_df.iloc[i].add_suffix("_A").reset_index(drop=True),
+            mol_df.iloc[j].add_suffix("_B").reset_index(drop=True),
+        ],
+        axis=1,
     )
-    overlapping = pair_df["overlap"] > overlap_cutoff
-    mrich.var(f"#(overlap > {overlap_cutoff})", len(pair_df[overlapping]), "pairs")
-    pair_df = pair_df[~overlapping]
+    pair_df["overlap"] = overlap
+    pair_df["distance"] = distance
+    pair_df = pair_df.set_index(["ID_A", "ID_B"])
+
+    return pair_df
+
 
-    # filter by distance
-    pair_df["distance"] = pair_df.apply(
-        lambda x: pair_min_distance(x["ROMol_A"], x["ROMol_B"]), axis=1
+def iter_pairs(
+    mol_df: "pd.DataFrame",
+    distance_cutoff: float,
+    block_size: int,
+    progress=None,
+    task=None,
+):
+    """Generate blocks of unordered molecule pairs (i < j) with their minimum distance and overlap.
+    Overlap is NaN for pairs further apart than distance_cutoff, and pairs with identical IDs are skipped."""
+
+    import numpy as np
+    from .tools import (
+        pair_overlaps,
+        get_mol_coords,
+        pad_coords,
+        iter_pair_blocks,
+        bounding_box_distances,
+        pair_min_distances,
     )
-    distant = pair_df["distance"] > distance_cutoff
-    mrich.var(f"#(distance > {distance_cutoff})", len(pair_df[distant]), "pairs")
-    pair_df = pair_df[~distant]
 
-    mrich.var(f"#pairs (post-filter)", len(pair_df), "pairs")
+    mols = list(mol_df["ROMol"])
+    ids = mol_df["ID"].to_numpy()
 
-    # write pair_df
-    pair_df_path = output_dir / "pairs.pkl.gz"
-    mrich.writing(pair_df_path)
-    pair_df.to_pickle(pair_df_path)
+    # coordinates, extracted once per molecule
+    coords = [get_mol_coords(mol) for mol in mols]
+    padded, mask = pad_coords(coords)
+    lower = np.array([c.min(axis=0) for c in coords]).reshape(-1, 3)
+    upper = np.array([c.max(axis=0) for c in coords]).reshape(-1, 3)
+
+    for i, j in iter_pair_blocks(len(mols), block_size):
 
+        if progress:
+            progress.update(task, advance=len(i))
 
-async def fragment_tasks(smiles_list, progress, tasks):
+        # only pair up different IDs
+        different = ids[i] != ids[j]
+        i, j = i[different], j[different]
 
-    t1, t2, t3 = tasks
+        distance = np.full(len(i), np.inf)
+        overlap = np.full(len(i), np.nan)
 
-    tasks = [
-        asyncio.gather(
-            aget_subnodes(smiles, progress=progress, task=t1),
-            aget_synthons(smiles, progress=progress, task=t2),
-            aget_r_groups(smiles, progress=progress, task=t3),
+        # bounding box prefilter
+        close = np.flatnonzero(
+            bounding_box_distances(lower, upper, i, j) <= distance_cutoff
         )
-        for smiles in smiles_list
-    ]
 
-    results = await asyncio.gather(*tasks)
+        # filter by distance
+        distance[close] = pair_min_distances(padded, mask, i[close], j[close])
+        close = close[distance[close] <= distance_cutoff]
+
+        # overlap of nearby pairs
+        overlap[close] = pair_overlaps(
+            mols,
+            i[close],
+            j[close],
+            n_jobs=CONFIG["FRAGMENT_NUM_PROCESSES"],
+        )
+
+        yield i, j, distance, overlap
+
 
-    return {
+async def fragment_tasks(
+    smiles_list,
+    progress,
+    tasks,
+    cache=None,
+    cached_only: bool = False,
+):
+    """Query subnodes, synthons and r-groups for each SMILES not already in the cache.
+    At most KNITWORK_MAX_IN_FLIGHT queries run concurrently (see knitwork.query.arun_query)"""
+
+    results, todo = get_cached_fragments(smiles_list, cache, cached_only)
+
+    for task in tasks:
+        progress.update(task, advance=len(results))
+
+    if CONFIG["FRAGMENT_COMBINED_QUERY"]:
+        coros = [
+            aget_fragments(smiles, progress=progress, tasks=tasks) for smiles in todo
+        ]
+
+    else:
+        t1, t2, t3 = tasks
+        coros = [
+            asyncio.gather(
+                aget_subnodes(smiles, progress=progress, task=t1),
+                aget_synthons(smiles, progress=progress, task=t2),
+                aget_r_groups(smiles, progress=progress, task=t3),
+            )
+            for smiles in todo
+        ]
+
+    try:
+        query_results = await asyncio.gather(*coros)
+    finally:
+        await aclose_driver()
+
+    new_results = {
         smiles: {"subnodes": subnodes, "synthons": synthons, "r_groups": r_groups}
-        for smiles, (subnodes, synthons, r_groups) in zip(smiles_list, results)
+        for smiles, (subnodes, synthons, r_groups) in zip(todo, query_results)
     }
 
+    if cache is not None:
+        cache.set_many(
+            {
+                fragment_key(smiles): {k: list(v) for k, v in result.items()}
+                for smiles, result in new_results.items()
+            }
+        )
+
+    results.update(new_results)
+
+    return results
+
+
+def get_cached_fragments(
+    smiles_list,
+    cache=None,
+    cached_only: bool = False,
+) -> tuple[dict, list]:
+    """Look up cached fragmentation results, returns a dict of results and a list of SMILES still to query"""
+
+    results = {}
+
+    if cache is None:
+        return results, list(smiles_list)
+
+    keys = {smiles: fragment_key(smiles) for smiles in smiles_list}
+    cached = cache.get_many(keys.values())
+
+    skipped = 0
+    for smiles, key in keys.items():
+        if key in cached:
+            result = cached[key]
+            results[smiles] = {
+                "subnodes": set(result["subnodes"]),
+                "synthons": set(result["synthons"]),
+                "r_groups": [tuple(r_group) for r_group in result["r_groups"]],
+            }
+        elif cached_only:
+            results[smiles] = {"subnodes": set(), "synthons": set(), "r_groups": []}
+            skipped += 1
 
-def filter_smiles_list(smiles_list, synthons: bool):
+    if skipped:
+        mrich.warning("Skipped", skipped, "uncached molecules")
 
-    from rdkit import Chem
+    METRICS.record_cache("fragments", hits=len(cached), misses=len(keys) - len(cached))
+
+    todo = [smiles for smiles in smiles_list if smiles not in results]
+
+    return results, todo
+
+
+def get_descriptors(
+    smiles_list,
+    n_jobs: int = CONFIG["FRAGMENT_NUM_PROCESSES"],
+    max_size: int = CONFIG["FRAGMENT_DESCRIPTOR_CACHE_SIZE"],
+) -> dict[str, tuple[int, int, int, int] | None]:
+    """(#atoms, #carbons, #ring atoms, #rings) for each SMILES (None if it can't be parsed).
+    Uncached SMILES are parsed once across n_jobs processes, and the max_size most recently used are kept in DESCRIPTOR_CACHE
+    """
+
+    from .tools import smiles_descriptors
+
+    descriptors = {}
+    todo = []
+    for smiles in smiles_list:
+        if smiles in DESCRIPTOR_CACHE:
+            DESCRIPTOR_CACHE.move_to_end(smiles)
+            descriptors[smiles] = DESCRIPTOR_CACHE[smiles]
+        else:
+            todo.append(smiles)
+
+    METRICS.record_cache("descriptors", hits=len(descriptors), misses=len(todo))
+
+    for smiles, row in zip(todo, smiles_descriptors(todo, n_jobs=n_jobs).tolist()):
+        row = tuple(row) if row[0] >= 0 else None
+        descriptors[smiles] = DESCRIPTOR_CACHE[smiles] = row
+
+    while len(DESCRIPTOR_CACHE) > max_size:
+        DESCRIPTOR_CACHE.popitem(last=False)
+
+    return descriptors
+
+
+def filter_smiles_list(smiles_list, synthons: bool, descriptors: dict | None = None):
+    """Filter subnodes or synthons according to the FRAGMENT_CHECK_* settings,
+    descriptors are calculated (see get_descriptors) unless given"""
 
     filtered = [s for s in smiles_list]
     if CONFIG["FRAGMENT_CHECK_SINGLE_MOL"]:
         filtered = [s for s in filtered if "." not in s]
 
+    if not (CONFIG["FRAGMENT_CHECK_CARBONS"] or CONFIG["FRAGMENT_CHECK_CARBON_RING"]):
+        return filtered
+
+    if descriptors is None:
+        descriptors = get_descriptors(filtered)
+
+    # SMILES that can't be parsed
+    filtered = [s for s in filtered if descriptors[s] is not None]
+
     if CONFIG["FRAGMENT_CHECK_CARBONS"]:
         n_c = CONFIG["FRAGMENT_MIN_CARBONS"]
-        filtered = [
-            s
-            for s in filtered
-            if len(
-                MOL_CACHE.setdefault(s, Chem.MolFromSmiles(s)).GetSubstructMatches(
-                    MOL_C
-                )
-            )
-            >= n_c
-        ]
+        filtered = [s for s in filtered if descriptors[s][1] >= n_c]
 
     if CONFIG["FRAGMENT_CHECK_CARBON_RING"]:
 
         new_filtered = []
         for s in filtered:
-            mol = MOL_CACHE.setdefault(s, Chem.MolFromSmiles(s))
+            num_atoms, num_carbons, num_ring_atoms, num_rings = descriptors[s]
 
-            num_rings = mol.GetRingInfo().NumRings()
             if num_rings != 1:
                 new_filtered.append(s)
 
-            num_ring_atoms = sum([atom.IsInRing() for atom in mol.GetAtoms()])
-            num_carbons = len(mol.GetSubstructMatches(MOL_C))
-            num_atoms = mol.GetNumAtoms()
-
             # one atom will be a xenon (attachment point)
             if synthons and (
                 num_ring_atoms != (num_atoms - 1) or num_carbons != (num_atoms - 1)
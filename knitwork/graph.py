@@ -0,0 +1,251 @@
+import mrich
+from mrich import print
+
+from .config import CONFIG
+from .query import (
+    get_driver,
+    run_query,
+    get_synthon_vector,
+    SUBNODES_QUERY,
+    TERMINAL_SUBNODES_QUERY,
+    SYNTHONS_QUERY,
+    TERMINAL_SYNTHONS_QUERY,
+    R_GROUPS_QUERY,
+    FRAGMENTS_QUERY,
+    PURE_EXPANSIONS_QUERY,
+    IMPURE_EXPANSIONS_QUERY,
+    IMPURE_CANDIDATES_QUERY,
+)
+
+# (name, node label or relationship type, property, is relationship)
+RECOMMENDED_INDEXES = [
+    ("knitwork_f2_smiles", "F2", "smiles", False),
+    ("knitwork_frag_synthon", "FRAG", "prop_synthon", True),
+]
+
+# plan operators that read every node with a label (or every relationship of a type)
+SCAN_OPERATORS = [
+    "AllNodesScan",
+    "NodeByLabelScan",
+    "DirectedRelationshipTypeScan",
+    "UndirectedRelationshipTypeScan",
+    "DirectedAllRelationshipsScan",
+    "UndirectedAllRelationshipsScan",
+]
+
+
+def query_templates(num_hops: int = 2, limit: int = 5) -> dict[str, str]:
+    """All query templates in knitwork.query, by name"""
+
+    expansion_params = {
+        "num_hops": num_hops,
+        "limit": f"LIMIT {limit}" if limit else "",
+        "metric": CONFIG["KNITWORK_SIMILARITY_METRIC"],
+    }
+
+    return {
+        "subnodes": SUBNODES_QUERY,
+        "terminal_subnodes": TERMINAL_SUBNODES_QUERY,
+        "synthons": SYNTHONS_QUERY,
+        "terminal_synthons": TERMINAL_SYNTHONS_QUERY,
+        "r_groups": R_GROUPS_QUERY,
+        "fragments": FRAGMENTS_QUERY,
+        "pure_expansions": PURE_EXPANSIONS_QUERY % expansion_params,
+        "impure_expansions": IMPURE_EXPANSIONS_QUERY % expansion_params,
+        "impure_candidates": IMPURE_CANDIDATES_QUERY % expansion_params,
+    }
+
+
+def sample_params(smiles: str | None = None) -> dict:
+    """Parameters for the query templates, for a SMILES (and one of its synthons) in the graph"""
+
+    records = run_query(
+        """
+        MATCH (a:F2)-[e:FRAG]->(:F2)
+        WHERE e.prop_synthon CONTAINS '[Xe]' AND ($smiles IS NULL OR a.smiles = $smiles)
+        RETURN a.smiles as smiles, e.prop_synthon as synthon
+        LIMIT 1
+        """,
+        smiles=smiles,
+    )
+
+    if records:
+        smiles, synthon = records[0]["smiles"], records[0]["synthon"]
+    else:
+        mrich.warning("No sample node found, profiling with placeholder SMILES")
+        smiles, synthon = smiles or "CCO", "[Xe]C"
+
+    mrich.var("sample smiles", smiles)
+    mrich.var("sample synthon", synthon)
+
+    pair = dict(
+        index=0, smiles=smiles, synthon=synthon, vector=get_synthon_vector(synthon)
+    )
+
+    return dict(
+        smiles=smiles,
+        subnodes=[smiles],
+        pairs=[pair],
+        threshold=CONFIG["KNITWORK_SIMILARITY_THRESHOLD"],
+        metric=CONFIG["KNITWORK_SIMILARITY_METRIC"],
+    )
+
+
+def get_plan(
+    query: str,
+    params: dict,
+    profile: bool = False,
+) -> dict:
+    """Plan of a query from EXPLAIN (not executed) or PROFILE (executed, with db hits)"""
+
+    driver = get_driver()
+    with driver.session() as session:
+        result = session.run(f"{'PROFILE' if profile else 'EXPLAIN'} {query}", **params)
+        summary = result.consume()
+
+    return summary.profile if profile else summary.plan
+
+
+def walk_plan(plan: dict):
+    """Iterate over every operator in a plan tree"""
+    yield plan
+    for child in plan.get("children", []):
+        yield from walk_plan(child)
+
+
+def summarise_plan(plan: dict) -> dict:
+    """Total db hits and rows, estimated rows and the scan operators in a plan"""
+
+    operators = list(walk_plan(plan))
+
+    def operator_type(operator):
+        # e.g. "NodeByLabelScan@neo4j"
+        return operator["operatorType"].split("@")[0]
+
+    args = plan.get("args", plan.get("arguments", {}))
+
+    return dict(
+        db_hits=sum(operator.get("dbHits", 0) for operator in operators),
+        rows=plan.get("rows"),
+        estimated_rows=args.get("EstimatedRows"),
+        operators=[operator_type(operator) for operator in operators],
+        scans=[
+            operator_type(operator)
+            for operator in operators
+            if operator_type(operator) in SCAN_OPERATORS
+        ],
+    )
+
+
+def get_indexes() -> list[tuple[str, str]]:
+    """(label or type, property) of each single-property index in the graph"""
+
+    try:
+        records = run_query("SHOW INDEXES")
+    except Exception:
+        # Neo4j < 4.2
+        records = run_query("CALL db.indexes()")
+
+    indexes = []
+    for record in records:
+        labels = record.get("labelsOrTypes") or record.get("tokenNames") or []
+        properties = record.get("properties") or []
+        if len(labels) == 1 and len(properties) == 1:
+            indexes.append((labels[0], properties[0]))
+
+    return indexes
+
+
+def index_statement(
+    name: str,
+    label: str,
+    prop: str,
+    relationship: bool,
+) -> str:
+    """Cypher to create a range index"""
+
+    if relationship:
+        pattern = f"()-[n:{label}]-()"
+    else:
+        pattern = f"(n:{label})"
+
+    return f"CREATE INDEX {name} IF NOT EXISTS FOR {pattern} ON (n.{prop})"
+
+
+def graph_check(
+    smiles: str | None = None,
+    profile: bool = False,
+    create_indexes: bool = False,
+) -> dict[str, dict]:
+    """Check the graph for the recommended indexes and EXPLAIN (or PROFILE) every query template.
+    Returns a summary of each query's plan."""
+
+    from rich.table import Table
+    from rich.markup import escape
+
+    mrich.h2("knitwork.graph.graph_check()")
+    mrich.var("GRAPH_LOCATION", CONFIG["GRAPH_LOCATION"])
+
+    # indexes
+    indexes = get_indexes()
+    mrich.var("#indexes", len(indexes))
+
+    missing = [
+        index for index in RECOMMENDED_INDEXES if (index[1], index[2]) not in indexes
+    ]
+
+    for name, label, prop, relationship in RECOMMENDED_INDEXES:
+        if (name, label, prop, relationship) in missing:
+            mrich.warning("Missing index", index_statement(name, label, prop, relationship))
+        else:
+            mrich.success("Index", f"{label}.{prop}")
+
+    if create_indexes:
+        for index in missing:
+            statement = index_statement(*index)
+            mrich.print("Creating", escape(statement))
+            run_query(statement)
+
+    # query plans
+    params = sample_params(smiles) if profile else dict(
+        smiles="",
+        subnodes=[],
+        pairs=[],
+        threshold=CONFIG["KNITWORK_SIMILARITY_THRESHOLD"],
+        metric=CONFIG["KNITWORK_SIMILARITY_METRIC"],
+    )
+
+    table = Table(title="PROFILE" if profile else "EXPLAIN")
+    table.add_column("query")
+    table.add_column("db hits" if profile else "estimated rows", justify="right")
+    table.add_column("scans")
+
+    summaries = {}
+    for name, query in query_templates().items():
+
+        try:
+            plan = get_plan(query, params, profile=profile)
+        except Exception as e:
+            mrich.error(f"Could not plan {name}: {e}")
+            table.add_row(name, "error", "")
+            continue
+
+        summary = summarise_plan(plan)
+        summaries[name] = summary
+
+        hits = summary["db_hits"] if profile else summary["estimated_rows"]
+        table.add_row(
+            name,
+            f"{hits:,.0f}" if hits is not None else "",
+            ", ".join(summary["scans"]) or "-",
+        )
+
+    print(table)
+
+    for name, summary in summaries.items():
+        if summary["scans"]:
+            mrich.warning(
+                f"{name} scans {', '.join(summary['scans'])}, check the indexes above"
+            )
+
+    return summaries
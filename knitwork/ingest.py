@@ -0,0 +1,149 @@
+import mrich
+
+import heapq
+import hashlib
+import numpy as np
+from pathlib import Path
+from rdkit import Chem
+
+
+def iter_sdf(
+    path: str | Path,
+    num_threads: int = 1,
+):
+    """Iterate over the molecules in an SDF in file order, skipping records that can't be parsed.
+    With num_threads > 1 records are parsed by a multithreaded supplier."""
+
+    path = str(path)
+
+    if num_threads <= 1 or not hasattr(Chem, "MultithreadedSDMolSupplier"):
+        for mol in Chem.SDMolSupplier(path):
+            if mol is not None:
+                yield mol
+        return
+
+    supplier = Chem.MultithreadedSDMolSupplier(path, numWriterThreads=num_threads)
+
+    # records are parsed out of order, a small heap (bounded by the supplier's queues) restores file order
+    heap = []
+    next_id = 1
+
+    for mol in supplier:
+        heapq.heappush(heap, (supplier.GetLastRecordId(), mol))
+
+        while heap and heap[0][0] == next_id:
+            _, mol = heapq.heappop(heap)
+            next_id += 1
+            if mol is not None:
+                yield mol
+
+    while heap:
+        _, mol = heapq.heappop(heap)
+        if mol is not None:
+            yield mol
+
+
+def ligand_key(
+    mol: Chem.Mol,
+    smiles: str | None = None,
+) -> bytes:
+    """Digest of a ligand's canonical SMILES and coordinates (in canonical atom order, to 0.001 Å),
+    the same for identical poses read from different files"""
+
+    smiles = smiles or Chem.MolToSmiles(mol)
+
+    order = np.argsort(list(Chem.CanonicalRankAtoms(mol)))
+    coords = np.round(mol.GetConformer().GetPositions()[order], 3) + 0.0  # no -0.0
+
+    return hashlib.sha1(smiles.encode() + coords.tobytes()).digest()
+
+
+def iter_ligands(
+    inputs: list[str | Path],
+    root: str | Path | None = None,
+    num_threads: int = 1,
+    deduplicate: bool = True,
+):
+    """Iterate over (canonical SMILES, molecule) for each ligand in the input SDFs,
+    optionally skipping repeats of identical ligands (same SMILES and coordinates)"""
+
+    seen = set()
+    n_duplicates = 0
+
+    for sdf_file in inputs:
+
+        if root:
+            sdf_file = Path(root) / sdf_file
+
+        mrich.reading(sdf_file)
+
+        for mol in iter_sdf(sdf_file, num_threads=num_threads):
+
+            smiles = Chem.MolToSmiles(mol)
+
+            if deduplicate:
+                key = ligand_key(mol, smiles)
+                if key in seen:
+                    n_duplicates += 1
+                    continue
+                seen.add(key)
+
+            yield smiles, mol
+
+    if deduplicate:
+        mrich.var("#duplicate ligands", n_duplicates)
+
+
+def read_ligands(
+    inputs: list[str | Path],
+    root: str | Path | None = None,
+    num_threads: int = 1,
+    deduplicate: bool = True,
+) -> "pd.DataFrame":
+    """Read the input SDFs into a molecule dataframe with ID, ROMol and smiles columns.
+    Only the ID (molecule name) and structure are kept, other SD properties are discarded."""
+
+    import pandas as pd
+
+    ids = []
+    mols = []
+    smiles_list = []
+
+    for smiles, mol in iter_ligands(inputs, root, num_threads, deduplicate):
+
+        ids.append(mol.GetProp("_Name") if mol.HasProp("_Name") else "")
+
+        for prop in mol.GetPropNames():
+            mol.ClearProp(prop)
+
+        mols.append(mol)
+        smiles_list.append(smiles)
+
+    mol_df = pd.DataFrame(dict(ID=ids, ROMol=mols, smiles=smiles_list))
+    mrich.var("#ligands", len(mol_df))
+
+    return mol_df
+
+
+def combine_ligands(
+    inputs: list[str | Path],
+    output: str | Path,
+    root: str | Path | None = None,
+    num_threads: int = 1,
+    deduplicate: bool = True,
+) -> int:
+    """Stream the input SDFs into a single SDF (with all SD properties), record by record.
+    Returns the number of ligands written."""
+
+    mrich.writing(output)
+    writer = Chem.SDWriter(str(output))
+
+    n = 0
+    for _, mol in iter_ligands(inputs, root, num_threads, deduplicate):
+        writer.write(mol)
+        n += 1
+
+    writer.close()
+    mrich.var("#ligands", n)
+
+    return n
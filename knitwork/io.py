@@ -0,0 +1,396 @@
+import mrich
+
+import os
+import json
+import shutil
+from pathlib import Path
+
+from .config import CONFIG
+
+FORMATS = ["pickle", "parquet"]
+
+EXTENSIONS = {
+    "pickle": ".pkl.gz",
+    "parquet": ".parquet",
+}
+
+SDF_OUTPUTS = ["single", "shards", "none"]
+
+# parquet schema metadata key listing the columns stored as binary mols
+MOL_COLUMNS_KEY = b"knitwork.mol_columns"
+
+
+def table_path(
+    directory: str | Path,
+    name: str,
+    output_format: str | None = None,
+) -> Path:
+    """Path of a table (e.g. 'pairs') in a directory, for the given format (KNITWORK_OUTPUT_FORMAT by default)"""
+
+    output_format = output_format or CONFIG["KNITWORK_OUTPUT_FORMAT"]
+
+    if output_format not in FORMATS:
+        raise ValueError(
+            f"Unknown output format: {output_format}, must be one of {FORMATS}"
+        )
+
+    return Path(directory) / f"{name}{EXTENSIONS[output_format]}"
+
+
+def find_table(
+    directory: str | Path,
+    name: str,
+) -> Path:
+    """Find an existing table in a directory, preferring KNITWORK_OUTPUT_FORMAT"""
+
+    output_format = CONFIG["KNITWORK_OUTPUT_FORMAT"]
+    formats = [output_format] + [f for f in FORMATS if f != output_format]
+
+    for f in formats:
+        path = table_path(directory, name, f)
+        if path.exists():
+            return path
+
+    raise FileNotFoundError(f"No '{name}' table in {directory}")
+
+
+def table_format(path: str | Path) -> str:
+    """Format of a table file, from its extension"""
+
+    for output_format, extension in EXTENSIONS.items():
+        if str(path).endswith(extension):
+            return output_format
+
+    raise ValueError(f"Unknown table format: {path}")
+
+
+def write_table(
+    df: "pd.DataFrame",
+    path: str | Path,
+) -> None:
+    """Write a dataframe as a gzipped pickle or (zstd-compressed) parquet, depending on the extension"""
+
+    mrich.writing(path)
+
+    if table_format(path) == "pickle":
+        df.to_pickle(path)
+    else:
+        write_parquet(df, path)
+
+
+def read_table(
+    path: str | Path,
+    columns: list[str] | None = None,
+) -> "pd.DataFrame":
+    """Read a table written by write_table, optionally only some of its columns (the index is always read)"""
+
+    mrich.reading(path)
+
+    if table_format(path) == "pickle":
+        import pandas as pd
+
+        df = pd.read_pickle(path)
+        if columns is not None:
+            df = df[columns]
+        return df
+
+    else:
+        return read_parquet(path, columns=columns)
+
+
+def write_parquet(
+    df: "pd.DataFrame",
+    path: str | Path,
+    preserve_index: bool | None = None,
+) -> None:
+    """Write a dataframe as parquet, storing RDKit molecules as binary mols"""
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from rdkit.Chem import Mol, PropertyPickleOptions
+
+    pickle_options = (
+        PropertyPickleOptions.AllProps | PropertyPickleOptions.CoordsAsDouble
+    )
+
+    mol_columns = [
+        column
+        for column in df.columns
+        if df[column].dtype == object
+        and isinstance(next(iter(df[column].dropna()), None), Mol)
+    ]
+
+    if mol_columns:
+        df = df.copy()
+        for column in mol_columns:
+            df[column] = [
+                mol.ToBinary(pickle_options) if mol is not None else None
+                for mol in df[column]
+            ]
+
+    table = pa.Table.from_pandas(df, preserve_index=preserve_index)
+    table = table.replace_schema_metadata(
+        {**table.schema.metadata, MOL_COLUMNS_KEY: json.dumps(mol_columns)}
+    )
+
+    pq.write_table(table, path, compression="zstd")
+
+
+def read_parquet(
+    path: str | Path,
+    columns: list[str] | None = None,
+) -> "pd.DataFrame":
+    """Read (memory-mapped) parquet written by write_parquet, restoring molecules and list columns"""
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from rdkit.Chem import Mol
+
+    table = pq.read_table(
+        path, columns=columns, memory_map=True, use_pandas_metadata=True
+    )
+
+    mol_columns = json.loads(table.schema.metadata.get(MOL_COLUMNS_KEY, b"[]"))
+
+    df = table.to_pandas()
+
+    for field in table.schema:
+
+        if field.name not in df.columns:
+            continue
+
+        # lists are read as numpy arrays by default
+        if pa.types.is_list(field.type) or pa.types.is_large_list(field.type):
+            df[field.name] = table.column(field.name).to_pylist()
+
+        elif field.name in mol_columns:
+            df[field.name] = [
+                Mol(blob) if blob is not None else None for blob in df[field.name]
+            ]
+
+    return df
+
+
+def write_part(
+    df: "pd.DataFrame",
+    path: str | Path,
+) -> None:
+    """Write a part of a table (keeping its index, so that it survives combining the parts).
+    The part is written to a temporary file and renamed, so that a crash never leaves it truncated"""
+
+    path = Path(path)
+    tmp_path = path.with_name(f".tmp-{path.name}")
+
+    if table_format(path) == "pickle":
+        df.to_pickle(tmp_path)
+    else:
+        write_parquet(df, tmp_path, preserve_index=True)
+
+    os.replace(tmp_path, path)
+
+
+def read_part(path: str | Path) -> "pd.DataFrame":
+    """Read a part written by write_part"""
+
+    if table_format(path) == "pickle":
+        import pandas as pd
+
+        return pd.read_pickle(path)
+    else:
+        return read_parquet(path)
+
+
+def write_merge_part(
+    path: Path,
+    sdf_path: Path | None,
+    properties: list[str] | None,
+    mols: bool,
+) -> None:
+    """Parse the merge SMILES of one part, writing an SDF shard and/or adding ROMol to the part"""
+
+    from rdkit.Chem import MolFromSmiles, PandasTools
+
+    df = read_part(path)
+    df["ROMol"] = [MolFromSmiles(smiles) for smiles in df["merge_smiles"]]
+
+    if sdf_path is not None:
+        df["ID"] = df.index
+        PandasTools.WriteSDF(
+            df,
+            str(sdf_path),
+            molColName="ROMol",
+            idName="ID",
+            properties=df.columns if properties is None else properties,
+        )
+        del df["ID"]
+
+    if mols:
+        write_part(df, path)
+
+
+class MergeWriter:
+    """Write merges incrementally, as batches of results complete.
+    Each batch is written (as SMILES) to a numbered part file. When the writer is closed,
+    the parts are parsed and written to SDF shards in parallel, and combined into the final table.
+
+    :param sdf: "single" to concatenate the shards into one SDF, "shards" to keep them, or "none"
+    :param sdf_properties: columns to write as SD properties, all by default
+    :param mols: store molecules (ROMol) in the table, as well as merge_smiles
+    """
+
+    def __init__(
+        self,
+        output_dir: str | Path,
+        name: str,
+        output_format: str | None = None,
+        sdf: str = "single",
+        sdf_properties: list[str] | None = None,
+        mols: bool = True,
+        parts: set[str] | None = None,
+    ):
+        output_dir = Path(output_dir)
+
+        if sdf not in SDF_OUTPUTS:
+            raise ValueError(f"Unknown SDF output: {sdf}, must be one of {SDF_OUTPUTS}")
+
+        self.table_path = table_path(output_dir, name, output_format)
+        self.sdf_path = output_dir / f"{name}.sdf"
+        self.shards_dir = output_dir / f"{name}.sdf.parts"
+        self.parts_dir = output_dir / f"{name}.parts"
+        self.extension = EXTENSIONS[table_format(self.table_path)]
+
+        self.sdf = sdf
+        self.sdf_properties = sdf_properties
+        self.mols = mols
+
+        self.num_rows = 0
+        self.num_parts = 0
+
+        if parts is None:
+            # start afresh
+            if self.parts_dir.exists():
+                shutil.rmtree(self.parts_dir)
+
+        elif self.parts_dir.exists():
+            self.resume(parts)
+
+        self.parts_dir.mkdir(parents=True, exist_ok=True)
+
+        mrich.writing(self.parts_dir)
+
+    def resume(self, parts: set[str]) -> None:
+        """Continue from the existing part files that are in parts (e.g. recorded in a ledger), removing any others"""
+
+        # unfinished writes (see write_part)
+        for path in self.parts_dir.glob(".tmp-*"):
+            path.unlink()
+
+        for path in sorted(self.parts_dir.glob(f"part-*{self.extension}")):
+
+            # e.g. written just before a crash, without being recorded
+            if path.name not in parts:
+                mrich.warning("Removing unrecorded part", path)
+                path.unlink()
+                continue
+
+            self.num_rows += len(read_part(path))
+            self.num_parts += 1
+
+        mrich.var("#resumed parts", self.num_parts)
+        mrich.var("#resumed merges", self.num_rows)
+
+    def write(self, df: "pd.DataFrame") -> str | None:
+        """Write a batch of merges (with merge_smiles), returns the name of the part file (or None if the batch is empty)"""
+
+        if df.empty:
+            return None
+
+        # IDs continue across batches
+        df = df.set_axis(range(self.num_rows, self.num_rows + len(df)))
+
+        path = self.parts_dir / f"part-{self.num_parts:06d}{self.extension}"
+        write_part(df, path)
+
+        self.num_rows += len(df)
+        self.num_parts += 1
+
+        return path.name
+
+    def close(self, keep_parts: bool = False) -> Path | None:
+        """Write the SDF and combine the parts into the final table, returns its path (or None if nothing was written).
+        With keep_parts the part files are kept, e.g. so that a run with outstanding work can be resumed.
+
+        Parquet parts (and SDF shards) are streamed into the final files one at a time,
+        but a pickle can only be written whole, so the final pickle table is built in memory."""
+
+        # the SDF of a previous run is only replaced here, so that a finished run that isn't closed keeps it
+        if self.shards_dir.exists():
+            shutil.rmtree(self.shards_dir)
+        self.sdf_path.unlink(missing_ok=True)
+
+        if not self.num_parts:
+            if not keep_parts:
+                shutil.rmtree(self.parts_dir)
+            return None
+
+        parts = sorted(self.parts_dir.glob(f"part-*{self.extension}"))
+
+        if self.sdf != "none" or self.mols:
+            self.write_shards(parts)
+
+        mrich.writing(self.table_path)
+
+        if self.extension == EXTENSIONS["pickle"]:
+            # a single pickle has to be built in memory
+            import pandas as pd
+
+            df = pd.concat([pd.read_pickle(part) for part in parts])
+            df.to_pickle(self.table_path)
+
+        else:
+            # parquet parts are streamed into the final file one at a time
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            # e.g. list<null> in parts where every list is empty
+            schema = pa.unify_schemas([pq.read_schema(part) for part in parts])
+
+            with pq.ParquetWriter(
+                self.table_path, schema, compression="zstd"
+            ) as writer:
+                for part in parts:
+                    table = pq.read_table(part, memory_map=True)
+                    writer.write_table(table.select(schema.names).cast(schema))
+
+        if not keep_parts:
+            shutil.rmtree(self.parts_dir)
+
+        return self.table_path
+
+    def write_shards(self, parts: list[Path]) -> None:
+        """Parse the parts in parallel, writing one SDF shard per part (concatenated unless sdf="shards")"""
+
+        from joblib import Parallel, delayed
+        from .metrics import METRICS
+
+        if self.sdf != "none":
+            self.shards_dir.mkdir(parents=True)
+            shards = [self.shards_dir / f"{part.name.split('.')[0]}.sdf" for part in parts]
+        else:
+            shards = [None for part in parts]
+
+        Parallel(n_jobs=CONFIG["KNITWORK_OUTPUT_NUM_PROCESSES"])(
+            delayed(METRICS.worker(write_merge_part))(part, shard, self.sdf_properties, self.mols)
+            for part, shard in zip(parts, shards)
+        )
+
+        if self.sdf == "single":
+            mrich.writing(self.sdf_path)
+            with open(self.sdf_path, "wb") as f:
+                for shard in shards:
+                    with open(shard, "rb") as f_shard:
+                        shutil.copyfileobj(f_shard, f)
+            shutil.rmtree(self.shards_dir)
+
+        elif self.sdf == "shards":
+            mrich.writing(self.shards_dir)
@@ -3,15 +3,63 @@ from mrich import print
 
 import time
 import asyncio
+import numpy as np
 import pandas as pd
 from json import loads
+from itertools import zip_longest
 from pathlib import Path
 from rich.progress import Progress
 from joblib import Parallel, delayed
-from rdkit.Chem import MolFromSmiles, PandasTools
 
 from .config import CONFIG, print_config
-from .query import get_pure_expansions, get_impure_expansions
+from .query import (
+    get_expansions_batch,
+    aget_expansions_batch,
+    aclose_driver,
+    precompute_synthon_vectors,
+    get_cached_expansions,
+    BatchError,
+)
+from .cache import open_cache
+from .metrics import METRICS, setup_metrics
+from .io import MergeWriter
+from .ledger import Ledger
+from .shard import shard_dir, shard_pairs
+
+ENGINES = ["joblib", "async"]
+
+
+class IncompleteMergeError(Exception):
+    """Substructure pairs failed (or were not attempted) in a merge run, which can be resumed"""
+
+
+# fields of each query result tuple
+RESULT_COLUMNS = {
+    "pure": ["catalogue_names", "merge_smiles"],
+    "impure": ["merge_smiles", "result_synthon", "similarity", "catalogue_names"],
+}
+
+# columns of the output merges dataframes
+MERGE_COLUMNS = {
+    "pure": [
+        "ID_A",
+        "ID_B",
+        "subnode_A",
+        "synthon_B",
+        "merge_smiles",
+        "catalogue_names",
+    ],
+    "impure": [
+        "ID_A",
+        "ID_B",
+        "subnode_A",
+        "synthon_B",
+        "merge_smiles",
+        "catalogue_names",
+        "similarity",
+        "result_synthon",
+    ],
+}
 
 
 def pure_merge(
@@ -19,180 +67,318 @@ def pure_merge(
     output_dir: str = "knitwork_output",
     cached_only: bool = False,
     limit: int = 5,
-) -> "pd.DataFrame":
-    """Generate 'pure' Knitwork merges'"""
+    batch_size: int = CONFIG["KNITWORK_BATCH_SIZE"],
+    engine: str = "joblib",
+    output_format: str | None = None,
+    sdf: str = "single",
+    sdf_properties: list[str] | None = None,
+    mols: bool = True,
+    resume: bool = False,
+    shard: tuple[int, int] | None = None,
+    profile: bool = False,
+) -> Path | None:
+    """Generate 'pure' Knitwork merges', returns the path of the merges table"""
 
     mrich.h2("knitwork.knit.pure_merge()")
     print_config("GRAPH_LOCATION")
     print_config("KNITWORK")
 
-    output_dir, cache_dir = create_dirs(output_dir)
-
-    substructure_pairs = get_unique_substructure_pairs(pairs_df)
-
-    # parallel merging
-    results = Parallel(
-        n_jobs=CONFIG["KNITWORK_NUM_CONNECTIONS"], backend="multiprocessing"
-    )(
-        delayed(get_pure_expansions)(
-            smiles,
-            synthon,
-            index=i,
-            cache_dir=cache_dir,
-            cached_only=cached_only,
-            limit=limit,
-        )
-        for i, (_, smiles, synthon) in enumerate(substructure_pairs)
+    return merge(
+        "pure",
+        pairs_df,
+        output_dir=output_dir,
+        cached_only=cached_only,
+        limit=limit,
+        batch_size=batch_size,
+        engine=engine,
+        output_format=output_format,
+        sdf=sdf,
+        sdf_properties=sdf_properties,
+        mols=mols,
+        resume=resume,
+        shard=shard,
+        profile=profile,
     )
 
-    if not results:
-        mrich.error("No results")
-        return None
-
-    # process results
-    data = []
-    for ((hit1, hit2), subnode, synthon), result in zip(substructure_pairs, results):
-
-        if result is None:
-            mrich.warning("Skipping", hit1, hit2, subnode, synthon)
-            continue
-
-        for names, merge in result:
-            data.append(
-                dict(
-                    ID_A=hit1,
-                    ID_B=hit2,
-                    subnode_A=subnode,
-                    synthon_B=synthon,
-                    merge_smiles=merge,
-                    catalogue_names=names,
-                )
-            )
-
-    mrich.var("#merges", len(data))
-
-    df = pd.DataFrame(data)
-    df.loc[:, "ROMol"] = df["merge_smiles"].apply(MolFromSmiles)
-
-    # write pickle
-    df_path = output_dir / "pure_merges.pkl.gz"
-    mrich.writing(df_path)
-    df.to_pickle(df_path)
-
-    df.loc[:, "ID"] = df.index
-
-    # write SDF
-    sdf_path = output_dir / "pure_merges.sdf"
-    mrich.writing(sdf_path)
-    PandasTools.WriteSDF(
-        df,
-        str(sdf_path),
-        molColName="ROMol",
-        idName="ID",
-        properties=df.columns,
-    )
-
-    return df
-
 
 def impure_merge(
     pairs_df: "pd.DataFrame",
     output_dir: str = "knitwork_output",
     cached_only: bool = False,
     limit: int = 5,
-) -> "pd.DataFrame":
-    """Generate 'impure' Knitwork merges'"""
+    batch_size: int = CONFIG["KNITWORK_BATCH_SIZE"],
+    engine: str = "joblib",
+    output_format: str | None = None,
+    sdf: str = "single",
+    sdf_properties: list[str] | None = None,
+    mols: bool = True,
+    resume: bool = False,
+    shard: tuple[int, int] | None = None,
+    profile: bool = False,
+) -> Path | None:
+    """Generate 'impure' Knitwork merges', returns the path of the merges table"""
 
     mrich.h2("knitwork.knit.impure_merge()")
     print_config("GRAPH_LOCATION")
     print_config("KNITWORK")
     print_config("FINGERPRINT")
 
-    output_dir, cache_dir = create_dirs(output_dir)
-
-    substructure_pairs = get_unique_substructure_pairs(pairs_df)
-
     # custom logger
     import logging, sys
 
     logging.basicConfig(stream=sys.stdout, level=logging.INFO, force=True)
 
-    # parallel merging
-    results = Parallel(
-        n_jobs=CONFIG["KNITWORK_NUM_CONNECTIONS"], backend="multiprocessing"
-    )(
-        delayed(get_impure_expansions)(
-            smiles,
-            synthon,
-            index=i,
-            cache_dir=cache_dir,
-            cached_only=cached_only,
-            limit=limit,
-        )
-        for i, (_, smiles, synthon) in enumerate(substructure_pairs)
+    return merge(
+        "impure",
+        pairs_df,
+        output_dir=output_dir,
+        cached_only=cached_only,
+        limit=limit,
+        batch_size=batch_size,
+        engine=engine,
+        output_format=output_format,
+        sdf=sdf,
+        sdf_properties=sdf_properties,
+        mols=mols,
+        resume=resume,
+        shard=shard,
+        profile=profile,
     )
 
-    if not results:
-        mrich.error("No results")
-        return None
 
-    # process results
-    data = []
-    for ((hit1, hit2), subnode, synthon), result in zip(substructure_pairs, results):
+def merge(
+    kind: str,
+    pairs_df: "pd.DataFrame",
+    output_dir: str = "knitwork_output",
+    cached_only: bool = False,
+    limit: int = 5,
+    batch_size: int = CONFIG["KNITWORK_BATCH_SIZE"],
+    engine: str = "joblib",
+    output_format: str | None = None,
+    sdf: str = "single",
+    sdf_properties: list[str] | None = None,
+    mols: bool = True,
+    resume: bool = False,
+    shard: tuple[int, int] | None = None,
+    profile: bool = False,
+) -> Path | None:
+    """Generate 'pure' or 'impure' merges, returns the path of the merges table (see merge_all)"""
+
+    return merge_all(
+        [kind],
+        pairs_df,
+        output_dir=output_dir,
+        cached_only=cached_only,
+        limit=limit,
+        batch_size=batch_size,
+        engine=engine,
+        output_format=output_format,
+        sdf=sdf,
+        sdf_properties=sdf_properties,
+        mols=mols,
+        resume=resume,
+        shard=shard,
+        profile=profile,
+    )[kind]
+
+
+def merge_all(
+    kinds: list[str],
+    pairs_df: "pd.DataFrame",
+    output_dir: str = "knitwork_output",
+    cache_dir: str | Path | None = None,
+    cached_only: bool = False,
+    limit: int = 5,
+    batch_size: int = CONFIG["KNITWORK_BATCH_SIZE"],
+    engine: str = "joblib",
+    output_format: str | None = None,
+    sdf: str = "single",
+    sdf_properties: list[str] | None = None,
+    mols: bool = True,
+    resume: bool = False,
+    shard: tuple[int, int] | None = None,
+    profile: bool = False,
+) -> dict[str, Path | None]:
+    """Generate merges of each kind ('pure' and/or 'impure') for the same unique substructure pairs,
+    with the batches of all kinds queried together. Returns the path of each kind's merges table.
+
+    Progress is recorded in a ledger for each kind, so that an interrupted run can be resumed.
+    Batches failing on transient or database errors are recorded as failed, and once the outputs have been
+    written IncompleteMergeError is raised if any pairs are left to retry. Any other error is raised immediately.
+    With shard=(i, N) only the i'th of N partitions of the substructure pairs is queried, into its own subdirectory
+    (see knitwork.shard.gather). Query and stage metrics are written to e.g. pure_metrics.json
+    (pure_impure_metrics.json for both kinds), and with profile each stage is profiled into e.g. pure_profile/"""
+
+    name = "_".join(kinds)
+
+    if shard is not None:
+        output_dir = shard_dir(output_dir, *shard)
+        mrich.var("shard", output_dir.name)
+
+    output_dir, cache_dir = create_dirs(output_dir, cache_dir)
+    cache = open_cache(cache_dir)
+
+    setup_metrics(output_dir / f"{name}_profile" if profile else None)
+
+    with METRICS.stage("substructure_pairs"):
+        pair_map, substructure_pairs = get_unique_substructure_pairs(pairs_df)
+
+    if shard is not None:
+        substructure_pairs = shard_pairs(substructure_pairs, *shard)
+        mrich.var("#shard substructure pairs", len(substructure_pairs))
+
+    pair_rows = pair_map.groupby(["subnode_A", "synthon_B"], sort=False).indices
+
+    max_attempts = CONFIG["KNITWORK_MAX_ATTEMPTS"]
+
+    paths = {}
+    runs = {}
+    for kind in kinds:
+
+        # work ledger
+        ledger_path = output_dir / f"{kind}_ledger.sqlite"
+        if not resume:
+            for path in [ledger_path, *ledger_path.parent.glob(f"{ledger_path.name}-*")]:
+                path.unlink(missing_ok=True)
+
+        ledger = Ledger(ledger_path)
+        mrich.var("ledger", ledger)
+
+        ledger.check_params(
+            kind=kind,
+            limit=limit,
+            output_format=output_format or CONFIG["KNITWORK_OUTPUT_FORMAT"],
+            pairs=pairs_digest(pair_map),
+        )
+        ledger.add(substructure_pairs)
+
+        outstanding = ledger.outstanding(max_attempts)
+        mrich.var(f"#outstanding {kind} pairs", len(outstanding))
+
+        # merges are written as each batch completes
+        writer = MergeWriter(
+            output_dir,
+            f"{kind}_merges",
+            output_format,
+            sdf=sdf,
+            sdf_properties=sdf_properties,
+            mols=mols,
+            parts=ledger.parts() if resume else None,
+        )
 
-        if result is None:
-            mrich.warning("Skipping", hit1, hit2, subnode, synthon)
+        # nothing left to do in a finished run
+        if (
+            resume
+            and not outstanding
+            and not writer.num_parts
+            and writer.table_path.exists()
+        ):
+            mrich.success("Run already complete", writer.table_path)
+            writer.parts_dir.rmdir()
+            ledger.close()
+            paths[kind] = writer.table_path
             continue
 
-        for expansion, result_synthon, similarity, ids in result:
-            data.append(
-                dict(
-                    ID_A=hit1,
-                    ID_B=hit2,
-                    subnode_A=subnode,
-                    synthon_B=synthon,
-                    merge_smiles=expansion,
-                    catalogue_names=ids,
-                    similarity=similarity,
-                    result_synthon=result_synthon,
-                )
+        write_batch, fail_batch = batch_callbacks(
+            kind, writer, ledger, pair_map, pair_rows
+        )
+
+        runs[kind] = dict(
+            ledger=ledger,
+            writer=writer,
+            pairs=outstanding,
+            callback=write_batch,
+            on_error=fail_batch,
+        )
+
+    # parallel merging
+    with METRICS.stage("expansions"):
+        if runs:
+            run_expansions(
+                runs,
+                cache=cache,
+                cached_only=cached_only,
+                limit=limit,
+                batch_size=batch_size,
+                engine=engine,
             )
 
-    mrich.var("#merges", len(data))
+    incomplete = {}
+    for kind, run in runs.items():
 
-    df = pd.DataFrame(data)
-    df.loc[:, "ROMol"] = df["merge_smiles"].apply(MolFromSmiles)
+        ledger, writer = run["ledger"], run["writer"]
 
-    # write pickle
-    df_path = output_dir / "impure_merges.pkl.gz"
-    mrich.writing(df_path)
-    df.to_pickle(df_path)
+        mrich.var(f"#{kind} merges", writer.num_rows)
 
-    df.loc[:, "ID"] = df.index
+        counts = ledger.counts()
+        mrich.var(f"#done {kind} pairs", counts["done"])
+        mrich.var(f"#failed {kind} pairs", counts["failed"])
 
-    # write SDF
-    sdf_path = output_dir / "impure_merges.sdf"
-    mrich.writing(sdf_path)
-    PandasTools.WriteSDF(
-        df,
-        str(sdf_path),
-        molColName="ROMol",
-        idName="ID",
-        properties=df.columns,
-    )
+        # keep the parts of an unfinished run, so that it can be resumed
+        retry = ledger.outstanding(max_attempts)
+        if retry and cached_only:
+            mrich.warning(
+                f"{len(retry)} {kind} substructure pairs aren't cached, rerun with --resume (without --cached-only) to query them"
+            )
+        elif retry:
+            mrich.warning(
+                f"{len(retry)} {kind} substructure pairs failed, rerun with --resume to retry them"
+            )
+            incomplete[kind] = len(retry)
+
+        ledger.close()
+
+        with METRICS.stage(f"{kind}_write_outputs"):
+            paths[kind] = writer.close(keep_parts=bool(retry))
+
+        if paths[kind] is None:
+            mrich.error(f"No {kind} results")
+
+    METRICS.write(output_dir / f"{name}_metrics.json")
+
+    if incomplete:
+        raise IncompleteMergeError(
+            f"Unfinished substructure pairs {incomplete}, rerun with --resume to retry them"
+        )
+
+    return paths
+
+
+def batch_callbacks(
+    kind: str,
+    writer: MergeWriter,
+    ledger: Ledger,
+    pair_map: "pd.DataFrame",
+    pair_rows: dict,
+) -> tuple:
+    """Callbacks writing a completed batch of a kind's results (and recording it in the ledger), or recording its failure"""
+
+    def write_batch(pairs, results):
+        with METRICS.stage(f"{kind}_write_parts"):
+            part = writer.write(
+                fan_out_results(kind, pair_map, pairs, results, pair_rows)
+            )
+            ledger.mark_done(pairs, part)
 
-    return df
+    def fail_batch(pairs, error):
+        mrich.error(error)
+        ledger.mark_failed(pairs, error)
 
+    return write_batch, fail_batch
 
-def create_dirs(output_dir: str | Path) -> (Path, Path):
-    """Create output and cache directories"""
+
+def create_dirs(
+    output_dir: str | Path,
+    cache_dir: str | Path | None = None,
+) -> (Path, Path):
+    """Create output and cache directories (output_dir/cache by default)"""
 
     output_dir = Path(output_dir)
     if not output_dir.exists():
         mrich.writing(output_dir)
         output_dir.mkdir(parents=True)
 
-    cache_dir = output_dir / "cache"
+    cache_dir = Path(cache_dir or output_dir / "cache")
     mrich.var("cache_dir", cache_dir)
     if not cache_dir.exists():
         mrich.writing(cache_dir)
@@ -201,16 +387,271 @@ def create_dirs(output_dir: str | Path) -> (Path, Path):
     return output_dir, cache_dir
 
 
-def get_unique_substructure_pairs(df):
+def run_expansions(
+    runs: dict[str, dict],
+    cache,
+    cached_only: bool,
+    limit: int,
+    batch_size: int,
+    engine: str = "joblib",
+    num_hops: int = 2,
+) -> None:
+    """Query 'pure' and/or 'impure' expansions for substructure pairs in batches.
+    runs maps each kind to a dict of its substructure 'pairs', a 'callback' and optionally an 'on_error' handler.
+    callback(pairs, results) is called with the cached results, and then with each batch as it completes.
+    If on_error is given, batches failing with a BatchError are passed to on_error(pairs, error) rather than raising.
+    The batches of all kinds are interleaved, so that they are queried together.
+
+    - joblib: spread over KNITWORK_NUM_CONNECTIONS worker processes
+    - async: single process, up to KNITWORK_MAX_IN_FLIGHT concurrent queries
+    """
+
+    mrich.var("engine", engine)
+
+    kind_batches = []
+    for kind, run in runs.items():
+
+        # bulk cache lookup, so that only uncached pairs are dispatched
+        with METRICS.stage("cache_lookup"):
+            cached, pairs = get_cached_expansions(
+                kind, run["pairs"], num_hops, limit, cache, cached_only
+            )
+
+        # with cached_only uncached pairs are None, and left pending in the ledger
+        uncached = [pair for pair, result in cached.items() if result is None]
+        cached = {pair: result for pair, result in cached.items() if result is not None}
+
+        mrich.var(f"#cached {kind} pairs", len(cached))
+        if uncached:
+            mrich.var(f"#skipped uncached {kind} pairs", len(uncached))
+        METRICS.record_cache(
+            f"{kind}_expansions", hits=len(cached), misses=len(pairs) + len(uncached)
+        )
+
+        if cached:
+            run["callback"](list(cached.keys()), list(cached.values()))
+
+        batches = [pairs[i : i + batch_size] for i in range(0, len(pairs), batch_size)]
+        mrich.var(f"#{kind} batches", len(batches))
+
+        # fingerprint every synthon once, rather than in each worker
+        if kind == "impure":
+            with METRICS.stage("fingerprints"):
+                synthon_vectors = precompute_synthon_vectors(
+                    synthon for _, synthon in pairs
+                )
+            mrich.var("#synthon fingerprints", len(synthon_vectors))
+            batch_vectors = [
+                {synthon: synthon_vectors[synthon] for _, synthon in batch}
+                for batch in batches
+            ]
+        else:
+            batch_vectors = [None for batch in batches]
+
+        kind_batches.append(
+            [(kind, batch, vectors) for batch, vectors in zip(batches, batch_vectors)]
+        )
+
+    # alternate between kinds
+    batches = [
+        batch
+        for batches in zip_longest(*kind_batches)
+        for batch in batches
+        if batch is not None
+    ]
+
+    def handle_batch(kind, batch, results, error):
+        run = runs[kind]
+        if error is None:
+            run["callback"](batch, results)
+        elif run.get("on_error") is None:
+            raise BatchError(error)
+        else:
+            run["on_error"](batch, error)
+
+    if engine == "joblib":
+        n_jobs = CONFIG["KNITWORK_NUM_CONNECTIONS"]
+
+        # the multiprocessing backend (forked workers inherit CONFIG) can't return results as they complete,
+        # so batches are dispatched in rounds over a persistent pool and written after each round
+        round_size = 4 * n_jobs
+
+        with Parallel(n_jobs=n_jobs, backend="multiprocessing") as parallel:
+            for start in range(0, len(batches), round_size):
+                stop = start + round_size
+
+                round_results = parallel(
+                    delayed(METRICS.worker(try_expansions_batch))(
+                        kind,
+                        batch,
+                        index=i,
+                        cache=cache,
+                        num_hops=num_hops,
+                        limit=limit,
+                        vectors=vectors,
+                    )
+                    for i, (kind, batch, vectors) in enumerate(
+                        batches[start:stop], start
+                    )
+                )
+
+                for (kind, batch, _), (results, error, metrics) in zip(
+                    batches[start:stop], round_results
+                ):
+                    METRICS.merge(metrics)
+                    handle_batch(kind, batch, results, error)
+
+    elif engine == "async":
+        with Progress() as progress:
+            task = progress.add_task(
+                f"query {' and '.join(runs)} expansions", total=len(batches)
+            )
+            asyncio.run(
+                aexpansion_tasks(
+                    batches,
+                    handle_batch,
+                    raise_errors=[
+                        kind for kind, run in runs.items() if run.get("on_error") is None
+                    ],
+                    cache=cache,
+                    num_hops=num_hops,
+                    limit=limit,
+                    progress=progress,
+                    task=task,
+                )
+            )
 
-    # get unique substructure pairs
+    else:
+        raise ValueError(f"Unknown engine: {engine}, must be one of {ENGINES}")
+
+
+async def aexpansion_tasks(
+    batches: list[tuple[str, list[tuple[str, str]], dict | None]],
+    handle_batch,
+    cache,
+    num_hops: int,
+    limit: int,
+    progress=None,
+    task=None,
+    raise_errors: list[str] | None = None,
+) -> None:
+    """Query all (kind, batch, vectors) batches concurrently over the shared async driver,
+    calling handle_batch(kind, pairs, results, error) as each completes.
+    Errors in batches of the kinds in raise_errors are raised immediately."""
+
+    async def run_batch(i, kind, batch, vectors):
+        try:
+            results = await aget_expansions_batch(
+                kind,
+                batch,
+                index=i,
+                cache=cache,
+                num_hops=num_hops,
+                limit=limit,
+                vectors=vectors,
+                progress=progress,
+                task=task,
+            )
+        except BatchError as e:
+            if kind in (raise_errors or []):
+                raise
+            return kind, batch, None, str(e)
+        return kind, batch, results, None
+
+    coros = [
+        run_batch(i, kind, batch, vectors)
+        for i, (kind, batch, vectors) in enumerate(batches)
+    ]
+
+    try:
+        for coro in asyncio.as_completed(coros):
+            handle_batch(*(await coro))
+    finally:
+        await aclose_driver()
+
+
+def try_expansions_batch(kind: str, batch: list[tuple[str, str]], **kwargs) -> tuple:
+    """Query a batch of expansions in a worker, returns (results, None, metrics) or (None, error message, metrics)
+    if it failed with a BatchError. Other errors are raised."""
+
+    # forked workers start with a copy of the parent's metrics
+    METRICS.reset()
+
+    try:
+        results, error = get_expansions_batch(kind, batch, **kwargs), None
+    except BatchError as e:
+        results, error = None, str(e)
+
+    return results, error, METRICS.drain()
+
+
+def get_unique_substructure_pairs(
+    df: "pd.DataFrame",
+) -> tuple["pd.DataFrame", list[tuple[str, str]]]:
+    """Get the distinct (subnode_A, synthon_B) pairs over all hit pairs, so that each is only queried once.
+
+    :param df: pairs dataframe indexed by (ID_A, ID_B) with subnodes_A and synthons_B columns
+    :return: dataframe mapping (ID_A, ID_B) to each (subnode_A, synthon_B) and a list of the unique (subnode_A, synthon_B) pairs
+    """
+
+    pair_map = (
+        df[["subnodes_A", "synthons_B"]]
+        .reset_index()
+        .explode("subnodes_A")
+        .explode("synthons_B")
+        .dropna(subset=["subnodes_A", "synthons_B"])
+        .rename(columns={"subnodes_A": "subnode_A", "synthons_B": "synthon_B"})
+        .drop_duplicates()
+        .reset_index(drop=True)
+    )
 
-    substructure_pairs = set()
-    for i, row in df.iterrows():
-        for subnode_A in row["subnodes_A"]:
-            for synthon_B in row["synthons_B"]:
-                substructure_pairs.add((i, subnode_A, synthon_B))
+    substructure_pairs = list(
+        pair_map[["subnode_A", "synthon_B"]]
+        .drop_duplicates()
+        .itertuples(index=False, name=None)
+    )
 
+    mrich.var("#substructure pairs", len(pair_map))
     mrich.var("#unique substructure pairs", len(substructure_pairs))
 
-    return substructure_pairs
+    return pair_map, substructure_pairs
+
+
+def pairs_digest(pair_map: "pd.DataFrame") -> str:
+    """Digest of the (ID_A, ID_B, subnode_A, synthon_B) rows of a pair map (in any order),
+    so that a run can't be resumed with different fragment pairs"""
+
+    import hashlib
+
+    rows = sorted(map(repr, pair_map.itertuples(index=False, name=None)))
+    return hashlib.sha256("\n".join(rows).encode()).hexdigest()
+
+
+def fan_out_results(
+    kind: str,
+    pair_map: "pd.DataFrame",
+    substructure_pairs: list[tuple[str, str]],
+    results: list,
+    pair_rows: dict | None = None,
+) -> "pd.DataFrame":
+    """Map query results for each unique (subnode_A, synthon_B) back to every (ID_A, ID_B) hit pair that needs them.
+    pair_rows (positions of each (subnode_A, synthon_B) in pair_map) avoids searching the whole pair_map for each batch."""
+
+    if pair_rows is not None:
+        rows = [pair_rows[pair] for pair in substructure_pairs]
+        pair_map = pair_map.iloc[np.concatenate(rows) if rows else []]
+
+    data = []
+    for (subnode, synthon), result in zip(substructure_pairs, results):
+
+        if result is None:
+            mrich.warning("Skipping", subnode, synthon)
+            continue
+
+        for row in result:
+            data.append((subnode, synthon, *row))
+
+    df = pd.DataFrame(data, columns=["subnode_A", "synthon_B"] + RESULT_COLUMNS[kind])
+    df = pair_map.merge(df, on=["subnode_A", "synthon_B"])
+
+    return df[MERGE_COLUMNS[kind]]
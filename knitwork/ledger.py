@@ -0,0 +1,119 @@
+import json
+import sqlite3
+from pathlib import Path
+
+STATUSES = ["pending", "done", "failed"]
+
+
+class Ledger:
+    """Record of the work in a knitting run, so that an interrupted run can be resumed.
+    Each unique (subnode, synthon) pair is 'pending', 'done' (written to a part file) or 'failed'."""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.connection = sqlite3.connect(self.path, timeout=120)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS params (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS pairs (
+                subnode TEXT,
+                synthon TEXT,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                part TEXT,
+                error TEXT,
+                PRIMARY KEY (subnode, synthon)
+            )"""
+        )
+        self.connection.commit()
+
+    def __repr__(self) -> str:
+        return f"Ledger({str(self.path)!r})"
+
+    def check_params(self, **params) -> None:
+        """Store the parameters of a run, or check that they match those of the run being resumed"""
+
+        stored = dict(self.connection.execute("SELECT key, value FROM params"))
+
+        if stored:
+            params = {key: json.dumps(value) for key, value in params.items()}
+            if stored != params:
+                raise ValueError(
+                    f"Can't resume {self.path}, parameters have changed: {stored} != {params}"
+                )
+
+        else:
+            with self.connection as connection:
+                connection.executemany(
+                    "INSERT INTO params (key, value) VALUES (?, ?)",
+                    [(key, json.dumps(value)) for key, value in params.items()],
+                )
+
+    def add(self, pairs: list[tuple[str, str]]) -> None:
+        """Add pairs as pending, leaving those already in the ledger untouched"""
+
+        with self.connection as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO pairs (subnode, synthon) VALUES (?, ?)",
+                pairs,
+            )
+
+    def outstanding(self, max_attempts: int) -> list[tuple[str, str]]:
+        """Pairs that are pending, or failed fewer than max_attempts times"""
+
+        return self.connection.execute(
+            "SELECT subnode, synthon FROM pairs WHERE status = 'pending' OR (status = 'failed' AND attempts < ?)",
+            (max_attempts,),
+        ).fetchall()
+
+    def parts(self) -> set[str]:
+        """Names of the part files holding completed pairs"""
+
+        rows = self.connection.execute(
+            "SELECT DISTINCT part FROM pairs WHERE status = 'done' AND part IS NOT NULL"
+        )
+        return {part for part, in rows}
+
+    def counts(self) -> dict[str, int]:
+        """Number of pairs with each status"""
+
+        counts = dict.fromkeys(STATUSES, 0)
+        counts.update(
+            self.connection.execute(
+                "SELECT status, COUNT(*) FROM pairs GROUP BY status"
+            )
+        )
+        return counts
+
+    def mark_done(
+        self,
+        pairs: list[tuple[str, str]],
+        part: str | None = None,
+    ) -> None:
+        """Mark pairs as done, with the part file their merges were written to (if any)"""
+
+        with self.connection as connection:
+            connection.executemany(
+                "UPDATE pairs SET status = 'done', part = ?, error = NULL WHERE subnode = ? AND synthon = ?",
+                [(part, subnode, synthon) for subnode, synthon in pairs],
+            )
+
+    def mark_failed(
+        self,
+        pairs: list[tuple[str, str]],
+        error: str,
+    ) -> None:
+        """Mark pairs as failed"""
+
+        with self.connection as connection:
+            connection.executemany(
+                "UPDATE pairs SET status = 'failed', attempts = attempts + 1, error = ? WHERE subnode = ? AND synthon = ?",
+                [(error, subnode, synthon) for subnode, synthon in pairs],
+            )
+
+    def close(self) -> None:
+        self.connection.close()
@@ -0,0 +1,371 @@
+import mrich
+
+import json
+import numpy as np
+from pathlib import Path
+
+from .config import CONFIG
+from .tools import parse_pharmfp, fingerprint_matrix, score_candidates
+
+GRAPH_BACKENDS = ["neo4j", "local"]
+
+# loaded on first use, shared with forked workers
+LOCAL_GRAPH = None
+
+
+def get_local_graph() -> "LocalGraph | None":
+    """The in-memory graph loaded from GRAPH_LOCAL_PATH, or None if GRAPH_BACKEND is 'neo4j'"""
+
+    global LOCAL_GRAPH
+
+    backend = CONFIG["GRAPH_BACKEND"]
+
+    if backend == "neo4j":
+        return None
+
+    elif backend != "local":
+        raise ValueError(
+            f"Unknown graph backend: {backend}, must be one of {GRAPH_BACKENDS}"
+        )
+
+    if LOCAL_GRAPH is None:
+        if "GRAPH_LOCAL_PATH" not in CONFIG:
+            raise ValueError("Configuration missing: ['GRAPH_LOCAL_PATH']")
+        LOCAL_GRAPH = LocalGraph.load(CONFIG["GRAPH_LOCAL_PATH"])
+
+    return LOCAL_GRAPH
+
+
+def concat_ranges(starts: np.ndarray, stops: np.ndarray) -> np.ndarray:
+    """Concatenation of np.arange(start, stop) for each start, stop"""
+
+    lengths = stops - starts
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.arange(lengths.sum()) - offsets + np.repeat(starts, lengths)
+
+
+class LocalGraph:
+    """In-memory fragment network, with F2/Mol nodes and FRAG edges in CSR adjacency arrays.
+    Answers the same queries as the Cypher templates in knitwork.query, returning records of the same shape.
+
+    Loaded from a JSON extract:
+
+    {
+        "nodes": [{"smiles": "...", "labels": ["F2", "Mol"], "cmpd_ids": [...]}, ...],
+        "edges": [{"start": 0, "end": 1, "prop_synthon": "...", "prop_core": "...", "prop_pharmfp": [0, 1, ...]}, ...],
+    }
+
+    where start and end are indices into nodes, and FRAG edges point from a node to its fragments.
+    Unlike Cypher (which returns a row per path) each node or edge is returned once.
+    """
+
+    def __init__(
+        self,
+        nodes: list[dict],
+        edges: list[dict],
+    ):
+        num_nodes = len(nodes)
+
+        # nodes
+        self.smiles = [node["smiles"] for node in nodes]
+        self.cmpd_ids = [node.get("cmpd_ids") for node in nodes]
+        self.is_f2 = np.array(["F2" in node.get("labels", ["F2"]) for node in nodes])
+        self.is_mol = np.array(["Mol" in node.get("labels", []) for node in nodes])
+        self.index = {
+            smiles: i for i, smiles in enumerate(self.smiles) if self.is_f2[i]
+        }
+
+        # edges
+        self.start = np.array([edge["start"] for edge in edges], dtype=np.int64)
+        self.end = np.array([edge["end"] for edge in edges], dtype=np.int64)
+        self.synthon = [edge.get("prop_synthon") for edge in edges]
+        self.core = [edge.get("prop_core") for edge in edges]
+
+        # pharmacophore fingerprints, zero-padded to the same length
+        pharmfps = [parse_pharmfp(edge.get("prop_pharmfp")) for edge in edges]
+        self.has_pharmfp = np.array([fp is not None for fp in pharmfps], dtype=bool)
+        self.pharmfp = fingerprint_matrix(pharmfps)
+
+        # CSR adjacency: edges out of / into each node
+        self.out_edges = np.argsort(self.start, kind="stable")
+        self.out_ptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.start, minlength=num_nodes), out=self.out_ptr[1:])
+
+        self.in_edges = np.argsort(self.end, kind="stable")
+        self.in_ptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.end, minlength=num_nodes), out=self.in_ptr[1:])
+
+        # NOT ()-[:FRAG]-(f)-[:FRAG]->(), i.e. no outgoing edge plus another edge
+        out_degree = np.diff(self.out_ptr)
+        degree = out_degree + np.diff(self.in_ptr)
+        self.terminal = ~((out_degree >= 1) & (degree >= 2))
+
+    def __repr__(self) -> str:
+        return f"LocalGraph(#nodes={len(self.smiles)}, #edges={len(self.start)})"
+
+    @classmethod
+    def load(cls, path: str | Path) -> "LocalGraph":
+        """Load a JSON graph extract"""
+
+        mrich.reading(path)
+        with open(path, "rt") as f:
+            data = json.load(f)
+
+        graph = cls(data["nodes"], data["edges"])
+        mrich.var("local graph", graph)
+
+        return graph
+
+    def dump(self, path: str | Path) -> None:
+        """Write the graph as a JSON extract"""
+
+        labels = [
+            ["F2"] * bool(is_f2) + ["Mol"] * bool(is_mol)
+            for is_f2, is_mol in zip(self.is_f2, self.is_mol)
+        ]
+
+        data = dict(
+            nodes=[
+                dict(smiles=smiles, labels=node_labels, cmpd_ids=cmpd_ids)
+                for smiles, node_labels, cmpd_ids in zip(
+                    self.smiles, labels, self.cmpd_ids
+                )
+            ],
+            edges=[
+                dict(
+                    start=int(self.start[i]),
+                    end=int(self.end[i]),
+                    prop_synthon=self.synthon[i],
+                    prop_core=self.core[i],
+                    prop_pharmfp=(
+                        self.pharmfp[i].tolist() if self.has_pharmfp[i] else None
+                    ),
+                )
+                for i in range(len(self.start))
+            ],
+        )
+
+        mrich.writing(path)
+        with open(path, "wt") as f:
+            json.dump(data, f)
+
+    def depths(
+        self,
+        node: int,
+        max_depth: int,
+        reverse: bool = False,
+    ) -> np.ndarray:
+        """Fewest FRAG hops from node to every node (-1 if not reachable within max_depth).
+        With reverse, edges are followed backwards (towards parents)."""
+
+        if reverse:
+            ptr, edges, neighbours = self.in_ptr, self.in_edges, self.start
+        else:
+            ptr, edges, neighbours = self.out_ptr, self.out_edges, self.end
+
+        depths = np.full(len(self.smiles), -1, dtype=np.int64)
+        depths[node] = 0
+
+        frontier = np.array([node])
+        for depth in range(1, max_depth + 1):
+            frontier = np.unique(
+                neighbours[edges[concat_ranges(ptr[frontier], ptr[frontier + 1])]]
+            )
+            frontier = frontier[depths[frontier] < 0]
+            if not len(frontier):
+                break
+            depths[frontier] = depth
+
+        return depths
+
+    def in_edges_of(self, nodes: np.ndarray) -> np.ndarray:
+        """All edges into the given nodes"""
+        return self.in_edges[concat_ranges(self.in_ptr[nodes], self.in_ptr[nodes + 1])]
+
+    def subnodes(
+        self,
+        smiles: str,
+        terminal_nodes: bool,
+    ) -> list[dict]:
+        """Records for knitwork.query.SUBNODES_QUERY (or TERMINAL_SUBNODES_QUERY)"""
+
+        if (node := self.index.get(smiles)) is None:
+            return []
+
+        depths = self.depths(node, 20)
+        mask = (depths >= 0) & self.is_f2
+        if terminal_nodes:
+            mask &= self.terminal
+
+        return [{"f": {"smiles": self.smiles[i]}} for i in np.flatnonzero(mask)]
+
+    def synthons(
+        self,
+        smiles: str,
+        terminal_nodes: bool,
+    ) -> list[dict]:
+        """Records for knitwork.query.SYNTHONS_QUERY (or TERMINAL_SYNTHONS_QUERY)"""
+
+        if (node := self.index.get(smiles)) is None:
+            return []
+
+        edges = self.last_edges(node, 15, terminal_nodes)
+
+        return [
+            {"edge": {"prop_synthon": self.synthon[e], "prop_core": self.core[e]}}
+            for e in edges
+        ]
+
+    def r_groups(self, smiles: str) -> list[dict]:
+        """Records for knitwork.query.R_GROUPS_QUERY"""
+
+        if (node := self.index.get(smiles)) is None:
+            return []
+
+        depths = self.depths(node, 15)
+
+        records = []
+        for e in self.last_edges(node, 15, True, depths):
+
+            synthon = self.synthon[e]
+            if not synthon or "[Xe]" not in synthon:
+                continue
+
+            # parent edges of paths up to 15 long
+            for f in self.in_edges_of(self.start[[e]]):
+                if 0 <= depths[self.start[f]] <= 13:
+                    r_group = self.synthon[f]
+                    if r_group is not None and r_group != synthon:
+                        records.append({"synthon": synthon, "r_group": r_group})
+
+        return records
+
+    def last_edges(
+        self,
+        node: int,
+        max_length: int,
+        terminal_nodes: bool,
+        depths: np.ndarray | None = None,
+    ) -> np.ndarray:
+        """Last edges of all paths from node up to max_length long, to (terminal) F2 nodes"""
+
+        if depths is None:
+            depths = self.depths(node, max_length)
+
+        mask = (depths >= 0) & self.is_f2
+        if terminal_nodes:
+            mask &= self.terminal
+
+        edges = self.in_edges_of(np.flatnonzero(mask))
+        starts = depths[self.start[edges]]
+
+        return edges[(starts >= 0) & (starts <= max_length - 1)]
+
+    def fragments(self, smiles: str) -> list[dict]:
+        """Records for knitwork.query.FRAGMENTS_QUERY"""
+
+        if (node := self.index.get(smiles)) is None:
+            return []
+
+        depths = self.depths(node, 20)
+
+        records = []
+        for b in np.flatnonzero((depths >= 0) & self.is_f2):
+
+            paths = []
+
+            if b == node:
+                paths.append([None, None, None, 0])
+
+            for e in self.in_edges_of(np.array([b])):
+
+                u = self.start[e]
+                if not 0 <= depths[u] <= 19:
+                    continue
+
+                edge = [self.synthon[e], self.core[e]]
+
+                if u == node:
+                    paths.append(edge + [None, 1])
+                    continue
+
+                for f in self.in_edges_of(np.array([u])):
+                    w = self.start[f]
+                    if 0 <= depths[w] <= 18:
+                        paths.append(edge + [self.synthon[f], depths[w] + 2])
+
+            records.append(
+                {
+                    "subnode": self.smiles[b],
+                    "terminal": bool(self.terminal[b]),
+                    "paths": paths,
+                }
+            )
+
+        return records
+
+    def expansions(
+        self,
+        kind: str,
+        pairs: list[dict],
+        num_hops: int,
+        limit: int | None,
+        threshold: float | None = None,
+        metric: str | None = None,
+        **kwargs,
+    ) -> list[dict]:
+        """Records for knitwork.query.PURE_EXPANSIONS_QUERY or IMPURE_EXPANSIONS_QUERY, for the same parameters"""
+
+        if kind == "pure":
+
+            records = []
+            for p in pairs:
+                edges = [
+                    e
+                    for e in self.expansion_edges(p["smiles"], num_hops)
+                    if self.synthon[e] == p["synthon"]
+                ]
+                for e in edges[: limit or None]:
+                    c = self.start[e]
+                    records.append(
+                        {"index": p["index"], "smi": self.smiles[c], "ids": self.cmpd_ids[c]}
+                    )
+
+            return records
+
+        elif kind == "impure":
+
+            # candidates with fingerprints, once for each subnode
+            candidates = {}
+            for smiles in {p["smiles"] for p in pairs}:
+                edges = self.expansion_edges(smiles, num_hops)
+                edges = edges[self.has_pharmfp[edges]]
+                starts = self.start[edges]
+                candidates[smiles] = dict(
+                    smi=[self.smiles[c] for c in starts],
+                    ids=[self.cmpd_ids[c] for c in starts],
+                    syn=np.array([self.synthon[e] for e in edges], dtype=object),
+                    fps=self.pharmfp[edges],
+                )
+
+            return score_candidates(
+                pairs, candidates, threshold, metric or "tanimoto", limit
+            )
+
+        else:
+            raise ValueError(f"Unknown expansion kind: {kind}")
+
+    def expansion_edges(
+        self,
+        smiles: str,
+        num_hops: int,
+    ) -> np.ndarray:
+        """Edges e in (a:F2 {smiles: $smiles})<-[:FRAG*0..num_hops]-(b:F2)<-[e:FRAG]-(c:Mol)"""
+
+        if (node := self.index.get(smiles)) is None:
+            return np.array([], dtype=np.int64)
+
+        depths = self.depths(node, num_hops, reverse=True)
+        edges = self.in_edges_of(np.flatnonzero((depths >= 0) & self.is_f2))
+
+        return edges[self.is_mol[self.start[edges]]]
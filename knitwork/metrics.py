@@ -0,0 +1,334 @@
+import mrich
+
+import os
+import sys
+import json
+import time
+import threading
+from pathlib import Path
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+PERCENTILES = [50, 90, 95, 99]
+
+# name of the query being run, so that retries deep in knitwork.query.run_query are attributed to it
+QUERY_NAME = ContextVar("QUERY_NAME", default="query")
+
+# record of the query being run, so that knitwork.query.arun_query can record the time it waited for a slot
+QUERY_RECORD = ContextVar("QUERY_RECORD", default=None)
+
+# subdirectory of the profile directory where worker processes append their stacks (see Metrics.worker)
+WORKER_PROFILES = ".workers"
+
+
+class Metrics:
+    """Timings and counters for a run: per-query wall time, rows, failures and retries,
+    cache hits and misses, and per-stage wall time. The wall time of an async query excludes the time
+    it waited for one of KNITWORK_MAX_IN_FLIGHT slots, which is recorded separately as its queue time.
+
+    Each process records into its own instance (METRICS). Worker processes send theirs back
+    with each batch (see drain) to be merged into the parent's.
+
+    With profile_dir set, each (outermost) stage is CPU profiled (see StackSampler), including the worker processes
+    of functions wrapped with worker, written as collapsed stacks (e.g. for flamegraph.pl or speedscope)
+    to {profile_dir}/{stage}.folded. Worker stacks are under a 'worker' root.
+    """
+
+    def __init__(self):
+        self.profile_dir = None
+        self.profiling = False
+        self.reset()
+
+    def __repr__(self) -> str:
+        return f"Metrics(#queries={sum(len(q['seconds']) for q in self.queries.values())}, #stages={len(self.stages)})"
+
+    def reset(self) -> None:
+        self.queries = {}
+        self.cache = {}
+        self.stages = {}
+
+    def record_query(
+        self,
+        name: str,
+        seconds: float,
+        rows: int = 0,
+        failed: bool = False,
+        queued: float = 0.0,
+    ) -> None:
+        query = self._query(name)
+        query["seconds"].append(seconds)
+        query["queued_seconds"].append(queued)
+        query["rows"] += rows
+        query["failures"] += failed
+
+    def record_retry(self, name: str) -> None:
+        self._query(name)["retries"] += 1
+
+    def record_queued(self, seconds: float) -> None:
+        """Record time the current query (see query) spent waiting to be run, excluded from its wall time"""
+
+        record = QUERY_RECORD.get()
+        if record is not None:
+            record["queued"] += seconds
+
+    def record_cache(
+        self,
+        name: str,
+        hits: int,
+        misses: int,
+    ) -> None:
+        cache = self.cache.setdefault(name, dict(hits=0, misses=0))
+        cache["hits"] += hits
+        cache["misses"] += misses
+
+    def _query(self, name: str) -> dict:
+        return self.queries.setdefault(
+            name, dict(seconds=[], queued_seconds=[], rows=0, failures=0, retries=0)
+        )
+
+    @contextmanager
+    def query(self, name: str):
+        """Time a query, yielding a dict in which to set the number of 'rows' returned"""
+
+        record = dict(rows=0, queued=0.0)
+        tokens = QUERY_NAME.set(name), QUERY_RECORD.set(record)
+        start = time.perf_counter()
+
+        def seconds():
+            return time.perf_counter() - start - record["queued"]
+
+        try:
+            yield record
+        except BaseException:
+            self.record_query(name, seconds(), failed=True, queued=record["queued"])
+            raise
+        else:
+            self.record_query(name, seconds(), record["rows"], queued=record["queued"])
+        finally:
+            QUERY_NAME.reset(tokens[0])
+            QUERY_RECORD.reset(tokens[1])
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a stage of a run (accumulated if it is entered more than once)"""
+
+        sampler = None
+        if self.profile_dir is not None and not self.profiling:
+            self.profiling = True
+            sampler = StackSampler()
+            sampler.start()
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+            if sampler is not None:
+                sampler.stop()
+                sampler.merge_workers(Path(self.profile_dir) / WORKER_PROFILES)
+                sampler.write(Path(self.profile_dir) / f"{name}.folded")
+                self.profiling = False
+
+    def worker(self, func):
+        """func wrapped to be profiled in worker processes while a stage is profiled, e.g. delayed(METRICS.worker(func))"""
+
+        if not self.profiling:
+            return func
+
+        return WorkerFunction(func, Path(self.profile_dir) / WORKER_PROFILES)
+
+    def drain(self) -> dict:
+        """Everything recorded since the last drain (or reset), e.g. to send from a worker process to the parent"""
+        data = dict(queries=self.queries, cache=self.cache, stages=self.stages)
+        self.reset()
+        return data
+
+    def merge(self, data: dict) -> None:
+        """Add metrics drained from another instance"""
+
+        for name, other in data["queries"].items():
+            query = self._query(name)
+            query["seconds"].extend(other["seconds"])
+            query["queued_seconds"].extend(other["queued_seconds"])
+            for key in ["rows", "failures", "retries"]:
+                query[key] += other[key]
+
+        for name, other in data["cache"].items():
+            self.record_cache(name, other["hits"], other["misses"])
+
+        for name, seconds in data["stages"].items():
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def summary(self) -> dict:
+        """Totals, mean and latency percentiles of each query, cache hit rates and stage timings"""
+
+        import numpy as np
+
+        queries = {}
+        for name, query in sorted(self.queries.items()):
+
+            seconds = np.array(query["seconds"])
+            queued = np.array(query["queued_seconds"])
+
+            queries[name] = dict(
+                count=len(seconds),
+                rows=query["rows"],
+                failures=query["failures"],
+                retries=query["retries"],
+                total_seconds=float(seconds.sum()),
+                mean_seconds=float(seconds.mean()) if len(seconds) else None,
+                max_seconds=float(seconds.max()) if len(seconds) else None,
+                **{
+                    f"p{p}_seconds": (
+                        float(np.percentile(seconds, p)) if len(seconds) else None
+                    )
+                    for p in PERCENTILES
+                },
+                total_queued_seconds=float(queued.sum()),
+                p99_queued_seconds=(
+                    float(np.percentile(queued, 99)) if len(queued) else None
+                ),
+            )
+
+        cache = {
+            name: dict(
+                **counts,
+                hit_rate=counts["hits"] / max(counts["hits"] + counts["misses"], 1),
+            )
+            for name, counts in sorted(self.cache.items())
+        }
+
+        return dict(queries=queries, cache=cache, stages=self.stages)
+
+    def write(self, path: str | Path) -> dict:
+        """Write the summary as JSON, and print the slowest queries"""
+
+        summary = self.summary()
+
+        for name, query in summary["queries"].items():
+            if query["count"]:
+                mrich.var(
+                    f"{name} queries",
+                    f"{query['count']} p50={query['p50_seconds']:.3f}s p99={query['p99_seconds']:.3f}s",
+                )
+
+        mrich.writing(path)
+        with open(path, "wt") as f:
+            json.dump(summary, f, indent=2)
+
+        return summary
+
+
+class StackSampler(threading.Thread):
+    """Sample the stacks of the threads of this process at a fixed interval, counting the collapsed stacks.
+    A CPU profile: a stack is only counted while its thread is running (from /proc, where it isn't available
+    every sample is counted, i.e. a wall-clock profile)"""
+
+    def __init__(self, interval: float = 0.005, prefix: str = ""):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.prefix = prefix
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+
+            threads = {thread.ident: thread.native_id for thread in threading.enumerate()}
+
+            for thread_id, frame in sys._current_frames().items():
+
+                if thread_id == self.ident or not is_running(threads.get(thread_id)):
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                    frame = frame.f_back
+
+                if stack:
+                    self.stacks[self.prefix + ";".join(reversed(stack))] += 1
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+
+    def merge_workers(self, directory: Path) -> None:
+        """Add (and remove) the stacks appended by worker processes to directory (see WorkerFunction)"""
+
+        if not directory.exists():
+            return
+
+        for path in directory.glob("*.folded"):
+            with open(path, "rt") as f:
+                for line in f:
+                    stack, count = line.rstrip("\n").rsplit(" ", maxsplit=1)
+                    self.stacks[stack] += int(count)
+            path.unlink()
+
+        directory.rmdir()
+
+    def write(self, path: str | Path, mode: str = "wt") -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if mode == "wt":
+            mrich.writing(path)
+        with open(path, mode) as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def is_running(native_id: int | None) -> bool:
+    """Whether a thread is running (or runnable), True if that can't be told"""
+
+    if native_id is None:
+        return True
+
+    try:
+        with open(f"/proc/self/task/{native_id}/stat", "rt") as f:
+            # the state follows the command name, which is in parentheses
+            return f.read().rsplit(")", maxsplit=1)[1].split()[0] == "R"
+    except (OSError, IndexError):
+        return True
+
+
+class WorkerFunction:
+    """A function run in worker processes, sampled (see StackSampler) while it runs,
+    its stacks appended to {directory}/{pid}.folded (see Metrics.worker)"""
+
+    def __init__(self, func, directory: Path):
+        self.func = func
+        self.directory = directory
+        self.pid = os.getpid()
+
+    def __call__(self, *args, **kwargs):
+
+        # e.g. with n_jobs=1, the calling process is already sampled
+        if os.getpid() == self.pid:
+            return self.func(*args, **kwargs)
+
+        sampler = StackSampler(prefix="worker;")
+        sampler.start()
+
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            sampler.stop()
+            self.directory.mkdir(parents=True, exist_ok=True)
+            sampler.write(self.directory / f"{os.getpid()}.folded", mode="at")
+
+
+METRICS = Metrics()
+
+
+def setup_metrics(profile_dir: str | Path | None = None) -> Metrics:
+    """Start recording a run's metrics from scratch, optionally profiling each stage into profile_dir"""
+
+    METRICS.reset()
+    METRICS.profile_dir = profile_dir
+
+    return METRICS
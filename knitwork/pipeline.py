@@ -0,0 +1,89 @@
+import mrich
+
+from pathlib import Path
+
+from .config import CONFIG, print_config
+from .fragment import fragment
+from .ingest import combine_ligands, read_ligands
+from .knit import merge_all
+
+KINDS = ["pure", "impure"]
+
+
+def run(
+    inputs: list[str | Path],
+    output_dir: str | Path = ".",
+    root: str | Path | None = None,
+    kinds: list[str] = KINDS,
+    cache_dir: str | Path | None = None,
+    limit: int = 5,
+    batch_size: int = CONFIG["KNITWORK_BATCH_SIZE"],
+    engine: str = "joblib",
+    output_format: str | None = None,
+    sdf: str = "single",
+    sdf_properties: list[str] | None = None,
+    mols: bool = True,
+    intermediates: bool = False,
+    profile: bool = False,
+) -> dict[str, Path | None]:
+    """Run the whole pipeline in one process: combine (and deduplicate) the input SDFs, fragment and pair them up,
+    and knit merges of each kind together over the same substructure pairs. Returns the path of each merges table.
+
+    Dataframes are passed between stages in memory, and fragmentation and knitting share one cache
+    (output_dir/cache by default). With intermediates the combined input and the fragment_output
+    tables are also written, as by the separate commands."""
+
+    mrich.h2("knitwork.pipeline.run()")
+
+    output_dir = Path(output_dir)
+    cache_dir = Path(cache_dir or output_dir / "cache")
+
+    mrich.var("output_dir", output_dir)
+    mrich.var("kinds", kinds)
+    print_config("GRAPH_LOCATION")
+    print_config("KNITWORK")
+
+    for kind in kinds:
+        if kind not in KINDS:
+            raise ValueError(f"Unknown merge kind: {kind}, must be one of {KINDS}")
+
+    num_threads = CONFIG["FRAGMENT_INGEST_THREADS"]
+
+    if intermediates:
+        # the combined input as written by combine-inputs, then fragmented from there
+        input_sdf = output_dir / "knitwork_input" / "input.sdf"
+        input_sdf.parent.mkdir(parents=True, exist_ok=True)
+        combine_ligands(inputs, input_sdf, root=root, num_threads=num_threads)
+        mol_df = read_ligands([input_sdf], num_threads=num_threads, deduplicate=False)
+    else:
+        mol_df = read_ligands(inputs, root=root, num_threads=num_threads)
+
+    pair_df = fragment(
+        mol_df,
+        output_dir / "fragment_output",
+        cache_dir=cache_dir,
+        output_format=output_format,
+        profile=profile,
+        write_tables=intermediates,
+    )
+
+    if "impure" in kinds:
+        # custom logger, as for impure_merge
+        import logging, sys
+
+        logging.basicConfig(stream=sys.stdout, level=logging.INFO, force=True)
+
+    return merge_all(
+        kinds,
+        pair_df[["subnodes_A", "synthons_B"]],
+        output_dir=output_dir / "knitwork_output",
+        cache_dir=cache_dir,
+        limit=limit,
+        batch_size=batch_size,
+        engine=engine,
+        output_format=output_format,
+        sdf=sdf,
+        sdf_properties=sdf_properties,
+        mols=mols,
+        profile=profile,
+    )
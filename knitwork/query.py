@@ -2,14 +2,148 @@ import mrich
 import logging
 from mrich import print
 
-import json
+import os
 import time
+import atexit
+import random
 import asyncio
-from rdkit.Chem import MolFromSmiles
-from neo4j import GraphDatabase, AsyncGraphDatabase
+import numpy as np
+from neo4j import GraphDatabase, AsyncGraphDatabase, Query
+from neo4j.exceptions import (
+    TransientError,
+    ServiceUnavailable,
+    SessionExpired,
+    DatabaseError,
+    ClientError,
+    ConnectionAcquisitionTimeoutError,
+)
 
 from .config import CONFIG
-from .tools import load_sig_factory, calc_pharm_fp
+from .metrics import METRICS, QUERY_NAME
+from .tools import (
+    canonical_smiles,
+    calc_synthon_fp,
+    parse_pharmfp,
+    fingerprint_matrix,
+    score_candidates,
+)
+from .cache import expansion_key
+from .local import get_local_graph
+
+# shared drivers, one connection pool per process (and per event loop for async)
+DRIVER = None
+DRIVER_PID = None
+ASYNC_DRIVERS = {}
+SEMAPHORES = {}
+
+# query templates
+SUBNODES_QUERY = """
+MATCH (fa:F2 {smiles: $smiles})-[e:FRAG*0..20]->(f:F2) 
+RETURN f
+"""
+
+TERMINAL_SUBNODES_QUERY = """
+MATCH (a:F2 {smiles: $smiles})-[e:FRAG*0..20]->(f:F2)
+WHERE NOT ()-[:FRAG]-(f)-[:FRAG]->()
+RETURN f
+"""
+
+SYNTHONS_QUERY = """
+MATCH (a:F2 {smiles: $smiles})-[e:FRAG*0..15]->(b:F2)
+RETURN e[-1] as edge
+"""
+
+TERMINAL_SYNTHONS_QUERY = """
+MATCH (a:F2 {smiles: $smiles})-[e:FRAG*0..15]->(b:F2)
+WHERE NOT ()-[:FRAG]-(b)-[:FRAG]->()
+RETURN e[-1] as edge
+"""
+
+R_GROUPS_QUERY = """
+MATCH (a:F2 {smiles: $smiles})-[e:FRAG*0..15]->(b:F2)
+WHERE NOT ()-[:FRAG]-(b)-[:FRAG]->()
+AND e[-1].prop_synthon contains '[Xe]'
+AND NOT e[-1].prop_synthon=e[-2].prop_synthon
+RETURN e[-1].prop_synthon as synthon, e[-2].prop_synthon as r_group;
+"""
+
+# one row per reachable node, with the last two edges of every path to it (and the shortest such path)
+FRAGMENTS_QUERY = """
+MATCH (a:F2 {smiles: $smiles})-[e:FRAG*0..20]->(b:F2)
+WITH b, e[-1] as edge, e[-2] as parent_edge, min(size(e)) as depth
+WITH b, collect([edge.prop_synthon, edge.prop_core, parent_edge.prop_synthon, depth]) as paths
+RETURN b.smiles as subnode, size([p = ()-[:FRAG]-(b)-[:FRAG]->() | p]) = 0 as terminal, paths
+"""
+
+# expansion templates are formatted with num_hops, limit and (impure) the similarity metric
+PURE_EXPANSIONS_QUERY = """
+UNWIND $pairs as p
+CALL {
+    WITH p
+    MATCH (a:F2 {smiles: p.smiles})<-[:FRAG*0..%(num_hops)d]-(b:F2)<-[e:FRAG]-(c:Mol)
+    WHERE e.prop_synthon=p.synthon
+    RETURN c.smiles as smi, c.cmpd_ids as ids
+    %(limit)s
+}
+RETURN p.index as index, smi, ids
+"""
+
+IMPURE_EXPANSIONS_QUERY = """
+UNWIND $pairs as p
+CALL {
+    WITH p
+    MATCH (a:F2 {smiles: p.smiles})<-[:FRAG*0..%(num_hops)d]-(b:F2)<-[e:FRAG]-(c:Mol)
+    WHERE e.prop_pharmfp IS NOT NULL
+    WITH p, %(metric)s(e.prop_pharmfp, p.vector) as sim, c.smiles as smi, e.prop_synthon as syn, c.cmpd_ids as ids
+    WHERE sim >= $threshold
+    AND NOT syn=p.synthon
+    RETURN smi, syn, sim, ids
+    %(limit)s
+}
+RETURN p.index as index, smi, syn, sim, ids
+"""
+
+# candidate expansions of each subnode with their fingerprints, for client-side similarity.
+# Like IMPURE_EXPANSIONS_QUERY there is a row per path (no DISTINCT), so that rows count the same against LIMIT
+IMPURE_CANDIDATES_QUERY = """
+UNWIND $subnodes as s
+CALL {
+    WITH s
+    MATCH (a:F2 {smiles: s})<-[:FRAG*0..%(num_hops)d]-(b:F2)<-[e:FRAG]-(c:Mol)
+    WHERE e.prop_pharmfp IS NOT NULL
+    RETURN c.smiles as smi, c.cmpd_ids as ids, e.prop_synthon as syn, e.prop_pharmfp as fp
+}
+RETURN s as subnode, smi, ids, syn, fp
+"""
+
+SIMILARITY_MODES = ["server", "client"]
+
+# errors worth retrying: server-side transient failures and dropped connections.
+# Timeouts aren't retried (a slow query would hold its slot for every attempt), they fail their batch
+TRANSIENT_ERRORS = (
+    TransientError,
+    ServiceUnavailable,
+    SessionExpired,
+)
+
+
+class BatchError(Exception):
+    """A batch of expansions failed on a transient, database or timeout error,
+    it is recorded in the ledger to be retried (with --resume). Any other error is raised."""
+
+
+def is_batch_error(e: Exception) -> bool:
+    """Whether a query error should fail its batch (see BatchError) rather than the run"""
+
+    if isinstance(
+        e,
+        TRANSIENT_ERRORS
+        + (DatabaseError, ConnectionAcquisitionTimeoutError, asyncio.TimeoutError),
+    ):
+        return True
+
+    # server-side transaction timeouts (see KNITWORK_QUERY_TIMEOUT) are client errors
+    return isinstance(e, ClientError) and "TimedOut" in (e.code or "")
 
 
 def check_config():
@@ -23,38 +157,149 @@ def check_config():
         raise ValueError(f"Configuration missing: {missing}")
 
 
-def get_driver():
-    check_config()
-    return GraphDatabase.driver(
-        CONFIG["GRAPH_LOCATION"],
+def driver_kwargs() -> dict:
+    """Keyword arguments for the Neo4j driver constructors"""
+    return dict(
         auth=(CONFIG["GRAPH_USERNAME"], CONFIG["GRAPH_PASSWORD"]),
+        max_connection_pool_size=CONFIG["GRAPH_MAX_CONNECTION_POOL_SIZE"],
+        max_connection_lifetime=CONFIG["GRAPH_MAX_CONNECTION_LIFETIME"],
+        connection_acquisition_timeout=CONFIG["GRAPH_CONNECTION_ACQUISITION_TIMEOUT"],
+        keep_alive=CONFIG["GRAPH_KEEP_ALIVE"],
     )
 
 
+def get_driver():
+    """Get the process-wide (pooled) Neo4j driver, creating it if needed"""
+
+    global DRIVER, DRIVER_PID
+
+    # a driver inherited over fork() shares sockets with the parent, don't reuse it
+    if DRIVER is not None and DRIVER_PID != os.getpid():
+        DRIVER = None
+
+    if DRIVER is None:
+        check_config()
+        DRIVER = GraphDatabase.driver(CONFIG["GRAPH_LOCATION"], **driver_kwargs())
+        DRIVER_PID = os.getpid()
+
+    return DRIVER
+
+
 async def aget_driver():
-    check_config()
-    return AsyncGraphDatabase.driver(
-        CONFIG["GRAPH_LOCATION"],
-        auth=(CONFIG["GRAPH_USERNAME"], CONFIG["GRAPH_PASSWORD"]),
-    )
+    """Get the (pooled) async Neo4j driver for the running event loop, creating it if needed"""
+
+    loop = asyncio.get_running_loop()
+    key = (os.getpid(), id(loop))
+
+    if key not in ASYNC_DRIVERS:
+        check_config()
+        ASYNC_DRIVERS[key] = AsyncGraphDatabase.driver(
+            CONFIG["GRAPH_LOCATION"], **driver_kwargs()
+        )
+
+    return ASYNC_DRIVERS[key]
+
+
+def close_driver():
+    """Close the process-wide Neo4j driver"""
+
+    global DRIVER
+
+    if DRIVER is not None and DRIVER_PID == os.getpid():
+        DRIVER.close()
+
+    DRIVER = None
+
+
+async def aclose_driver():
+    """Close the async Neo4j driver for the running event loop"""
+
+    loop = asyncio.get_running_loop()
+    driver = ASYNC_DRIVERS.pop((os.getpid(), id(loop)), None)
+    SEMAPHORES.pop((os.getpid(), id(loop)), None)
+
+    if driver is not None:
+        await driver.close()
+
+
+atexit.register(close_driver)
+
+
+def aget_semaphore():
+    """Get the semaphore bounding in-flight async queries for the running event loop"""
+
+    loop = asyncio.get_running_loop()
+    key = (os.getpid(), id(loop))
+
+    if key not in SEMAPHORES:
+        SEMAPHORES[key] = asyncio.Semaphore(CONFIG["KNITWORK_MAX_IN_FLIGHT"])
+
+    return SEMAPHORES[key]
+
+
+def retry_delay(attempt: int) -> float:
+    """Exponential backoff (with jitter) before retrying a failed query"""
+    return CONFIG["KNITWORK_RETRY_BACKOFF"] * 2**attempt * random.uniform(0.5, 1.0)
 
 
 async def arun_query(query, **kwargs):
+    """Run an async query, bounded to KNITWORK_MAX_IN_FLIGHT concurrent queries per event loop,
+    with a per-query timeout and retries on transient errors (not on timeouts)"""
+
+    semaphore = aget_semaphore()
+    retries = CONFIG["KNITWORK_QUERY_RETRIES"]
+
+    for attempt in range(retries + 1):
+        try:
+            # the query's wall time starts once it has a slot (see Metrics.query)
+            start = time.perf_counter()
+            async with semaphore:
+                METRICS.record_queued(time.perf_counter() - start)
+                return await asyncio.wait_for(
+                    _arun_query(query, **kwargs),
+                    timeout=CONFIG["KNITWORK_QUERY_TIMEOUT"],
+                )
+        except TRANSIENT_ERRORS as e:
+            if attempt == retries:
+                raise
+            delay = retry_delay(attempt)
+            METRICS.record_retry(QUERY_NAME.get())
+            logging.warning(f"Retrying query in {delay:.1f}s ({type(e).__name__}: {e})")
+            await asyncio.sleep(delay)
+
+
+async def _arun_query(query, **kwargs):
     driver = await aget_driver()
-    async with driver:
-        async with driver.session() as session:
-            result = await session.run(query, **kwargs)
-            records = [record async for record in result]
-            return records
+    async with driver.session() as session:
+        result = await session.run(query, **kwargs)
+        records = [record async for record in result]
+        return records
 
 
 def run_query(query, **kwargs):
+    """Run a query with a (server-side) timeout and retries on transient errors (not on timeouts)"""
+
+    retries = CONFIG["KNITWORK_QUERY_RETRIES"]
+    query = Query(query, timeout=CONFIG["KNITWORK_QUERY_TIMEOUT"])
+
+    for attempt in range(retries + 1):
+        try:
+            return _run_query(query, **kwargs)
+        except TRANSIENT_ERRORS as e:
+            if attempt == retries:
+                raise
+            delay = retry_delay(attempt)
+            METRICS.record_retry(QUERY_NAME.get())
+            logging.warning(f"Retrying query in {delay:.1f}s ({type(e).__name__}: {e})")
+            time.sleep(delay)
+
+
+def _run_query(query, **kwargs):
     driver = get_driver()
-    with driver:
-        with driver.session() as session:
-            result = session.run(query, **kwargs)
-            records = [record for record in result]
-            return records
+    with driver.session() as session:
+        result = session.run(query, **kwargs)
+        records = [record for record in result]
+        return records
 
 
 async def aget_subnodes(
@@ -71,19 +316,14 @@ async def aget_subnodes(
     :return: list of unique subnode SMILES
     """
 
-    if terminal_nodes:
-        query = """
-        MATCH (a:F2 {smiles: $smiles})-[e:FRAG*0..20]->(f:F2)
-        WHERE NOT ()-[:FRAG]-(f)-[:FRAG]->()
-        RETURN f
-        """
-    else:
-        query = """
-        MATCH (fa:F2 {smiles: $smiles})-[e:FRAG*0..20]->(f:F2) 
-        RETURN f
-        """
+    with METRICS.query("subnodes") as metrics:
+        if (graph := get_local_graph()) is not None:
+            records = graph.subnodes(smiles, terminal_nodes)
+        else:
+            query = TERMINAL_SUBNODES_QUERY if terminal_nodes else SUBNODES_QUERY
+            records = await arun_query(query, smiles=smiles)
+        metrics["rows"] = len(records)
 
-    records = await arun_query(query, smiles=smiles)
     subnodes = [record["f"]["smiles"] for record in records]
 
     if progress:
@@ -107,19 +347,14 @@ async def aget_synthons(
     :return: list of constituent synthon SMILES strings
     """
 
-    if terminal_nodes:
-        query = """
-        MATCH (a:F2 {smiles: $smiles})-[e:FRAG*0..15]->(b:F2)
-        WHERE NOT ()-[:FRAG]-(b)-[:FRAG]->()
-        RETURN e[-1] as edge
-        """
-    else:
-        query = """
-        MATCH (a:F2 {smiles: $smiles})-[e:FRAG*0..15]->(b:F2)
-        RETURN e[-1] as edge
-        """
+    with METRICS.query("synthons") as metrics:
+        if (graph := get_local_graph()) is not None:
+            records = graph.synthons(smiles, terminal_nodes)
+        else:
+            query = TERMINAL_SYNTHONS_QUERY if terminal_nodes else SYNTHONS_QUERY
+            records = await arun_query(query, smiles=smiles)
+        metrics["rows"] = len(records)
 
-    records = await arun_query(query, smiles=smiles)
     edges = [edge for record in records if (edge := record["edge"])]
 
     synthons = set()
@@ -147,15 +382,12 @@ async def aget_r_groups(
     task=None,
 ):
 
-    query = """
-    MATCH (a:F2 {smiles: $smiles})-[e:FRAG*0..15]->(b:F2)
-    WHERE NOT ()-[:FRAG]-(b)-[:FRAG]->()
-    AND e[-1].prop_synthon contains '[Xe]'
-    AND NOT e[-1].prop_synthon=e[-2].prop_synthon
-    RETURN e[-1].prop_synthon as synthon, e[-2].prop_synthon as r_group;
-    """
-
-    records = await arun_query(query, smiles=smiles)
+    with METRICS.query("r_groups") as metrics:
+        if (graph := get_local_graph()) is not None:
+            records = graph.r_groups(smiles)
+        else:
+            records = await arun_query(R_GROUPS_QUERY, smiles=smiles)
+        metrics["rows"] = len(records)
 
     results = []
     for record in records:
@@ -167,129 +399,489 @@ async def aget_r_groups(
     return results
 
 
+async def aget_fragments(
+    smiles: str,
+    terminal_subnodes: bool = CONFIG["FRAGMENT_TERMINAL_SUBNODES"],
+    terminal_synthons: bool = CONFIG["FRAGMENT_TERMINAL_SYNTHONS"],
+    progress=None,
+    tasks=None,
+):
+    """
+    Get subnodes, synthons and r-groups for a given node (retrieve using SMILES)
+    with a single traversal of the FRAG tree. Equivalent to aget_subnodes, aget_synthons and aget_r_groups.
+
+    :param smiles: SMILES string for node to fragment
+    :param terminal_subnodes: whether to only return 'terminal' subnodes (can't be broken down further)
+    :param terminal_synthons: whether to only return 'terminal' synthons
+    :return: tuple of (set of subnode SMILES, set of synthon SMILES, list of (synthon, r_group) tuples)
+    """
+
+    with METRICS.query("fragments") as metrics:
+        if (graph := get_local_graph()) is not None:
+            records = graph.fragments(smiles)
+        else:
+            records = await arun_query(FRAGMENTS_QUERY, smiles=smiles)
+        metrics["rows"] = len(records)
+
+    subnodes = set()
+    synthons = set()
+    r_groups = []
+
+    for record in records:
+
+        terminal = record["terminal"]
+
+        if terminal or not terminal_subnodes:
+            subnodes.add(record["subnode"])
+
+        for synthon, core, r_group, depth in record["paths"]:
+
+            # synthon and r-group queries only walk 15 hops
+            if depth > 15:
+                continue
+
+            if terminal or not terminal_synthons:
+                for i in [synthon, core]:
+                    if i and i.count("Xe") == 1:
+                        synthons.add(i)
+
+            if (
+                terminal
+                and synthon
+                and r_group
+                and "[Xe]" in synthon
+                and synthon != r_group
+            ):
+                r_groups.append((synthon, r_group))
+
+    if progress:
+        for task in tasks:
+            progress.update(task, advance=1)
+
+    return subnodes, synthons, r_groups
+
+
 def get_pure_expansions(
     smiles: str,
     synthon: str,
     num_hops: int = 2,
     limit: int = 5,
     index: int | None = None,
-    cache_dir=None,
+    cache=None,
     cached_only=False,
 ):
+    """Get 'pure' expansions of a single (subnode, synthon) pair, see get_pure_expansions_batch"""
 
-    if cache_dir:
-        cache_file = cache_dir / f"pure_{smiles}_{synthon}_{num_hops}_{limit}.json"
-        if cache_file.exists():
-            logging.info(f"Using cache {index} {smiles} {synthon}")
-            return json.load(open(cache_file, "rt"))
-        elif cached_only:
-            return None
-
-    query = """
-    MATCH (a:F2 {smiles: $smiles})<-[:FRAG*0..%(num_hops)d]-(b:F2)<-[e:FRAG]-(c:Mol)
-    WHERE e.prop_synthon=$synthon
-    WITH c.smiles as smi, c.cmpd_ids as ids
-    RETURN smi, ids
-    """ % {
-        "num_hops": num_hops
-    }
+    return get_pure_expansions_batch(
+        [(smiles, synthon)],
+        num_hops=num_hops,
+        limit=limit,
+        index=index,
+        cache=cache,
+        cached_only=cached_only,
+    )[0]
 
-    if limit:
-        query = query + f" LIMIT {limit}"
 
-    logging.info(f"Starting impure expansion {index} {smiles} {synthon}")
+def get_pure_expansions_batch(
+    pairs: list[tuple[str, str]],
+    num_hops: int = 2,
+    limit: int = 5,
+    index: int | None = None,
+    cache=None,
+    cached_only=False,
+):
+    """
+    Get 'pure' expansions for a batch of (subnode, synthon) pairs with a single UNWIND query
+
+    :param pairs: list of (subnode SMILES, synthon SMILES) tuples
+    :param num_hops: maximum number of FRAG hops between the subnode and expansion
+    :param limit: maximum number of expansions per pair
+    :param index: batch index (for logging)
+    :param cache: query cache (see knitwork.cache)
+    :param cached_only: only return cached results, uncached pairs are None
+    :return: list with [(compound IDs, expansion SMILES), ...] for each pair
+    """
 
-    try:
-        records = run_query(query, smiles=smiles, synthon=synthon)
-    except Exception as e:
-        mrich.error(index, e)
-        raise Exception(f"{smiles=} {synthon=} {e}")
+    return get_expansions_batch(
+        "pure",
+        pairs,
+        num_hops=num_hops,
+        limit=limit,
+        index=index,
+        cache=cache,
+        cached_only=cached_only,
+    )
 
-    results = []
-    for record in records:
-        results.append((record["ids"], record["smi"]))
 
-    if cache_dir:
-        json.dump(results, open(cache_file, "wt"), indent=2)
+def get_impure_expansions(
+    smiles: str,
+    synthon: str,
+    num_hops: int = 2,
+    limit: int = 5,
+    index: int | None = None,
+    cache=None,
+    cached_only=False,
+):
+    """Get 'impure' expansions of a single (subnode, synthon) pair, see get_impure_expansions_batch"""
 
-    logging.info(f"Success {index} {smiles} {synthon} #results: {len(results)}")
+    return get_impure_expansions_batch(
+        [(smiles, synthon)],
+        num_hops=num_hops,
+        limit=limit,
+        index=index,
+        cache=cache,
+        cached_only=cached_only,
+    )[0]
 
-    return results
 
+def get_impure_expansions_batch(
+    pairs: list[tuple[str, str]],
+    num_hops: int = 2,
+    limit: int = 5,
+    index: int | None = None,
+    cache=None,
+    cached_only=False,
+):
+    """
+    Get 'impure' expansions (pharmacophorically similar synthons) for a batch of (subnode, synthon) pairs with a single UNWIND query
+
+    :param pairs: list of (subnode SMILES, synthon SMILES) tuples
+    :param num_hops: maximum number of FRAG hops between the subnode and expansion
+    :param limit: maximum number of expansions per pair
+    :param index: batch index (for logging)
+    :param cache: query cache (see knitwork.cache)
+    :param cached_only: only return cached results, uncached pairs are None
+    :return: list with [(expansion SMILES, synthon SMILES, similarity, compound IDs), ...] for each pair
+    """
 
-def get_impure_expansions(
-    smiles: str,
-    synthon: str,
+    return get_expansions_batch(
+        "impure",
+        pairs,
+        num_hops=num_hops,
+        limit=limit,
+        index=index,
+        cache=cache,
+        cached_only=cached_only,
+    )
+
+
+def get_expansions_batch(
+    kind: str,
+    pairs: list[tuple[str, str]],
     num_hops: int = 2,
     limit: int = 5,
     index: int | None = None,
-    cache_dir=None,
+    cache=None,
     cached_only=False,
+    vectors: dict | None = None,
 ):
+    """Get 'pure' or 'impure' expansions for a batch of (subnode, synthon) pairs"""
+
+    results, todo = get_cached_expansions(
+        kind, pairs, num_hops, limit, cache, cached_only
+    )
+
+    if todo:
+
+        query, params = expansions_query(kind, todo, num_hops, limit, vectors)
+
+        logging.info(f"Starting {kind} expansion batch {index} #pairs: {len(todo)}")
+
+        try:
+            with METRICS.query(f"{kind}_expansions") as metrics:
+                if (graph := get_local_graph()) is not None:
+                    records = graph.expansions(
+                        kind, num_hops=num_hops, limit=limit, **params
+                    )
+                elif client_similarity(kind):
+                    query, subnodes = candidates_query(params, num_hops)
+                    rows = run_query(query, subnodes=subnodes)
+                    records = score_expansions(params, rows, limit)
+                else:
+                    records = run_query(query, **params)
+                metrics["rows"] = len(records)
+        except Exception as e:
+            mrich.error(index, e)
+            if not is_batch_error(e):
+                raise
+            raise BatchError(f"batch {index} #pairs={len(todo)} {e}") from e
+
+        results.update(
+            parse_expansions(kind, todo, records, num_hops, limit, index, cache)
+        )
+
+    return [results[pair] for pair in pairs]
 
-    if cache_dir:
-        cache_file = cache_dir / f"impure_{smiles}_{synthon}_{num_hops}_{limit}.json"
-        if cache_file.exists():
-            logging.info(f"Using cache {index} {smiles} {synthon}")
-            return json.load(open(cache_file, "rt"))
-        elif cached_only:
-            return None
 
-    logging.info(f"Starting impure expansion {index} {smiles} {synthon}")
+async def aget_expansions_batch(
+    kind: str,
+    pairs: list[tuple[str, str]],
+    num_hops: int = 2,
+    limit: int = 5,
+    index: int | None = None,
+    cache=None,
+    cached_only=False,
+    vectors: dict | None = None,
+    progress=None,
+    task=None,
+):
+    """Get 'pure' or 'impure' expansions for a batch of (subnode, synthon) pairs asynchronously.
+    Blocking work (cache reads and writes, fingerprints, scoring and local graph queries) runs in threads,
+    so that it doesn't hold up the other queries in flight"""
 
-    sig_factory = load_sig_factory(
-        fdef_file=CONFIG["FINGERPRINT_FDEF"],
-        max_point_count=CONFIG["FINGERPRINT_MAXPOINTCOUNT"],
-        bins=json.loads(CONFIG["FINGERPRINT_BINS"]),
+    results, todo = await asyncio.to_thread(
+        get_cached_expansions, kind, pairs, num_hops, limit, cache, cached_only
     )
 
-    vector = calc_pharm_fp(MolFromSmiles(synthon), sig_factory, as_str=False)
+    if todo:
 
-    threshold = CONFIG["KNITWORK_SIMILARITY_THRESHOLD"]
-    metric = CONFIG["KNITWORK_SIMILARITY_METRIC"]
+        query, params = await asyncio.to_thread(
+            expansions_query, kind, todo, num_hops, limit, vectors
+        )
 
-    query = """
-    MATCH (a:F2 {smiles: $smiles})<-[:FRAG*0..%(num_hops)d]-(b:F2)<-[e:FRAG]-(c:Mol)
-    WHERE e.prop_pharmfp IS NOT NULL
-    WITH usersimilarity.tanimoto_similarity(e.prop_pharmfp, $vector) as sim, c.smiles as smi, e.prop_synthon as syn, c.cmpd_ids as ids
-    WHERE sim >= $threshold
-    AND NOT e.prop_synthon=$query_synthon
-    RETURN smi, syn, sim, ids
-    """ % {
+        logging.info(f"Starting {kind} expansion batch {index} #pairs: {len(todo)}")
+
+        try:
+            with METRICS.query(f"{kind}_expansions") as metrics:
+                if (graph := get_local_graph()) is not None:
+                    records = await asyncio.to_thread(
+                        graph.expansions,
+                        kind,
+                        num_hops=num_hops,
+                        limit=limit,
+                        **params,
+                    )
+                elif client_similarity(kind):
+                    query, subnodes = candidates_query(params, num_hops)
+                    rows = await arun_query(query, subnodes=subnodes)
+                    records = await asyncio.to_thread(
+                        score_expansions, params, rows, limit
+                    )
+                else:
+                    records = await arun_query(query, **params)
+                metrics["rows"] = len(records)
+        except Exception as e:
+            mrich.error(index, e)
+            if not is_batch_error(e):
+                raise
+            raise BatchError(f"batch {index} #pairs={len(todo)} {e}") from e
+
+        results.update(
+            await asyncio.to_thread(
+                parse_expansions, kind, todo, records, num_hops, limit, index, cache
+            )
+        )
+
+    if progress:
+        progress.update(task, advance=1)
+
+    return [results[pair] for pair in pairs]
+
+
+def expansions_query(
+    kind: str,
+    pairs: list[tuple[str, str]],
+    num_hops: int,
+    limit: int,
+    vectors: dict | None = None,
+) -> tuple[str, dict]:
+    """Build the batched UNWIND query and its parameters for 'pure' or 'impure' expansions.
+    Precomputed synthon fingerprints can be passed as a dict of vectors"""
+
+    if kind == "pure":
+
+        query = PURE_EXPANSIONS_QUERY
+
+        params = dict(
+            pairs=[
+                dict(index=i, smiles=smiles, synthon=synthon)
+                for i, (smiles, synthon) in enumerate(pairs)
+            ]
+        )
+
+    elif kind == "impure":
+
+        query = IMPURE_EXPANSIONS_QUERY
+
+        vectors = vectors or {}
+
+        params = dict(
+            pairs=[
+                dict(
+                    index=i,
+                    smiles=smiles,
+                    synthon=synthon,
+                    vector=vectors.get(synthon) or get_synthon_vector(synthon),
+                )
+                for i, (smiles, synthon) in enumerate(pairs)
+            ],
+            threshold=CONFIG["KNITWORK_SIMILARITY_THRESHOLD"],
+            metric=CONFIG["KNITWORK_SIMILARITY_METRIC"],
+        )
+
+    else:
+        raise ValueError(f"Unknown expansion kind: {kind}")
+
+    query = query % {
         "num_hops": num_hops,
+        "limit": f"LIMIT {limit}" if limit else "",
+        "metric": CONFIG["KNITWORK_SIMILARITY_METRIC"],
     }
 
-    if limit:
-        query = query + f" LIMIT {limit}"
-
-    try:
-        records = run_query(
-            query,
-            smiles=smiles,
-            query_synthon=synthon,
-            vector=vector,
-            threshold=threshold,
-            metric=metric,
-            # num_hops=num_hops,
+    return query, params
+
+
+def client_similarity(kind: str) -> bool:
+    """Whether impure similarities are calculated client-side (KNITWORK_SIMILARITY_MODE)"""
+
+    mode = CONFIG["KNITWORK_SIMILARITY_MODE"]
+
+    if mode not in SIMILARITY_MODES:
+        raise ValueError(
+            f"Unknown similarity mode: {mode}, must be one of {SIMILARITY_MODES}"
         )
-    except Exception as e:
-        mrich.error(index, e)
-        raise Exception(f"{smiles=} {synthon=} {e}")
 
-    results = []
+    return kind == "impure" and mode == "client"
+
+
+def candidates_query(params: dict, num_hops: int) -> tuple[str, list[str]]:
+    """Query for the candidate expansions of the unique subnodes of impure expansion parameters"""
+    subnodes = list(dict.fromkeys(pair["smiles"] for pair in params["pairs"]))
+    return IMPURE_CANDIDATES_QUERY % {"num_hops": num_hops}, subnodes
+
+
+def score_expansions(
+    params: dict,
+    rows: list,
+    limit: int,
+) -> list[dict]:
+    """Score candidate expansions (from IMPURE_CANDIDATES_QUERY) client-side, returns IMPURE_EXPANSIONS_QUERY records"""
+
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(row["subnode"], []).append(row)
+
+    candidates = {
+        subnode: dict(
+            smi=[row["smi"] for row in rows],
+            ids=[row["ids"] for row in rows],
+            syn=np.array([row["syn"] for row in rows], dtype=object),
+            fps=fingerprint_matrix([parse_pharmfp(row["fp"]) for row in rows]),
+        )
+        for subnode, rows in grouped.items()
+    }
+
+    return score_candidates(
+        params["pairs"],
+        candidates,
+        params["threshold"],
+        params["metric"],
+        limit,
+    )
+
+
+def parse_expansions(
+    kind: str,
+    pairs: list[tuple[str, str]],
+    records: list,
+    num_hops: int,
+    limit: int,
+    index: int | None = None,
+    cache=None,
+) -> dict:
+    """Map the records of a batched expansion query back to their (subnode, synthon) pairs, and cache them"""
+
+    results = {pair: [] for pair in pairs}
+
     for record in records:
-        results.append(
-            (
+
+        if kind == "pure":
+            result = (record["ids"], record["smi"])
+        else:
+            result = (
                 record["smi"],  # expansion
                 record["syn"],  # synthon
                 record["sim"],  # similarity
                 record["ids"],  # compound names / IDs
             )
-        )
 
-    if cache_dir:
-        json.dump(results, open(cache_file, "wt"), indent=2)
+        results[pairs[record["index"]]].append(result)
 
-    logging.info(f"Success {index} {smiles} {synthon} #results: {len(results)}")
+    dump_cached_expansions(kind, results, num_hops, limit, cache)
+
+    logging.info(
+        f"Success batch {index} #results: {sum(len(v) for v in results.values())}"
+    )
 
     return results
+
+
+def get_synthon_vector(synthon: str) -> list[int]:
+    """Pharmacophore fingerprint of a synthon, memoized on canonical SMILES and the FINGERPRINT config"""
+    return list(
+        calc_synthon_fp(
+            canonical_smiles(synthon),
+            CONFIG["FINGERPRINT_FDEF"],
+            CONFIG["FINGERPRINT_MAXPOINTCOUNT"],
+            CONFIG["FINGERPRINT_BINS"],
+        )
+    )
+
+
+def precompute_synthon_vectors(synthons) -> dict[str, list[int]]:
+    """Calculate pharmacophore fingerprints for all (unique) synthons up front"""
+    return {synthon: get_synthon_vector(synthon) for synthon in set(synthons)}
+
+
+def get_cached_expansions(
+    kind: str,
+    pairs: list[tuple[str, str]],
+    num_hops: int,
+    limit: int,
+    cache=None,
+    cached_only=False,
+) -> tuple[dict, list]:
+    """Look up cached expansions, returns a dict of cached results and a list of unique pairs still to query"""
+
+    pairs = list(dict.fromkeys(pairs))
+
+    results = {}
+
+    if cache is not None:
+
+        keys = {
+            (smiles, synthon): expansion_key(kind, smiles, synthon, num_hops, limit)
+            for smiles, synthon in pairs
+        }
+
+        cached = cache.get_many(keys.values())
+
+        for pair, key in keys.items():
+            if key in cached:
+                results[pair] = cached[key]
+            elif cached_only:
+                results[pair] = None
+
+    todo = [pair for pair in pairs if pair not in results]
+
+    return results, todo
+
+
+def dump_cached_expansions(
+    kind: str,
+    results: dict,
+    num_hops: int,
+    limit: int,
+    cache=None,
+) -> None:
+    """Write query results to the cache"""
+
+    if cache is None:
+        return
+
+    cache.set_many(
+        {
+            expansion_key(kind, smiles, synthon, num_hops, limit): result
+            for (smiles, synthon), result in results.items()
+        }
+    )
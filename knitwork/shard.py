@@ -0,0 +1,152 @@
+import mrich
+
+import re
+import hashlib
+from pathlib import Path
+
+from .config import CONFIG
+
+SHARD_PATTERN = re.compile(r"shard-(\d+)-of-(\d+)")
+
+
+def parse_shard(shard: str) -> tuple[int, int]:
+    """Parse a shard option 'i/N' (0 <= i < N) into (i, N)"""
+
+    try:
+        index, num_shards = (int(x) for x in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard: {shard!r}, must be 'i/N'")
+
+    if not 0 <= index < num_shards:
+        raise ValueError(f"Invalid shard: {shard!r}, must have 0 <= i < N")
+
+    return index, num_shards
+
+
+def shard_dir(
+    output_dir: str | Path,
+    index: int,
+    num_shards: int,
+) -> Path:
+    """Output subdirectory of a shard"""
+    return Path(output_dir) / f"shard-{index}-of-{num_shards}"
+
+
+def pair_shard(
+    pair: tuple[str, str],
+    num_shards: int,
+) -> int:
+    """Shard of a (subnode, synthon) pair, the same on every machine and run"""
+    digest = hashlib.sha1("\t".join(pair).encode()).hexdigest()
+    return int(digest, 16) % num_shards
+
+
+def shard_pairs(
+    pairs: list[tuple[str, str]],
+    index: int,
+    num_shards: int,
+) -> list[tuple[str, str]]:
+    """The pairs in a shard"""
+    return [pair for pair in pairs if pair_shard(pair, num_shards) == index]
+
+
+def find_shards(output_dir: str | Path) -> list[Path]:
+    """Find the shard subdirectories of an output directory, checking that they are all present"""
+
+    output_dir = Path(output_dir)
+
+    shards = {}
+    for path in output_dir.iterdir():
+        if match := SHARD_PATTERN.fullmatch(path.name):
+            shards[tuple(int(x) for x in match.groups())] = path
+
+    if not shards:
+        raise FileNotFoundError(f"No shards in {output_dir}")
+
+    num_shards = {n for _, n in shards}
+    if len(num_shards) > 1:
+        raise ValueError(f"Shards of different partitions in {output_dir}: {num_shards}")
+
+    (num_shards,) = num_shards
+    missing = [i for i in range(num_shards) if (i, num_shards) not in shards]
+    if missing:
+        raise FileNotFoundError(f"Missing shards in {output_dir}: {missing}")
+
+    return [shards[i, num_shards] for i in range(num_shards)]
+
+
+def gather(
+    output_dir: str | Path,
+    kinds: tuple[str] = ("pure", "impure"),
+    output_format: str | None = None,
+    sdf: str = "single",
+    sdf_properties: list[str] | None = None,
+    mols: bool = True,
+) -> dict[str, Path]:
+    """Merge the outputs and caches of all shards in an output directory, returns the path of each merges table"""
+
+    from .io import MergeWriter, find_table, read_table
+    from .cache import open_cache
+    from .ledger import Ledger
+
+    mrich.h2("knitwork.shard.gather()")
+
+    output_dir = Path(output_dir)
+    shards = find_shards(output_dir)
+    mrich.var("#shards", len(shards))
+
+    # caches
+    cache = open_cache(output_dir / "cache")
+    for shard in shards:
+        if (shard / "cache").exists():
+            cache.update(open_cache(shard / "cache"))
+    mrich.var("#cached queries", len(cache))
+
+    paths = {}
+    for kind in kinds:
+
+        name = f"{kind}_merges"
+
+        ledger_paths = [shard / f"{kind}_ledger.sqlite" for shard in shards]
+        if not any(path.exists() for path in ledger_paths):
+            continue
+        elif not all(path.exists() for path in ledger_paths):
+            mrich.warning(f"Not all shards have run {kind} knitting, skipping")
+            continue
+
+        tables = []
+        for shard, ledger_path in zip(shards, ledger_paths):
+
+            ledger = Ledger(ledger_path)
+            outstanding = ledger.outstanding(CONFIG["KNITWORK_MAX_ATTEMPTS"])
+            if outstanding:
+                mrich.warning(
+                    f"{shard.name} has {len(outstanding)} outstanding {kind} pairs"
+                )
+            ledger.close()
+
+            # shards without any merges have no table
+            try:
+                tables.append(find_table(shard, name))
+            except FileNotFoundError:
+                pass
+
+        # IDs are renumbered across shards by the writer
+        writer = MergeWriter(
+            output_dir,
+            name,
+            output_format,
+            sdf=sdf,
+            sdf_properties=sdf_properties,
+            mols=mols,
+        )
+
+        for table in tables:
+            df = read_table(table)
+            writer.write(df.drop(columns="ROMol", errors="ignore"))
+
+        mrich.var(f"#{kind} merges", writer.num_rows)
+
+        paths[kind] = writer.close()
+
+    return paths
@@ -1,16 +1,31 @@
 import mrich
 from mrich import print
 
+import json
 import numpy as np
 from pathlib import Path
+from functools import lru_cache
+from joblib import Parallel, delayed
 from itertools import product
 from scipy.spatial.distance import cdist
 
-from rdkit.Chem import Mol, rdShapeHelpers
+from rdkit.Chem import (
+    Mol,
+    MolFromSmiles,
+    MolFromSmarts,
+    MolToSmiles,
+    PropertyPickleOptions,
+)
+from rdkit.Chem import rdShapeHelpers
 from rdkit.Chem import ChemicalFeatures
 from rdkit.Chem.Pharm2D import Generate
 from rdkit.Chem.Pharm2D.SigFactory import SigFactory
 
+from .metrics import METRICS
+
+
+SIMILARITY_METRICS = ["tanimoto", "dice", "cosine"]
+
 
 def pair_overlap(molA: Mol, molB: Mol):
     overlapA = 1 - rdShapeHelpers.ShapeProtrudeDist(molA, molB, allowReordering=False)
@@ -19,27 +34,190 @@ def pair_overlap(molA: Mol, molB: Mol):
 
 
 def pair_min_distance(molA: Mol, molB: Mol):
-    confA = molA.GetConformer()
-    confB = molB.GetConformer()
-    coords1 = np.array(
-        [list(confA.GetAtomPosition(i)) for i in range(molA.GetNumAtoms())]
-    )
-    coords2 = np.array(
-        [list(confB.GetAtomPosition(i)) for i in range(molB.GetNumAtoms())]
-    )
+    coords1 = get_mol_coords(molA)
+    coords2 = get_mol_coords(molB)
     dists = cdist(coords1, coords2)
-    # print(coords1)
-    # print(coords2)
-    # print(dists)
-    # raise NotImplementedError
     return np.min(dists)
 
 
+def pair_overlaps(
+    mols: list[Mol],
+    i: np.ndarray,
+    j: np.ndarray,
+    n_jobs: int = 1,
+    chunk_size: int = 1000,
+) -> np.ndarray:
+    """Shape overlap (see pair_overlap) for each molecule pair (i, j),
+    in chunks spread over a pool of n_jobs processes"""
+
+    if n_jobs == 1 or len(i) <= chunk_size:
+        return np.array([pair_overlap(mols[a], mols[b]) for a, b in zip(i, j)])
+
+    # ship each chunk only the molecules it needs, as binary blobs (including full precision coordinates)
+    pickle_options = PropertyPickleOptions.CoordsAsDouble
+    chunks = []
+    for start in range(0, len(i), chunk_size):
+        a = i[start : start + chunk_size]
+        b = j[start : start + chunk_size]
+        blobs = {k: mols[k].ToBinary(pickle_options) for k in set(a) | set(b)}
+        chunks.append((blobs, a, b))
+
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(METRICS.worker(chunk_overlaps))(blobs, a, b) for blobs, a, b in chunks
+    )
+
+    return np.concatenate(results)
+
+
+def chunk_overlaps(
+    blobs: dict[int, bytes],
+    i: np.ndarray,
+    j: np.ndarray,
+) -> np.ndarray:
+    """Shape overlap for molecule pairs (i, j) from binary mol blobs"""
+    mols = {k: Mol(blob) for k, blob in blobs.items()}
+    return np.array([pair_overlap(mols[a], mols[b]) for a, b in zip(i, j)])
+
+
+def smiles_descriptors(
+    smiles_list: list[str],
+    n_jobs: int = 1,
+    chunk_size: int = 10_000,
+) -> np.ndarray:
+    """Descriptors used to filter subnodes and synthons, as an (n, 4) int32 array of
+    (#atoms, #carbons, #ring atoms, #rings) per SMILES, -1 for SMILES that can't be parsed.
+    In chunks spread over a pool of n_jobs processes"""
+
+    if n_jobs == 1 or len(smiles_list) <= chunk_size:
+        return chunk_descriptors(smiles_list)
+
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(METRICS.worker(chunk_descriptors))(smiles_list[start : start + chunk_size])
+        for start in range(0, len(smiles_list), chunk_size)
+    )
+
+    return np.concatenate(results)
+
+
+def chunk_descriptors(smiles_list: list[str]) -> np.ndarray:
+    """Descriptors (see smiles_descriptors) for a chunk of SMILES"""
+
+    carbon = MolFromSmarts("[#6]")
+    table = np.full((len(smiles_list), 4), -1, dtype=np.int32)
+
+    for k, smiles in enumerate(smiles_list):
+
+        mol = MolFromSmiles(smiles)
+        if mol is None:
+            continue
+
+        ring_info = mol.GetRingInfo()
+        table[k] = (
+            mol.GetNumAtoms(),
+            len(mol.GetSubstructMatches(carbon)),
+            len(set().union(*ring_info.AtomRings())),
+            ring_info.NumRings(),
+        )
+
+    return table
+
+
+def get_mol_coords(mol: Mol) -> np.ndarray:
+    """Atomic coordinates of a molecule's conformer as an (n_atoms, 3) array"""
+    return mol.GetConformer().GetPositions()
+
+
+def pad_coords(coords: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    """Stack ragged coordinate arrays into a (n_mols, max_atoms, 3) array and an (n_mols, max_atoms) mask of real atoms"""
+
+    n_atoms = np.array([len(c) for c in coords])
+    mask = np.arange(n_atoms.max(initial=0)) < n_atoms[:, None]
+
+    padded = np.zeros(mask.shape + (3,))
+    padded[mask] = np.concatenate(coords) if coords else []
+
+    return padded, mask
+
+
+def iter_pair_blocks(n: int, block_size: int):
+    """Yield (i, j) index arrays covering every unordered pair i < j of n items, in blocks of about block_size pairs"""
+
+    start = 0
+    while start < n:
+
+        # always take at least one row
+        stop = start + 1
+        count = n - stop
+        while stop < n and count + (n - stop - 1) <= block_size:
+            count += n - stop - 1
+            stop += 1
+
+        rows = range(start, stop)
+        i = np.concatenate([np.full(n - r - 1, r) for r in rows])
+        j = np.concatenate([np.arange(r + 1, n) for r in rows])
+
+        yield i, j
+
+        start = stop
+
+
+def bounding_box_distances(
+    lower: np.ndarray,
+    upper: np.ndarray,
+    i: np.ndarray,
+    j: np.ndarray,
+) -> np.ndarray:
+    """Distance between the axis-aligned bounding boxes of molecule pairs (i, j),
+    a lower bound on the minimum interatomic distance"""
+
+    gap = np.maximum(0, np.maximum(lower[j] - upper[i], lower[i] - upper[j]))
+    return np.sqrt((gap**2).sum(axis=-1))
+
+
+def pair_min_distances(
+    padded: np.ndarray,
+    mask: np.ndarray,
+    i: np.ndarray,
+    j: np.ndarray,
+    max_bytes: int = 2**26,
+) -> np.ndarray:
+    """Minimum interatomic distance for each molecule pair (i, j), vectorised over chunks of pairs.
+    Chunks are sized from the padded atom count, so that each (pairs, atoms_A, atoms_B, 3) temporary stays within max_bytes
+    """
+
+    num_atoms = padded.shape[1]
+    chunk_size = max(1, max_bytes // max(num_atoms * num_atoms * 3 * 8, 1))
+
+    distances = np.empty(len(i))
+
+    for start in range(0, len(i), chunk_size):
+        a = i[start : start + chunk_size]
+        b = j[start : start + chunk_size]
+
+        # (pairs, atoms_A, atoms_B) squared distances, ignoring padding
+        d2 = ((padded[a][:, :, None, :] - padded[b][:, None, :, :]) ** 2).sum(axis=-1)
+        d2[~(mask[a][:, :, None] & mask[b][:, None, :])] = np.inf
+
+        distances[start : start + chunk_size] = np.sqrt(d2.min(axis=(1, 2)))
+
+    return distances
+
+
 def load_sig_factory(
     fdef_file: str | Path,
     max_point_count: int,
     bins: list[list[int]],
 ):
+    """Load a pharmacophore SigFactory, memoized per process on (fdef_file, max_point_count, bins)"""
+    return _load_sig_factory(str(fdef_file), max_point_count, json.dumps(bins))
+
+
+@lru_cache(maxsize=None)
+def _load_sig_factory(
+    fdef_file: str,
+    max_point_count: int,
+    bins: str,
+):
 
     # Get FDef file path
 
@@ -57,13 +235,172 @@ def load_sig_factory(
     # sig_factory
 
     sig_factory = SigFactory(feature_factory, maxPointCount=max_point_count)
-    sig_factory.SetBins(bins)
+    sig_factory.SetBins(json.loads(bins))
     sig_factory.Init()
     sig_factory.GetSigSize()
 
     return sig_factory
 
 
+@lru_cache(maxsize=2**16)
+def canonical_smiles(smiles: str) -> str:
+    """Canonicalise a SMILES string (LRU-cached)"""
+    return MolToSmiles(MolFromSmiles(smiles))
+
+
+@lru_cache(maxsize=2**16)
+def calc_synthon_fp(
+    smiles: str,
+    fdef_file: str,
+    max_point_count: int,
+    bins: str,
+) -> tuple[int, ...]:
+    """
+    Calculate the pharmacophore fingerprint vector of a synthon (LRU-cached per process)
+
+    :param smiles: canonical synthon SMILES
+    :param fdef_file: feature definition file
+    :param max_point_count: maximum number of pharmacophore points
+    :param bins: JSON-encoded distance bins
+    :return: fingerprint bits
+    """
+    sig_factory = _load_sig_factory(fdef_file, max_point_count, bins)
+    return tuple(calc_pharm_fp(MolFromSmiles(smiles), sig_factory, as_str=False))
+
+
+def similarity_metric(metric: str) -> str:
+    """Name of a similarity metric, e.g. 'tanimoto' for 'usersimilarity.tanimoto_similarity'"""
+
+    name = metric.rsplit(".", maxsplit=1)[-1].removesuffix("_similarity")
+
+    if name not in SIMILARITY_METRICS:
+        raise ValueError(
+            f"Unknown similarity metric: {metric}, must be one of {SIMILARITY_METRICS}"
+        )
+
+    return name
+
+
+def similarity_matrix(
+    fps: np.ndarray,
+    vectors: np.ndarray,
+    metric: str = "tanimoto",
+) -> np.ndarray:
+    """
+    Similarity of every (bit) fingerprint to every query fingerprint
+
+    :param fps: (n, m) array of fingerprints
+    :param vectors: (k, m) array of query fingerprints, the shorter of fps and vectors is zero-padded
+    :param metric: tanimoto, dice or cosine (see similarity_metric)
+    :return: (n, k) array of similarities (0 where both fingerprints are empty)
+    """
+
+    metric = similarity_metric(metric)
+
+    fps = np.asarray(fps) != 0
+    vectors = np.atleast_2d(np.asarray(vectors)) != 0
+
+    width = max(fps.shape[1], vectors.shape[1])
+    fps = np.pad(fps, ((0, 0), (0, width - fps.shape[1]))).astype(np.float32)
+    vectors = np.pad(vectors, ((0, 0), (0, width - vectors.shape[1]))).astype(
+        np.float32
+    )
+
+    # bit counts are exact in float32, the ratios are taken in double precision (as on the server)
+    # so that similarities exactly at the threshold are kept
+    common = (fps @ vectors.T).astype(np.float64)
+    a = fps.sum(axis=1, dtype=np.float64)[:, None]
+    b = vectors.sum(axis=1, dtype=np.float64)[None, :]
+
+    if metric == "tanimoto":
+        denominator = a + b - common
+    elif metric == "dice":
+        common, denominator = 2 * common, a + b
+    elif metric == "cosine":
+        denominator = np.sqrt(a * b)
+
+    return np.divide(
+        common, denominator, out=np.zeros(common.shape), where=denominator > 0
+    )
+
+
+def parse_pharmfp(pharmfp) -> list[int] | None:
+    """Pharmacophore fingerprint from a list or ';'-separated string (see calc_pharm_fp)"""
+
+    if pharmfp is None:
+        return None
+
+    if isinstance(pharmfp, str):
+        return [int(x) for x in pharmfp.split(";") if x]
+
+    return list(pharmfp)
+
+
+def fingerprint_matrix(fps: list[list[int] | None]) -> np.ndarray:
+    """Stack fingerprints into a (zero-padded) uint8 matrix, missing fingerprints are all zero"""
+
+    width = max((len(fp) for fp in fps if fp is not None), default=0)
+
+    matrix = np.zeros((len(fps), width), dtype=np.uint8)
+    for i, fp in enumerate(fps):
+        if fp is not None:
+            matrix[i, : len(fp)] = fp
+
+    return matrix
+
+
+def score_candidates(
+    pairs: list[dict],
+    candidates: dict[str, dict],
+    threshold: float,
+    metric: str,
+    limit: int | None,
+) -> list[dict]:
+    """
+    Score candidate expansions against the synthons of impure expansion pairs, all synthons of a subnode at once.
+    Equivalent to knitwork.query.IMPURE_EXPANSIONS_QUERY with the similarity calculated client-side.
+
+    :param pairs: dicts with index, smiles (subnode), synthon and vector (synthon fingerprint)
+    :param candidates: dicts of smi, ids, syn (arrays) and fps (matrix) of candidate expansions for each subnode
+    :return: records with index, smi, syn, sim and ids
+    """
+
+    subnode_pairs = {}
+    for pair in pairs:
+        subnode_pairs.setdefault(pair["smiles"], []).append(pair)
+
+    records = []
+    for subnode, group in subnode_pairs.items():
+
+        c = candidates.get(subnode)
+        if c is None or not len(c["syn"]):
+            continue
+
+        vectors = fingerprint_matrix([pair["vector"] for pair in group])
+        similarities = similarity_matrix(c["fps"], vectors, metric)
+
+        for j, pair in enumerate(group):
+            # as in Cypher, missing synthons never match NOT syn=p.synthon
+            keep = (
+                (similarities[:, j] >= threshold)
+                & (c["syn"] != pair["synthon"])
+                & np.not_equal(c["syn"], None)
+            )
+
+            for i in np.flatnonzero(keep)[: limit or None]:
+                records.append(
+                    dict(
+                        index=pair["index"],
+                        smi=c["smi"][i],
+                        syn=c["syn"][i],
+                        sim=float(similarities[i, j]),
+                        ids=c["ids"][i],
+                    )
+                )
+
+    return records
+
+
 def calc_pharm_fp(mol, sig_factory, as_str=True):
     """
     Calculate pharmacophore fingerprint using RDKit